@@ -15,9 +15,23 @@
 
 """Subsonic Interface for beets"""
 
+import os
+import sqlite3
+
+import six
+
+from beets import config
+from beets.library import Album, Library
 from beets.plugins import BeetsPlugin
 from beets.ui import Subcommand
+from beets.ui import UserError
+from beets.ui import get_path_formats, get_replacements
+from beets.util.artresizer import ArtResizer
 
+from beetsplug.beetsonic import search
+from beetsplug.beetsonic import server
+from beetsplug.beetsonic import thumbnails
+from beetsplug.beetsonic import transcoding
 from beetsplug.beetsonic.models import BeetsModel
 from beetsplug.beetsonic.web import SubsonicServer
 
@@ -31,17 +45,134 @@ class BeetsonicPlugin(BeetsPlugin):
             'cors': u'',
             'playlist_dir': u'',
             'ignoredArticles': u'The El La Los Las Le Les',
+            # The WSGI server, see the server module
+            'server': server.DEFAULT_CONFIG,
+            # Play statistics and starred albums, defaults to stats.db in
+            # beets' config directory
+            'stats_db': u'',
+            # Count plays when songs are streamed instead of when they are
+            # scrobbled, for clients which do not scrobble
+            'count_streams': False,
+            # Full-text index of search2 and search3, defaults to search.db
+            # in beets' config directory
+            'search_db': u'',
+            # Lyrics fetched for the songs without any in the library,
+            # defaults to lyrics.db in beets' config directory
+            'lyrics_db': u'',
+            # Song counts and durations of the playlists, defaults to
+            # playlists.db in beets' config directory
+            'playlists_db': u'',
+            'transcoding': {
+                'workers': transcoding.DEFAULT_WORKERS,
+                'default_profile': u'mp3',
+                'profiles': transcoding.DEFAULT_PROFILES,
+                # Defaults to the transcodes directory in beets' config
+                # directory; the size is in megabytes, 0 disables the cache
+                'cache_dir': u'',
+                'cache_size': 1024,
+            },
+            'thumbnails': {
+                # Defaults to the thumbnails directory in beets' config
+                # directory; the size is in megabytes, 0 disables the cache
+                'cache_dir': u'',
+                'cache_size': 256,
+                # Sizes generated by the sonic-warm command
+                'warm_sizes': thumbnails.DEFAULT_WARM_SIZES,
+            },
         })
+        self.model = None
+        # Songs and albums changed by this process, to be indexed again by
+        # the search index of the server
+        self.dirty_items = set()
+        self.dirty_albums = set()
+        self.register_listener('database_change', self.database_change)
+        self.register_listener('item_imported', self.item_imported)
+        self.register_listener('album_imported', self.album_imported)
+        self.register_listener('item_removed', self.item_removed)
+        self.register_listener('cli_exit', self.cli_exit)
+
+    def database_change(self, lib, model):
+        """
+        Start a new library generation when beets changes the database, so
+        that the responses cached by the clients are sent again.
+        """
+        if self.model is not None:
+            self.model.invalidate()
+        if isinstance(model, Album):
+            self.dirty_albums.add(model.id)
+        elif model is not None:
+            self.dirty_items.add(model.id)
+
+    def item_imported(self, lib, item):
+        self.dirty_items.add(item.id)
+
+    def album_imported(self, lib, album):
+        self.dirty_albums.add(album.id)
+        self.dirty_items.update(item.id for item in album.items())
+
+    def item_removed(self, item):
+        self.dirty_items.add(item.id)
+
+    def cli_exit(self, lib):
+        """
+        Mark the songs and albums changed by the command in the search
+        index, for the server to index them again. Nothing is done when the
+        server never created the index.
+        """
+        path = self.db_path('search_db', u'search.db')
+        # Without an index yet, the server builds it from the whole library
+        if (self.dirty_items or self.dirty_albums) and os.path.exists(path):
+            try:
+                index = search.SearchIndex(path)
+                try:
+                    index.mark_dirty(self.dirty_items, self.dirty_albums)
+                finally:
+                    index.close()
+            except sqlite3.Error as e:
+                # e.g. while the server holds the lock of the database
+                self._log.warning(u'cannot mark the changes in the search '
+                                  u'index: {}', e)
+        self.dirty_items.clear()
+        self.dirty_albums.clear()
+
+    def cache_configs(self, key, default_dir):
+        """
+        Get a configuration section holding the cache_dir and cache_size of
+        a cache, resolving the cache directory.
+        :param key: The configuration key of the section.
+        :param default_dir: The directory used in beets' configuration
+        directory when cache_dir is not set.
+        :return: The configuration dict.
+        """
+        configs = self.config[key].flatten()
+        if self.config[key]['cache_dir'].get():
+            configs[u'cache_dir'] = self.config[key]['cache_dir'].as_filename()
+        else:
+            configs[u'cache_dir'] = os.path.join(
+                config.config_dir(), u'beetsonic', default_dir)
+        return configs
+
+    def db_path(self, key, default_name):
+        """
+        Get the path of a database of the plugin.
+        :param key: The configuration key of the path.
+        :param default_name: The file name used in beets' configuration
+        directory when the path is not set.
+        :return: The path.
+        """
+        if self.config[key].get():
+            return self.config[key].as_filename()
+        return os.path.join(config.config_dir(), u'beetsonic', default_name)
 
     def commands(self):
         def init_server(lib, opts, args):
-            model = BeetsModel(lib)
+            model = self.model = BeetsModel(lib)
+            model.create_indexes()
             if opts.username is None:
                 raise KeyError('Username is required')
             if opts.password is None:
                 raise KeyError('Password is required')
             # Get all the args and opts into one variable
-
             configs = {
                 u'host': self.config['host'].as_str(),
                 u'port': self.config['port'].get(int),
@@ -51,13 +182,36 @@ class BeetsonicPlugin(BeetsPlugin):
                 u'username': opts.username,
                 u'password': opts.password,
                 u'ignoredArticles': self.config['ignoredArticles'].as_str(),
+                u'transcoding': self.cache_configs('transcoding',
+                                                   u'transcodes'),
+                u'thumbnails': self.cache_configs('thumbnails',
+                                                  u'thumbnails'),
+                u'stats_db': self.db_path('stats_db', u'stats.db'),
+                u'count_streams': self.config['count_streams'].get(bool),
+                u'search_db': self.db_path('search_db', u'search.db'),
+                u'lyrics_db': self.db_path('lyrics_db', u'lyrics.db'),
+                u'playlists_db': self.db_path('playlists_db',
+                                              u'playlists.db'),
             }
-            app = SubsonicServer(model, configs, __name__)
-            app.run(
-                host=configs[u'host'],
-                port=configs[u'port'],
-                debug=configs[u'debug'],
-            )
+            server_config = self.config['server'].flatten()
+            if opts.debug:
+                server_config[u'backend'] = u'development'
+            parent = os.getpid()
+
+            def create_app():
+                app_model = model
+                if os.getpid() != parent:
+                    # A forked worker, with SQLite connections of its own
+                    app_lib = Library(lib.path, lib.directory,
+                                      get_path_formats(), get_replacements())
+                    app_model = self.model = BeetsModel(app_lib)
+                return SubsonicServer(app_model, configs, __name__)
+
+            try:
+                server.serve(create_app, configs[u'host'], configs[u'port'],
+                             server_config, debug=configs[u'debug'])
+            except server.ServerError as e:
+                raise UserError(six.text_type(e))
 
         cmd = Subcommand('sonic',
                          help='Run Subsonic server interface for beets')
@@ -68,4 +222,31 @@ class BeetsonicPlugin(BeetsPlugin):
         cmd.parser.add_option(u'-d', u'--debug', action='store_true',
                               default=False, help=u'debug mode')
         cmd.func = init_server
-        return [cmd]
+
+        def warm_thumbnails(lib, opts, args):
+            if not ArtResizer.shared.local:
+                raise UserError(u'Pillow or ImageMagick is required to '
+                                u'resize cover art')
+            configs = self.cache_configs('thumbnails', u'thumbnails')
+            if not configs[u'cache_size']:
+                raise UserError(u'The thumbnail cache is disabled')
+            sizes = self.config['thumbnails']['warm_sizes'].get(list)
+            artpaths = list(BeetsModel(lib).get_cover_art_paths())
+            generated = 0
+            for count in thumbnails.warm_all(
+                    artpaths, configs[u'cache_dir'],
+                    int(configs[u'cache_size']) << 20,
+                    [int(size) for size in sizes], opts.jobs):
+                generated += count
+            self._log.info(u'{} thumbnails generated for {} cover art',
+                           generated, len(artpaths))
+
+        warm_cmd = Subcommand('sonic-warm',
+                              help='Generate the thumbnails of the cover art '
+                                   'for the Subsonic server')
+        warm_cmd.parser.add_option(u'-j', u'--jobs', action='store',
+                                   type='int', default=None,
+                                   help=u'number of processes, one per CPU '
+                                        u'by default')
+        warm_cmd.func = warm_thumbnails
+        return [cmd, warm_cmd]
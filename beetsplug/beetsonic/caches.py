@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Caches for the data served by the Subsonic API, and the SQLite databases of
+the plugin.
+"""
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import collections
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Prefix of the files written to a DirectoryCache before being added to it.
+TEMP_PREFIX = u'.tmp-'
+
+# Number of seconds after which temporary files are considered abandoned.
+STALE_TEMP_AGE = 60 * 60
+
+# Number of seconds after which a DirectoryCache lists its directory again,
+# to count the files of the other processes using it.
+RESCAN_INTERVAL = 60
+
+
+class DocumentCache(object):
+    """
+    In-memory cache of serialized response documents. Every document is kept
+    along with the state of the library it was built from, and is built again
+    once that state changes.
+    """
+
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, state, build):
+        """
+        Get a document, building it if it is missing or outdated.
+        :param key: The key of the document, e.g. its endpoint and format.
+        :param state: The current state of the library, see
+        BeetsModel.get_library_state.
+        :param build: Function without arguments building the document.
+        :return: The document.
+        """
+        with self._lock:
+            cached = self._documents.get(key)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+        document = build()
+        with self._lock:
+            self._documents[key] = (state, document)
+        return document
+
+
+class DirectoryCache(object):
+    """
+    Directory of generated files, e.g. transcoded songs. Files are written to
+    a temporary file first, then renamed into the cache, so that the cache
+    only ever holds complete files. When the directory grows larger than
+    max_size, the least recently used files are removed.
+
+    The directory may be shared by several processes, e.g. the workers of
+    the server. Using a file touches it, so that the modification times are
+    the order of use across processes, and the directory is listed again
+    every rescan_interval seconds to count the files of the others.
+    """
+
+    def __init__(self, directory, max_size, rescan_interval=RESCAN_INTERVAL):
+        """
+        :param directory: The cache directory, created if needed.
+        :param max_size: The maximum size of the cache, in bytes, or None
+        for no limit, e.g. for processes leaving the evictions to another.
+        :param rescan_interval: The number of seconds after which the
+        directory is listed again, when files are added.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        # The sizes of the cached files by name, least recently used first.
+        # In between scans of the directory, files are counted as they are
+        # added and evicted.
+        self._files = collections.OrderedDict()
+        self._size = 0
+        self._scanned = 0
+        # Number of files evicted since the cache was created
+        self.evicted = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._scan()
+
+    def _scan(self):
+        """
+        List the directory, ordering its files by modification time.
+        """
+        # Files left over by interrupted writes. Recent ones may still be
+        # written by another process using the same directory.
+        stale = time.time() - STALE_TEMP_AGE
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.startswith(TEMP_PREFIX):
+                    if os.path.getmtime(path) < stale:
+                        os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        self._files = collections.OrderedDict(
+            (name, size) for _, size, name in sorted(entries))
+        self._size = sum(self._files.values())
+        self._scanned = time.time()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a cache from the configuration of the plugin.
+        :param config: Dict with the cache_dir and cache_size keys, the
+        size being in megabytes.
+        :return: The cache, or None if caching is disabled.
+        """
+        if not config.get(u'cache_dir') or not config.get(u'cache_size'):
+            return None
+        return cls(config[u'cache_dir'], int(config[u'cache_size']) << 20)
+
+    def get(self, path):
+        """
+        Look up a cached file, marking it as recently used.
+        :param path: The path of the file in the cache.
+        :return: The path, or None if the file is not cached.
+        """
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        name = os.path.basename(path)
+        with self._lock:
+            size = self._files.pop(name, None)
+            if size is not None:
+                self._files[name] = size
+                return path
+        # Added by another process using the same directory
+        self.track(path)
+        return path
+
+    def temp_file(self, suffix=u''):
+        """
+        Create a temporary file in the cache directory, to be added with
+        add() once complete.
+        :param suffix: The suffix of the file name.
+        :return: A tuple of the OS level handle and the path of the file.
+        """
+        return tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=suffix,
+                                dir=self.directory)
+
+    def add(self, temp_path, path):
+        """
+        Move a complete file into the cache, then evict the least recently
+        used files if the cache is too large.
+        :param temp_path: The path of the temporary file.
+        :param path: The path of the file in the cache.
+        """
+        os.rename(temp_path, path)
+        self.track(path)
+
+    def track(self, path):
+        """
+        Count a file of the cache as the most recently used, e.g. a file
+        added by another process, evicting the least recently used ones if
+        the cache grows too large.
+        :param path: The path of the file in the cache.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        name = os.path.basename(path)
+        with self._lock:
+            if time.time() - self._scanned >= self.rescan_interval:
+                # Counts the files added, used and evicted by other processes
+                self._scan()
+            self._size += size - self._files.pop(name, 0)
+            self._files[name] = size
+            self._evict()
+
+    def trim(self):
+        """
+        List the directory again, then evict the least recently used files
+        if the cache is too large.
+        """
+        with self._lock:
+            self._scan()
+            self._evict()
+
+    def _evict(self):
+        while self.max_size is not None and self._size > self.max_size and \
+                self._files:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            self.evicted += 1
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class Database(object):
+    """
+    A SQLite database of the plugin, e.g. the play statistics. The databases
+    are small and written to by short transactions, so that a single
+    connection shared by the request threads, behind a lock, is enough.
+
+    Subclasses set SCHEMA, and increase SCHEMA_VERSION whenever it changes:
+    the TABLES of databases of another version are dropped before the schema
+    is created.
+    """
+
+    SCHEMA = ''
+    SCHEMA_VERSION = 0
+    TABLES = ()
+
+    def __init__(self, path):
+        """
+        :param path: The path of the database, created if needed, or
+        ':memory:'.
+        :raise sqlite3.Error: When the schema cannot be created.
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        try:
+            with self._lock, self._connection as connection:
+                self._create_schema(connection)
+        except sqlite3.Error:
+            self._connection.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _create_schema(self, connection):
+        """
+        Create the schema, dropping the tables of another SCHEMA_VERSION.
+        The version is stored as the user_version of the database.
+        """
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self._drop_tables(connection)
+            connection.execute(
+                'PRAGMA user_version={}'.format(self.SCHEMA_VERSION))
+        connection.executescript(self.SCHEMA)
+
+    def _drop_tables(self, connection):
+        for table in self.TABLES:
+            connection.execute('DROP TABLE IF EXISTS {}'.format(table))
@@ -26,3 +26,4 @@ USER_NOT_AUTHORIZED_ERROR_MSG = u'User is not authorized for the ' + \
 PREMIUM_TRIAL_OVER_ERROR_MSG = u'Hell has frozen over and beetsonic is ' + \
                                u'premium only'
 DATA_NOT_FOUND_ERROR_MSG = u'The requested data was not found.'
+INVALID_PARAMETER_ERROR_MSG = u'Parameter {} is invalid.'
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Lyrics of the songs which have none in the library, for getLyrics.
+
+Scraping lyrics takes seconds, so it is done by the threads of a
+LyricsFetcher, which requests only wait for up to a timeout: a request
+giving up leaves the lookup running, and its result is read from the cache
+by the next request for the song. Results are kept in a SQLite database of
+the plugin, songs without lyrics included, so that the sources are not
+scraped again before their TTL expires.
+"""
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import threading
+import time
+
+from beets import logging
+from six.moves import queue
+
+from beetsplug.beetsonic import caches
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS lyrics (
+    artist TEXT NOT NULL,
+    title TEXT NOT NULL,
+    lyrics TEXT,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (artist, title)
+);
+'''
+
+log = logging.getLogger('beets.beetsonic')
+
+# Number of seconds lyrics found are kept in a LyricsCache.
+FOUND_TTL = 90 * 24 * 60 * 60
+
+# Number of seconds songs without lyrics are kept in a LyricsCache, before
+# the sources are tried again.
+MISSING_TTL = 7 * 24 * 60 * 60
+
+# Number of seconds a request waits for the lyrics of a LyricsFetcher.
+FETCH_TIMEOUT = 5
+
+# Number of lookups of a LyricsFetcher running at once.
+FETCH_WORKERS = 2
+
+# The lyrics plugin of fetch_from_beets
+_plugin = None
+_plugin_lock = threading.Lock()
+
+
+def fetch_from_beets(artist, title):
+    """
+    Fetch lyrics with beets' lyrics plugin, from its configured sources.
+    The plugin is only created by the first lookup.
+    :return: The lyrics, or None when none are found.
+    """
+    global _plugin
+    with _plugin_lock:
+        if _plugin is None:
+            from beetsplug.lyrics import LyricsPlugin
+            _plugin = LyricsPlugin()
+    return _plugin.get_lyrics(artist, title)
+
+
+def _key(artist, title):
+    return artist.strip().lower(), title.strip().lower()
+
+
+class LyricsCache(caches.Database):
+    """
+    The database of the lyrics fetched, or not found, per artist and title.
+    """
+
+    SCHEMA = SCHEMA
+
+    def __init__(self, path, found_ttl=FOUND_TTL, missing_ttl=MISSING_TTL):
+        """
+        :param path: The path of the database, created if needed, or
+        ':memory:'.
+        :param found_ttl: The number of seconds lyrics are kept.
+        :param missing_ttl: The number of seconds songs without lyrics are
+        kept.
+        """
+        super(LyricsCache, self).__init__(path)
+        self.found_ttl = found_ttl
+        self.missing_ttl = missing_ttl
+
+    def get(self, artist, title):
+        """
+        Look up the lyrics of a song.
+        :return: A (found, lyrics) tuple, found being False when the song is
+        not in the cache or has expired, and lyrics None for songs known to
+        have none.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT lyrics, fetched FROM lyrics '
+                'WHERE artist=? AND title=?', _key(artist, title)).fetchone()
+        if row is None:
+            return False, None
+        lyrics, fetched = row
+        ttl = self.found_ttl if lyrics else self.missing_ttl
+        if fetched + ttl < time.time():
+            return False, None
+        return True, lyrics or None
+
+    def put(self, artist, title, lyrics, fetched=None):
+        """
+        Store the lyrics of a song.
+        :param lyrics: The lyrics, or None when none were found.
+        :param fetched: The timestamp of the lookup, or None for now.
+        """
+        with self._lock, self._connection as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO lyrics (artist, title, lyrics, '
+                'fetched) VALUES (?, ?, ?, ?)',
+                _key(artist, title) + (lyrics or None, fetched or time.time()))
+
+
+class LyricsFetcher(object):
+    """
+    Lyrics read from a LyricsCache, and else looked up by background
+    threads. Concurrent requests for the same song share a single lookup.
+    """
+
+    _STOP = object()
+
+    def __init__(self, cache, fetch=fetch_from_beets, timeout=FETCH_TIMEOUT,
+                 workers=FETCH_WORKERS):
+        """
+        :param cache: The LyricsCache.
+        :param fetch: Function looking up the lyrics of an artist and a
+        title, returning None when there are none, e.g. fetch_from_beets.
+        :param timeout: The number of seconds get waits for a lookup.
+        :param workers: The number of lookups running at once.
+        """
+        self.cache = cache
+        self.fetch = fetch
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        # The events of the lookups queued or running, per song key
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._run,
+                                      name='beetsonic-lyrics')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def get(self, artist, title):
+        """
+        Get the lyrics of a song, waiting up to the timeout when they have
+        to be looked up.
+        :return: The lyrics, or None when there are none or the lookup is
+        still running.
+        """
+        found, lyrics = self.cache.get(artist, title)
+        if found:
+            return lyrics
+        key = _key(artist, title)
+        with self._lock:
+            done = self._pending.get(key)
+            if done is None:
+                done = self._pending[key] = threading.Event()
+                self._queue.put((key, artist, title))
+        done.wait(self.timeout)
+        return self.cache.get(artist, title)[1]
+
+    def close(self):
+        """
+        Stop the threads, once the queued lookups are done.
+        """
+        for _ in self._threads:
+            self._queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            lookup = self._queue.get()
+            if lookup is self._STOP:
+                return
+            key, artist, title = lookup
+            try:
+                self.cache.put(artist, title, self.fetch(artist, title))
+            except Exception as e:
+                # Not cached, so that the next request tries again
+                log.warning(u'beetsonic: cannot fetch the lyrics of {} - {}: '
+                            u'{}', artist, title, e)
+            finally:
+                with self._lock:
+                    self._pending.pop(key).set()
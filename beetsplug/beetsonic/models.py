@@ -9,21 +9,201 @@ from __future__ import (
     unicode_literals,
 )
 
-import functools
-import glob
+import collections
+import errno
 import os
 import random
+import sqlite3
+import threading
+import time
 from datetime import datetime
 
 import enum
 import six
+from beets import logging
+from beets import util
+from beets.library import BLOB_TYPE, Item, parse_query_parts
 from beets.ui import decargs
-from beetsplug.lyrics import LyricsPlugin
 
+from beetsplug.beetsonic import playlists
+from beetsplug.beetsonic import search
 from beetsplug.beetsonic import utils
 
+log = logging.getLogger('beets.beetsonic')
+
 BEET_MUSIC_FOLDER_ID = 1
 
+# Number of rows fetched at once from the SQLite cursor when streaming rows.
+ROW_BATCH_SIZE = 256
+
+# SQL function returning the index name of an artist, see utils.index_name.
+INDEX_NAME_FUNCTION = 'beetsonic_index_name'
+
+# The state of the library the responses are built from. The generation
+# changes whenever the library does, and last_modified is the Unix timestamp
+# of the last known change.
+LibraryState = collections.namedtuple('LibraryState',
+                                      ['generation', 'last_modified'])
+
+# Columns of an AlbumID3, selected from ALBUM_ID3_TABLES and grouped by
+# album, see BeetsModel._create_album_id3.
+ALBUM_ID3_COLUMNS = collections.OrderedDict([
+    ('id', 'a.id'),
+    ('album', 'a.album'),
+    ('albumartist', 'a.albumartist'),
+    ('year', 'a.year'),
+    ('genre', 'a.genre'),
+    ('added', 'a.added'),
+    ('song_count', 'COUNT(i.id)'),
+    ('duration', 'TOTAL(i.length)'),
+])
+ALBUM_ID3_TABLES = 'albums a LEFT JOIN items i ON a.id=i.album_id'
+
+# Indexes created in the library by BeetsModel.create_indexes: the songs of
+# an album, the titles looked up by getLyrics, the paths of playlists, and the
+# orders and filters of getAlbumList2, so that a page only reads its own
+# albums.
+LIBRARY_INDEXES = [
+    ('beetsonic_items_album_id', 'items', ['album_id']),
+    ('beetsonic_items_title', 'items', ['title COLLATE NOCASE']),
+    ('beetsonic_items_path', 'items', ['path']),
+    ('beetsonic_albums_added', 'albums', ['added']),
+    ('beetsonic_albums_album', 'albums', ['album', 'albumartist', 'year']),
+    ('beetsonic_albums_albumartist', 'albums',
+     ['albumartist', 'album', 'year']),
+    ('beetsonic_albums_year', 'albums', ['year', 'albumartist', 'album']),
+    ('beetsonic_albums_genre', 'albums', ['genre']),
+]
+
+# Number of playlist entries or ids looked up at once, below SQLite's limit
+# of 999 query parameters.
+PLAYLIST_BATCH_SIZE = 500
+
+# Number of rounds of random ids drawn by BeetsModel._sample_ids.
+RANDOM_SAMPLING_ROUNDS = 3
+
+# The file of a song, as needed to stream it.
+SongFile = collections.namedtuple('SongFile',
+                                  ['id', 'path', 'format', 'bitrate', 'mtime',
+                                   'album_id'])
+
+# Columns of the items table needed to create a song.
+SONG_COLUMNS = ['id', 'title', 'album', 'artist', 'year', 'genre', 'album_id',
+                'path', 'track', 'length', 'format']
+
+MUSIC_TYPE = utils.get_music_type()
+
+
+if six.PY2:
+    class Row(sqlite3.Row):
+        """
+        The rows read from the library. Python 2's sqlite3.Row only takes
+        byte strings as column names, and the names in this module are
+        unicode.
+        """
+
+        def __getitem__(self, key):
+            if isinstance(key, six.text_type):
+                key = str(key)
+            return super(Row, self).__getitem__(key)
+else:
+    Row = sqlite3.Row
+
+
+class _ThreadConnection(object):
+    """
+    The read connection of a thread, only referenced by its thread-local
+    storage, so that it is closed as soon as the thread ends.
+    """
+
+    def __init__(self, connection, owned):
+        """
+        :param connection: The sqlite3 connection.
+        :param owned: Whether to close the connection, False for the
+        connections of the library.
+        """
+        self.connection = connection
+        self.owned = owned
+
+    def __del__(self):
+        if self.owned:
+            try:
+                self.connection.close()
+            except sqlite3.Error:
+                pass
+
+
+class ReadConnections(object):
+    """
+    Read-only SQLite connections to the library, one per thread, closed
+    once their thread ends.
+
+    The library's transactions are serialized by a lock of beets, so that a
+    slow request would block all the others. These connections read without
+    it: the database is switched to WAL mode, where readers do not wait for
+    each other nor for the writer, and each connection is made query_only,
+    so that nothing can be written through them.
+    """
+
+    def __init__(self, lib):
+        """
+        :param lib: The beets Library.
+        """
+        self.lib = lib
+        self._local = threading.local()
+        # Another connection to an in-memory database would open an empty one
+        self._shared = lib.path in (':memory:', b':memory:')
+        self._version_connection = None
+        self._version_lock = threading.Lock()
+        if not self._shared:
+            self._enable_wal()
+
+    def _enable_wal(self):
+        connection = self.lib._create_connection()
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.Error as e:
+            log.warning(u'beetsonic: cannot enable WAL mode: {}', e)
+        finally:
+            connection.close()
+
+    def data_version(self):
+        """
+        Get the data_version of the library, which changes with every commit
+        of another connection. It is read through a single connection, so
+        that each commit is seen once, whichever thread checks first.
+        :return: The data_version, or None for in-memory libraries, which
+        only this process changes, see BeetsModel.invalidate.
+        """
+        if self._shared:
+            return None
+        with self._version_lock:
+            if self._version_connection is None:
+                self._version_connection = sqlite3.connect(
+                    util.py3_path(self.lib.path), check_same_thread=False)
+                self._version_connection.execute('PRAGMA query_only=ON')
+            return self._version_connection.execute(
+                'PRAGMA data_version').fetchone()[0]
+
+    def get(self):
+        """
+        Get the connection of the current thread, created if needed.
+        :return: The sqlite3 connection.
+        """
+        holder = getattr(self._local, 'connection', None)
+        if holder is None:
+            if self._shared:
+                connection = self.lib._connection()
+            else:
+                connection = self.lib._create_connection()
+                connection.execute('PRAGMA query_only=ON')
+            connection.create_function(INDEX_NAME_FUNCTION, 2,
+                                       utils.index_name)
+            connection.row_factory = Row
+            holder = _ThreadConnection(connection, not self._shared)
+            self._local.connection = holder
+        return holder.connection
+
 
 @enum.unique
 class BeetIdType(enum.Enum):
@@ -95,13 +275,95 @@ class BeetsModel(object):
         self.basedir = lib.directory
         if not isinstance(self.basedir, six.string_types):
             self.basedir = self.basedir.decode()
+        self._basedir_prefix = self.basedir.rstrip(os.sep) + os.sep
+
+        self._epoch = int(time.time())
+        self._generation = 0
+        self._state = None
+        self._data_version = None
+        self._state_lock = threading.Lock()
+        # The generation and the fingerprint of get_library_fingerprint
+        self._fingerprint = None
+        self._connections = ReadConnections(lib)
+        # The resolved playlists, per m3u location
+        self._playlists = {}
+        self._playlists_lock = threading.Lock()
+
+    def _query(self, query, params=()):
+        """
+        Run a read query on the connection of the current thread.
+        :param query: The SQL query.
+        :param params: The parameters of the query.
+        :return: The list of rows, which are mappings.
+        """
+        return self._connections.get().execute(query, params).fetchall()
 
     def _resolve_path(self, path, relative=False):
         if not path:
             return None
+        if not isinstance(path, (six.binary_type, six.text_type)):
+            # The BLOBs of the rows read from the library
+            path = six.binary_type(path)
         if not isinstance(path, six.string_types):
             path = path.decode()
-        return os.path.relpath(path, self.basedir) if relative else path
+        path = os.path.join(self.basedir, path)
+        if not relative:
+            return path
+        # Paths in the library directory, which are most of them, do not need
+        # the path normalization of relpath
+        if path.startswith(self._basedir_prefix) and \
+                os.sep + os.pardir not in path and \
+                os.sep + os.curdir + os.sep not in path:
+            return path[len(self._basedir_prefix):]
+        return os.path.relpath(path, self.basedir)
+
+    def _iter_rows(self, query, params=()):
+        """
+        Stream the rows of a read query from the SQLite cursor, fetching them
+        in batches, so that the whole result is never held in memory.
+        The rows are mappings, as with the library's transactions.
+        :param query: The SQL query.
+        :param params: The parameters of the query.
+        :return: A generator of rows.
+        """
+        cursor = self._connections.get().execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(ROW_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def _iter_songs(self, where, params=(), order='id'):
+        """
+        Stream Child objects for the items matching a SQL condition, reading
+        only the columns needed to create them.
+        :param where: The SQL condition on the items table.
+        :param params: The parameters of the condition.
+        :param order: The SQL ordering of the items.
+        :return: A generator of Child objects.
+        """
+        query = 'SELECT {} FROM items WHERE {} ORDER BY {}'.format(
+            ', '.join(SONG_COLUMNS), where, order)
+        rows = self._iter_rows(query, params)
+        return (self._create_song(row) for row in rows)
+
+    def _get_songs(self, where, params=(), order=None):
+        """
+        Get the Child objects for the items matching a SQL condition, without
+        creating beets' Item objects, see _iter_songs.
+        :param where: The SQL condition on the items table.
+        :param params: The parameters of the condition.
+        :param order: The SQL ordering of the items, the default sort of the
+        library when None.
+        :return: A list of Child objects.
+        """
+        if order is None:
+            order = self.lib.get_default_item_sort().order_clause() or 'id'
+        return list(self._iter_songs(where, params, order))
 
     @staticmethod
     def _create_artist(name, **kwargs):
@@ -119,20 +381,21 @@ class BeetsModel(object):
     def _create_song(self, item):
         """
         Create a Child object from beets' Item.
-        :param item: The beet's Item object.
+        :param item: The beet's Item object, or a row with the SONG_COLUMNS
+        of the items table.
         :return: The Child object.
         """
-        item_id = BeetIdType.get_item_id(item.id)
+        item_id = BeetIdType.get_item_id(item['id'])
         album_id = None
-        if item.album_id:
-            album_id = BeetIdType.get_album_id(item.album_id)
-        path = self._resolve_path(item.path, relative=True)
+        if item['album_id']:
+            album_id = BeetIdType.get_album_id(item['album_id'])
+        path = self._resolve_path(item['path'], relative=True)
         return utils.create_song(
-            item_id, item.title, album=item.album, artist=item.artist,
-            year=item.year, genre=item.genre, coverArt=album_id,
-            path=path, parent=album_id, track=item.track, duration=item.length,
-            type=utils.get_music_type(), isVideo=False,
-            suffix=item.format.lower(),
+            item_id, item['title'], album=item['album'], artist=item['artist'],
+            year=item['year'], genre=item['genre'], coverArt=album_id,
+            path=path, parent=album_id, track=item['track'],
+            duration=item['length'], type=MUSIC_TYPE,
+            isVideo=False, suffix=item['format'].lower(),
         )
 
     @staticmethod
@@ -152,44 +415,107 @@ class BeetsModel(object):
             parent=BeetIdType.get_artist_id(album['albumartist'])
         )
 
-    def get_album_artists(self):
+    def get_album_artists(self, ignored_articles=u''):
         """
-        Get all album artists
-        :return: List of Artist objects
+        Get all album artists, sorted by index name (see utils.index_name)
+        and name, streamed from the database.
+        :param ignored_articles: Articles to ignore in the index names,
+        separated by spaces.
+        :return: Generator of Artist objects
         """
-        with self.lib.transaction() as tx:
-            rows = tx.query(
-                'SELECT DISTINCT albumartist FROM albums ORDER BY albumartist'
-            )
-        return [self._create_artist(row[0]) for row in rows]
+        rows = self._iter_rows(
+            'SELECT DISTINCT albumartist FROM albums '
+            'ORDER BY {}(albumartist, ?), albumartist'.format(
+                INDEX_NAME_FUNCTION),
+            (ignored_articles,)
+        )
+        return (self._create_artist(row[0]) for row in rows)
 
-    def get_album_artists_id3(self):
+    def get_album_artists_id3(self, ignored_articles=u''):
         """
-        Get all album artists
-        :return: List of ArtistID3 objects
+        Get all album artists, sorted by index name (see utils.index_name)
+        and name, streamed from the database.
+        :param ignored_articles: Articles to ignore in the index names,
+        separated by spaces.
+        :return: Generator of ArtistID3 objects
         """
-        with self.lib.transaction() as tx:
-            rows = tx.query(
-                'SELECT albumartist, COUNT(1) FROM albums GROUP BY albumartist ORDER BY albumartist'
-            )
-        return [self._create_artist_id3(row[0], row[1]) for row in rows]
+        rows = self._iter_rows(
+            'SELECT albumartist, COUNT(1) FROM albums GROUP BY albumartist '
+            'ORDER BY {}(albumartist, ?), albumartist'.format(
+                INDEX_NAME_FUNCTION),
+            (ignored_articles,)
+        )
+        return (self._create_artist_id3(row[0], row[1]) for row in rows)
 
     def get_singletons(self):
         """
-        Get all the singletons in Child objects
-        :return: Child objects for singletons
+        Get all the singletons in Child objects, streamed from the database.
+        :return: Generator of Child objects for singletons
         """
-        results = self.lib.items('singleton:true')
-        return [self._create_song(item) for item in results]
+        return self._iter_songs('album_id IS NULL')
 
     def get_last_modified(self):
         """
         Get the timestamp of the last modified operation
         :return: the Unix timestamp of the last modified operation
         """
-        with self.lib.transaction() as tx:
-            rows = tx.query('SELECT max(mtime) FROM items')
-        return rows[0][0]
+        return self.get_library_state().last_modified
+
+    def invalidate(self):
+        """
+        Forget the cached library state, so that the next call to
+        get_library_state starts a new generation. Call it whenever beets
+        changes the database in this process.
+        """
+        with self._state_lock:
+            self._state = None
+
+    def get_library_state(self):
+        """
+        Get the current state of the library. The state is cached, and a new
+        generation started for every commit SQLite reports, or after
+        invalidate() is called.
+        :return: The LibraryState.
+        """
+        with self._state_lock:
+            data_version = self._connections.data_version()
+            if self._state is not None and \
+                    data_version == self._data_version:
+                return self._state
+            if self._generation == 0:
+                last_modified = self._query(
+                    'SELECT max(ifnull((SELECT max(mtime) FROM items), 0), '
+                    'ifnull((SELECT max(added) FROM items), 0), '
+                    'ifnull((SELECT max(added) FROM albums), 0))')[0][0]
+            else:
+                # Changes such as edited tags or removed songs do not show in
+                # the dates of the library, so date them from when they are
+                # noticed
+                last_modified = time.time()
+            self._generation += 1
+            self._data_version = data_version
+            self._state = LibraryState(
+                '{}-{}'.format(self._epoch, self._generation), last_modified)
+            return self._state
+
+    def get_library_fingerprint(self):
+        """
+        Get a fingerprint of the songs of the library which, unlike the
+        generations of get_library_state, is kept across restarts. It changes
+        when songs are added or removed, or when their files are updated.
+        :return: The fingerprint, as text.
+        """
+        generation = self.get_library_state().generation
+        with self._state_lock:
+            if self._fingerprint is not None and \
+                    self._fingerprint[0] == generation:
+                return self._fingerprint[1]
+        row = self._query('SELECT COUNT(id), IFNULL(MAX(id), 0), '
+                          'IFNULL(MAX(mtime), 0) FROM items')[0]
+        fingerprint = u'{}-{}-{!r}'.format(row[0], row[1], float(row[2]))
+        with self._state_lock:
+            self._fingerprint = (generation, fingerprint)
+        return fingerprint
 
     @staticmethod
     def get_music_folders():
@@ -209,11 +535,10 @@ class BeetsModel(object):
         :param columns: The columns to fetch from the table.
         :return: A list of Album objects.
         """
-        with self.lib.transaction() as tx:
-            query = 'SELECT {} FROM albums WHERE albumartist=?'.format(
-                ', '.join(columns)
-            )
-            rows = tx.query(query, (artist_name,))
+        query = 'SELECT {} FROM albums WHERE albumartist=?'.format(
+            ', '.join(columns)
+        )
+        rows = self._query(query, (artist_name,))
         albums = [dict(zip(columns, row)) for row in rows]
         return albums
 
@@ -222,10 +547,15 @@ class BeetsModel(object):
         children = []
         parent = None
         if beet_id[0] is BeetIdType.album:
-            album = self.lib.get_album(beet_id[1])
-            name = album.album
-            parent = BeetIdType.get_artist_id(album.albumartist)
-            children = [self._create_song(item) for item in album.items()]
+            rows = self._query(
+                'SELECT album, albumartist FROM albums WHERE id=?',
+                (beet_id[1],))
+            if not rows:
+                raise EntityNotFoundError(
+                    'Album {} not found'.format(beet_id[1]))
+            name, album_artist = rows[0]
+            parent = BeetIdType.get_artist_id(album_artist)
+            children = self._get_songs('album_id=?', (beet_id[1],))
         elif beet_id[0] is BeetIdType.artist:
             name = beet_id[1]
             columns = ['id', 'album', 'albumartist', 'year', 'genre', 'artpath']
@@ -234,27 +564,230 @@ class BeetsModel(object):
                 children.append(self._create_album(album))
         else:
             # It is the Item here
-            item = self.lib.get_item(beet_id[1])
-            name = item.title
-            parent = BeetIdType.get_album_id(item.album_id)
+            rows = self._query(
+                'SELECT title, album_id FROM items WHERE id=?',
+                (beet_id[1],))
+            if not rows:
+                raise EntityNotFoundError(
+                    'Song {} not found'.format(beet_id[1]))
+            name, album_id = rows[0]
+            parent = BeetIdType.get_album_id(album_id)
         return utils.create_directory(object_id, name, children,
                                       parent=parent)
 
+    @staticmethod
+    def _create_album_id3(album):
+        """
+        Create an AlbumID3 object from a row of ALBUM_ID3_COLUMNS.
+        :param album: Mapping of the ALBUM_ID3_COLUMNS keys to their values.
+        :return: The AlbumID3 object.
+        """
+        return utils.create_album_id3(
+            id=BeetIdType.get_album_id(album['id']),
+            name=album['album'],
+            song_count=album['song_count'],
+            duration=album['duration'],
+            created=datetime.fromtimestamp(album['added']),
+            artist=album['albumartist'],
+            artistId=BeetIdType.get_artist_id(album['albumartist']),
+            coverArt=BeetIdType.get_album_id(album['id']),
+            year=album['year'],
+            genre=album['genre'],
+        )
+
+    def create_indexes(self):
+        """
+        Create the indexes the queries of the model rely on, if they do not
+        exist yet, see LIBRARY_INDEXES.
+        """
+        with self.lib.transaction() as tx:
+            for name, table, columns in LIBRARY_INDEXES:
+                tx.mutate('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    name, table, ', '.join(columns)))
+
+    def _get_album_id3s(self, album_filter, params, orders):
+        """
+        Get AlbumID3 objects, aggregating the songs of the selected albums
+        only.
+        :param album_filter: SQL query of the albums table selecting the
+        albums, along with any LIMIT clause.
+        :param params: The parameters of the query.
+        :param orders: The SQL ordering of the albums.
+        :return: A list of AlbumID3 objects.
+        """
+        tables = ALBUM_ID3_TABLES.replace(
+            'albums a', '({}) a'.format(album_filter), 1)
+        query = 'SELECT {} FROM {} GROUP BY a.id ORDER BY {}'.format(
+            ','.join(ALBUM_ID3_COLUMNS.values()), tables, ','.join(orders))
+        rows = self._query(query, params)
+        albums = [dict(zip(ALBUM_ID3_COLUMNS.keys(), row)) for row in rows]
+        return [self._create_album_id3(album) for album in albums]
+
+    def _sample_ids(self, table, filters, params, number):
+        """
+        Pick random album or item ids, without reading the whole table when
+        the ids are dense enough: random ids are drawn between the lowest and
+        the highest one, and those which do not exist or do not match the
+        filters are drawn again, at most RANDOM_SAMPLING_ROUNDS times.
+        :param table: albums or items, aliased as `a` in the filters.
+        :param filters: The SQL conditions on the table.
+        :param params: The parameters of the conditions.
+        :param number: The number of ids wanted.
+        :return: A list of at most `number` ids, in random order.
+        """
+        where = ' AND '.join(filters)
+        min_id, max_id = self._query(
+            'SELECT MIN(id), MAX(id) FROM {}'.format(table), ())[0]
+        if not number or min_id is None:
+            return []
+        id_range = max_id - min_id + 1
+        picked = []
+        tried = set()
+        for _ in range(RANDOM_SAMPLING_ROUNDS):
+            wanted = min((number - len(picked)) * 2, id_range - len(tried))
+            if wanted <= 0:
+                break
+            candidates = []
+            while len(candidates) < wanted:
+                candidate = random.randint(min_id, max_id)
+                if candidate not in tried:
+                    tried.add(candidate)
+                    candidates.append(candidate)
+            found = set()
+            for batch in self._batches(candidates):
+                found.update(row[0] for row in self._query(
+                    'SELECT a.id FROM {} a WHERE {} AND a.id IN ({})'
+                    .format(table, where, ','.join('?' * len(batch))),
+                    list(params) + batch))
+            picked.extend(c for c in candidates if c in found)
+            if len(picked) >= number:
+                return picked[:number]
+        # Sparse ids or selective filters: sample the remaining ones
+        ids = [row[0] for row in self._query(
+            'SELECT a.id FROM {} a WHERE {}'.format(table, where), params)]
+        picked_ids = set(picked)
+        remaining = [album_id for album_id in ids
+                     if album_id not in picked_ids]
+        return picked + random.sample(
+            remaining, min(number - len(picked), len(remaining)))
+
+    @staticmethod
+    def _batches(ids):
+        """
+        Split ids looked up with an IN condition into batches of
+        PLAYLIST_BATCH_SIZE.
+        :param ids: The list of ids.
+        :return: Generator of lists of ids.
+        """
+        for start in range(0, len(ids), PLAYLIST_BATCH_SIZE):
+            yield ids[start:start + PLAYLIST_BATCH_SIZE]
+
+    @staticmethod
+    def _sort_by_ids(objects, ids, get_id):
+        """
+        Sort objects read with an IN condition in the order of their ids.
+        :param objects: List of Child, AlbumID3... objects.
+        :param ids: The beets ids, in the wanted order.
+        :param get_id: Function giving the Subsonic id of a beets id.
+        :return: The sorted list.
+        """
+        positions = dict((get_id(beet_id), position)
+                         for position, beet_id in enumerate(ids))
+        return sorted(objects, key=lambda obj: positions[obj.id])
+
+    def get_album_id3s_from_ids(self, album_ids):
+        """
+        Get AlbumID3 objects of albums given by their ids, e.g. from the play
+        statistics. Albums which are not in the library are skipped.
+        :param album_ids: List of beets album ids.
+        :return: The list of AlbumID3 objects, in the order of album_ids.
+        """
+        albums = []
+        for batch in self._batches(album_ids):
+            albums.extend(self._get_album_id3s(
+                'SELECT * FROM albums WHERE id IN ({})'.format(
+                    ','.join('?' * len(batch))), batch, ['a.id']))
+        return self._sort_by_ids(albums, album_ids, BeetIdType.get_album_id)
+
+    def get_album_list2_from_ids(self, album_ids):
+        """
+        Get an AlbumList2 object of albums given by their ids, see
+        get_album_id3s_from_ids.
+        :param album_ids: List of beets album ids.
+        :return: The AlbumList2 object.
+        """
+        return utils.create_album_list2(
+            self.get_album_id3s_from_ids(album_ids))
+
+    def get_albums_from_ids(self, album_ids):
+        """
+        Get Child objects of albums given by their ids.
+        :param album_ids: List of beets album ids.
+        :return: The list of Child objects, in the order of album_ids.
+        """
+        columns = ['id', 'album', 'albumartist', 'year', 'genre', 'artpath']
+        albums = []
+        for batch in self._batches(album_ids):
+            rows = self._query(
+                'SELECT {} FROM albums WHERE id IN ({})'.format(
+                    ', '.join(columns), ','.join('?' * len(batch))), batch)
+            albums.extend(self._create_album(dict(zip(columns, row)))
+                          for row in rows)
+        return self._sort_by_ids(albums, album_ids, BeetIdType.get_album_id)
+
+    def get_songs_from_ids(self, item_ids):
+        """
+        Get Child objects of songs given by their ids.
+        :param item_ids: List of beets item ids.
+        :return: The list of Child objects, in the order of item_ids.
+        """
+        songs = []
+        for batch in self._batches(item_ids):
+            songs.extend(self._get_songs('id IN ({})'.format(
+                ','.join('?' * len(batch))), batch, 'id'))
+        return self._sort_by_ids(songs, item_ids, BeetIdType.get_item_id)
+
+    def get_artists_from_names(self, names):
+        """
+        Get Artist objects of album artists given by their names.
+        :param names: List of album artist names.
+        :return: The list of Artist objects.
+        """
+        return [self._create_artist(name) for name in names]
+
+    def get_artist_id3s_from_names(self, names):
+        """
+        Get ArtistID3 objects of album artists given by their names.
+        :param names: List of album artist names.
+        :return: The list of ArtistID3 objects, in the order of names.
+        """
+        album_counts = {}
+        for batch in self._batches(names):
+            album_counts.update(self._query(
+                'SELECT albumartist, COUNT(id) FROM albums '
+                'WHERE albumartist IN ({}) GROUP BY albumartist'.format(
+                    ','.join('?' * len(batch))), batch))
+        return [self._create_artist_id3(
+            name, album_counts[name], coverArt=BeetIdType.get_artist_id(name))
+            for name in names if name in album_counts]
+
+    def update_search_index(self, search_index):
+        """
+        Bring a search index up to date with the library, reading it through
+        the connection of the current thread.
+        :param search_index: The search.SearchIndex.
+        """
+        search_index.update(self._query, self.get_library_state())
+
+    def search_library(self, kind, text, count, offset=0):
+        """
+        Search the library without a search index, see search.like_search.
+        """
+        return search.like_search(self._query, kind, text, count, offset)
+
     def get_album_list2(self, query_type, size, offset, from_year, to_year, genre):
-        columns = {
-            'id': 'a.id',
-            'album': 'a.album',
-            'albumartist': 'a.albumartist',
-            'year': 'a.year',
-            'genre': 'a.genre',
-            'added': 'a.added',
-            'song_count': 'COUNT(i.id)',
-            'duration': 'SUM(i.length)',
-        }
-        tables = 'albums a LEFT JOIN items i ON a.id=i.album_id'
         filters = ['1=1']
         params = []
-        groups = ['a.id']
         orders = []
 
         if genre:
@@ -266,6 +799,11 @@ class BeetsModel(object):
         if to_year:
             filters.append('a.year<=?')
             params.append(to_year)
+
+        if query_type == 'random':
+            return self.get_album_list2_from_ids(
+                self._sample_ids('albums', filters, params, size))
+
         if query_type == 'newest':
             orders.append('a.added DESC')
         elif query_type == 'alphabeticalByName':
@@ -280,37 +818,15 @@ class BeetsModel(object):
             orders.append('a.albumartist ASC')
             orders.append('a.album ASC')
             orders.append('a.year ASC')
+        # Ties are broken by id, so that pages do not overlap
+        orders.append('a.id ASC')
 
-        query = 'SELECT {} FROM {} WHERE {} GROUP BY {} ORDER BY {}'.format(
-            ','.join(columns.values()),
-            tables,
-            ' AND '.join(filters),
-            ','.join(groups),
-            ','.join(orders)
-        )
-
-        with self.lib.transaction() as tx:
-            rows = tx.query(query, params)
-
-        number = min(len(rows), size)
-        if query_type == 'random':
-            rows = random.sample(rows, number)
-        else:
-            rows = rows[offset:offset+number]
-
-        albums = [dict(zip(columns.keys(), row)) for row in rows]
-        albums = [utils.create_album_id3(
-            id=BeetIdType.get_album_id(album['id']),
-            name=album['album'],
-            song_count=album['song_count'],
-            duration=album['duration'],
-            created=datetime.fromtimestamp(album['added']),
-            artist=album['albumartist'],
-            artistId=BeetIdType.get_artist_id(album['albumartist']),
-            coverArt=BeetIdType.get_album_id(album['id']),
-            year=album['year'],
-            genre=album['genre'],
-        ) for album in albums]
+        # Only the albums of the page are joined with their songs
+        album_filter = 'SELECT * FROM albums a WHERE {} ORDER BY {} ' \
+                       'LIMIT ? OFFSET ?'.format(' AND '.join(filters),
+                                                 ','.join(orders))
+        albums = self._get_album_id3s(album_filter,
+                                      params + [size, max(offset, 0)], orders)
         return utils.create_album_list2(albums)
 
     def get_random_songs(self, size=10, genre=None, from_year=None,
@@ -335,20 +851,50 @@ class BeetsModel(object):
                 to_year = to_year or ''
                 year_range = [from_year, to_year]
                 query_parts.append('year:{}'.format('..'.join(year_range)))
-            query = decargs(query_parts)
-            result = list(self.lib.items(query))
-            number = min(len(result), size)
-            items = random.sample(result, number)
-            songs = [self._create_song(item) for item in items]
+            query, _ = parse_query_parts(decargs(query_parts), Item)
+            where, params = query.clause()
+            # Only the picked songs are read
+            songs = self.get_songs_from_ids(
+                self._sample_ids('items', [where or '1'], params, size))
 
         return utils.create_songs(songs)
 
     def get_song_location(self, id):
         id = BeetIdType.get_type(id)[1]
-        item = self.lib.get_item(id)
-        if not item:
+        rows = self._query('SELECT path FROM items WHERE id=?', (id,))
+        if not rows:
             raise ValueError('Song with id {} not found'.format(id))
-        return self._resolve_path(item.path)
+        return self._resolve_path(rows[0]['path'])
+
+    def get_song_file(self, id):
+        """
+        Get the file of a song, along with what is needed to transcode it.
+        :param id: The Subsonic id of the song.
+        :return: The SongFile.
+        """
+        item_id = BeetIdType.get_type(id)[1]
+        rows = self._query(
+            'SELECT id, path, format, bitrate, mtime, album_id FROM items '
+            'WHERE id=?', (item_id,))
+        if not rows:
+            raise ValueError('Song with id {} not found'.format(item_id))
+        row = rows[0]
+        return SongFile(row['id'], self._resolve_path(row['path']),
+                        row['format'], row['bitrate'], row['mtime'],
+                        row['album_id'])
+
+    def get_song_album_id(self, id):
+        """
+        Get the album of a song.
+        :param id: The Subsonic id of the song.
+        :return: The beets id of the album, None for singletons.
+        """
+        item_id = BeetIdType.get_type(id)[1]
+        rows = self._query('SELECT album_id FROM items WHERE id=?',
+                           (item_id,))
+        if not rows:
+            raise ValueError('Song with id {} not found'.format(item_id))
+        return rows[0][0]
 
     @staticmethod
     def get_user(username):
@@ -379,9 +925,10 @@ class BeetsModel(object):
         beet_id = BeetIdType.get_type(object_id)
         location = None
         if beet_id[0] is BeetIdType.album:
-            album = self.lib.get_album(beet_id[1])
-            if album:
-                location = album.artpath or None
+            rows = self._query('SELECT artpath FROM albums WHERE id=?',
+                               (beet_id[1],))
+            if rows:
+                location = rows[0]['artpath'] or None
         elif beet_id[0] is BeetIdType.artist:
             columns = ['artpath']
             albums = self._get_albums_from_artist(beet_id[1], columns)
@@ -389,23 +936,46 @@ class BeetsModel(object):
             if len(albums) > 0:
                 location = albums[0]['artpath']
         elif beet_id[0] is BeetIdType.item:
-            item = self.lib.get_item(beet_id[1])
-            if item:
-                album = item.get_album()
-                if album and album.artpath:
-                    location = album.artpath
+            rows = self._query(
+                'SELECT a.artpath FROM items i JOIN albums a '
+                'ON a.id=i.album_id WHERE i.id=?', (beet_id[1],))
+            if rows:
+                location = rows[0]['artpath'] or None
 
         return self._resolve_path(location)
 
-    @staticmethod
-    def get_lyrics(artist, title):
+    def get_cover_art_paths(self):
+        """
+        Get the paths of the cover art of all the albums.
+        :return: Generator of paths, without duplicates.
+        """
+        rows = self._iter_rows(
+            "SELECT DISTINCT artpath FROM albums "
+            "WHERE artpath IS NOT NULL AND artpath != ''"
+        )
+        return (self._resolve_path(row[0]) for row in rows)
+
+    def get_lyrics(self, artist, title, fetcher=None):
+        """
+        Get the lyrics of a song, from the lyrics stored in the library, or
+        else from a fetcher.
+        :param artist: The artist of the song.
+        :param title: The title of the song.
+        :param fetcher: The LyricsFetcher, or None to only read the library.
+        :return: The Lyrics object, empty when there are none.
+        """
         # For now let's return an empty lyrics if either artist or lyrics is
         # not passed in
         empty_lyrics = utils.create_lyrics('', artist=artist, title=title)
         if not artist or not title:
             return empty_lyrics
-        lyrics_plugin = LyricsPlugin()
-        lyrics = lyrics_plugin.get_lyrics(artist, title)
+        rows = self._query(
+            "SELECT lyrics FROM items WHERE title=? COLLATE NOCASE "
+            "AND artist=? COLLATE NOCASE AND lyrics != '' LIMIT 1",
+            (title, artist))
+        lyrics = rows[0]['lyrics'] if rows else None
+        if not lyrics and fetcher is not None:
+            lyrics = fetcher.get(artist, title)
         if not lyrics:
             return empty_lyrics
         return utils.create_lyrics(lyrics, artist=artist, title=title)
@@ -413,9 +983,8 @@ class BeetsModel(object):
     def get_genres(self):
         album_query = 'SELECT genre, count(genre) FROM albums GROUP BY genre'
         item_query = 'SELECT genre, count(genre) FROM items GROUP BY genre'
-        with self.lib.transaction() as tx:
-            distinct_album_genres = tx.query(album_query)
-            distinct_item_genres = tx.query(item_query)
+        distinct_album_genres = self._query(album_query)
+        distinct_item_genres = self._query(item_query)
         album_genre_map = {row[0]: int(row[1]) for row in distinct_album_genres}
         item_genre_map = {row[0]: int(row[1]) for row in distinct_item_genres}
         all_genres = set(album_genre_map.keys()).union(
@@ -429,66 +998,231 @@ class BeetsModel(object):
             for genre in all_genres]
         return utils.create_genres(genre_objs)
 
-    def get_playlists(self, playlist_dir, username):
+    def get_playlists(self, playlist_dir, username, cache=None, watcher=None):
         """
         Get all m3u or m3u8 playlist from a directory, matching them with beets'
         internal DB to ensure that only songs that are present in beets are
-        returned in the Playlists object.
+        counted in the Playlists object.
         :param playlist_dir: The directory to find playlists.
+        :param cache: The PlaylistCache of the song counts and durations, or
+        None to match every playlist with the library.
+        :param watcher: The PlaylistWatcher of the directory, or None to scan
+        it.
         :return: The bound Playlists object.
         """
-        m3us = glob.glob(os.path.join(playlist_dir, '*.m3u*'))
-        playlists = []
-        for m3u in m3us:
-            playlist = self._get_playlist(m3u, username)
-            if playlist:
-                playlists.append(playlist)
-        return utils.create_playlists(playlists)
+        if watcher is not None:
+            m3us = watcher.playlists
+        else:
+            m3us = playlists.scan(playlist_dir)
+        fingerprint = None
+        if cache is not None:
+            fingerprint = self.get_library_fingerprint()
+        summaries = []
+        for m3u in sorted(m3us):
+            summary = self._get_playlist_summary(m3u, m3us[m3u], username,
+                                                 cache, fingerprint)
+            if summary:
+                summaries.append(summary)
+        if cache is not None:
+            cache.prune(m3us)
+        return utils.create_playlists(summaries)
+
+    def _get_playlist_summary(self, location, mtime, username, cache,
+                              fingerprint):
+        try:
+            playlist_filename = os.path.basename(location)
+            if cache is None:
+                item_ids, duration = self._get_playlist_items(location, mtime)
+                summary = len(item_ids), duration
+            else:
+                playlist = self._get_cached_playlist(location, mtime, cache,
+                                                     fingerprint)
+                summary = playlist.song_count, playlist.duration
+            last_modified = datetime.fromtimestamp(mtime)
+            return utils.create_playlist_summary(
+                [username], BeetIdType.get_playlist_id(playlist_filename),
+                os.path.splitext(playlist_filename)[0], summary[0],
+                summary[1], last_modified, last_modified, owner=username)
+        except IOError:
+            return None
+
+    def _get_cached_playlist(self, location, mtime, cache, fingerprint):
+        """
+        Get the songs of a m3u file from a PlaylistCache, matching the file
+        with the library only when it changed, or when the library changed
+        and some of its songs were not found.
+        :param fingerprint: The current fingerprint of the library, see
+        get_library_fingerprint.
+        :return: The CachedPlaylist.
+        """
+        cached = cache.get(location, mtime)
+        if cached is not None and cached.library_fingerprint == fingerprint:
+            return cached
+        if cached is not None and not cached.unmatched:
+            # Only the songs of the playlist may have changed or been removed
+            entries = cached.items
+            lengths = {}
+            for batch in self._batches(sorted(set(
+                    item_id for item_id, _ in entries))):
+                lengths.update(self._query(
+                    'SELECT id, length FROM items WHERE id IN ({})'.format(
+                        ','.join('?' * len(batch))), batch))
+            matches = [(item_id, lengths[item_id], duration)
+                       for item_id, duration in entries if item_id in lengths]
+            unmatched = len(entries) - len(matches)
+        else:
+            matches, unmatched = self._match_paths(utils.parse_m3u(location))
+        item_ids, duration = self._sum_matches(matches)
+        playlist = playlists.CachedPlaylist(
+            fingerprint, [(item_id, entry_duration)
+                          for item_id, _, entry_duration in matches],
+            unmatched, len(item_ids), duration)
+        cache.put(location, mtime, playlist)
+        return playlist
 
-    def _get_playlist(self, location, username):
+    def _get_playlist(self, location, username, mtime=None):
         try:
             playlist_filename = os.path.basename(location)
             playlist_name = os.path.splitext(playlist_filename)[0]
             # For now let's say the created date is the same as the last
             # modified date
-            last_modified = datetime.fromtimestamp(os.path.getmtime(location))
-            songs = utils.parse_m3u(location)
-
-            duration = 0
-            num_songs = len(songs)
-            children = []
-
-            if len(songs) > 0:
-                songs = ['path:"{}"'.format(path) for path in songs]
-                query = ', '.join(songs)
-                items = self.lib.items(query)
-                num_songs = len(items)
-                duration = functools.reduce(
-                    lambda length, item: length + item.length,
-                    items,
-                    0
-                )
-                children = [self._create_song(item) for item in items]
+            if mtime is None:
+                mtime = os.path.getmtime(location)
+            last_modified = datetime.fromtimestamp(mtime)
+            item_ids, duration = self._get_playlist_items(location, mtime)
+            # The songs are only read while the response is written
             return utils.create_playlist(
-                children, [username],
+                self._iter_songs_from_ids(item_ids), [username],
                 BeetIdType.get_playlist_id(playlist_filename),
-                playlist_name, num_songs, duration, last_modified,
+                playlist_name, len(item_ids), duration, last_modified,
                 last_modified, owner=username)
         except IOError:
             return None
 
-    def get_playlist(self, playlist_id, playlist_dir, username):
+    def _get_playlist_items(self, location, mtime):
+        """
+        Get the songs of a m3u file which are in the library, cached until
+        the file or the library changes.
+        :param location: The path of the m3u file.
+        :param mtime: The modification time of the file.
+        :return: A (item_ids, duration) tuple, item_ids being the list of
+        the beets ids of the songs in the order of the file, duplicates
+        included, and duration their total length.
+        """
+        key = (mtime, self.get_library_state().generation)
+        with self._playlists_lock:
+            cached = self._playlists.get(location)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        items = self._resolve_paths(utils.parse_m3u(location))
+        with self._playlists_lock:
+            self._playlists[location] = (key, items)
+        return items
+
+    def forget_playlist(self, location):
+        """
+        Drop the cached songs of a m3u file, e.g. once it changed, see
+        PlaylistWatcher.
+        :param location: The path of the m3u file.
+        """
+        with self._playlists_lock:
+            self._playlists.pop(location, None)
+
+    def _resolve_paths(self, entries):
+        """
+        Match the entries of a playlist with the items of the library.
+        :param entries: Iterable of M3uEntry objects, see utils.parse_m3u.
+        :return: A (item_ids, duration) tuple, see _get_playlist_items.
+        """
+        return self._sum_matches(self._match_paths(entries)[0])
+
+    @staticmethod
+    def _sum_matches(matches):
+        """
+        Sum the songs of a playlist matched with the library.
+        :param matches: List of matches, see _match_paths.
+        :return: A (item_ids, duration) tuple, see _get_playlist_items. The
+        songs without a length in the library count for the duration of
+        their #EXTINF line.
+        """
+        return ([item_id for item_id, _, _ in matches],
+                sum(length or duration for _, length, duration in matches))
+
+    def _match_paths(self, entries):
+        """
+        Match the entries of a playlist with the items of the library, by
+        batches of PLAYLIST_BATCH_SIZE paths.
+        :param entries: Iterable of M3uEntry objects, see utils.parse_m3u.
+        :return: A (matches, unmatched) tuple, matches being the list of the
+        (item_id, length, duration) tuples of the entries found, in order,
+        length being the one in the library and duration the one of the
+        #EXTINF line, and unmatched the number of the other entries.
+        """
+        case_sensitive = util.case_sensitive(util.bytestring_path(
+            self.basedir))
+        keys = []
+        durations = []
+        for entry in entries:
+            key = util.bytestring_path(util.normpath(entry.path))
+            keys.append(key if case_sensitive else key.lower())
+            durations.append(entry.duration or 0)
+        column = 'path' if case_sensitive else 'BYTELOWER(path)'
+
+        found = {}
+        unique_keys = sorted(set(keys))
+        for start in range(0, len(unique_keys), PLAYLIST_BATCH_SIZE):
+            batch = unique_keys[start:start + PLAYLIST_BATCH_SIZE]
+            rows = self._query(
+                'SELECT id, {0}, length FROM items WHERE {0} IN ({1})'.format(
+                    column, ','.join('?' * len(batch))),
+                [BLOB_TYPE(key) for key in batch])
+            for row in rows:
+                found[bytes(row[1])] = (row[0], row[2] or 0)
+
+        matches = [found[key] + (duration,)
+                   for key, duration in zip(keys, durations) if key in found]
+        return matches, len(keys) - len(matches)
+
+    def _iter_songs_from_ids(self, item_ids):
+        """
+        Stream Child objects of songs given by their ids, by batches of
+        PLAYLIST_BATCH_SIZE ids.
+        :param item_ids: List of beets item ids, possibly repeated.
+        :return: Generator of Child objects, in the order of item_ids.
+        """
+        for start in range(0, len(item_ids), PLAYLIST_BATCH_SIZE):
+            batch = item_ids[start:start + PLAYLIST_BATCH_SIZE]
+            unique_ids = sorted(set(batch))
+            rows = self._query(
+                'SELECT {} FROM items WHERE id IN ({})'.format(
+                    ', '.join(SONG_COLUMNS), ','.join('?' * len(unique_ids))),
+                unique_ids)
+            songs = dict((row['id'], self._create_song(row)) for row in rows)
+            for item_id in batch:
+                if item_id in songs:
+                    yield songs[item_id]
+
+    def get_playlist(self, playlist_id, playlist_dir, username, watcher=None):
         """
         Get a playlist from a directory, matching the items in it with beets'
         internal DB to ensure that only songs that are present in beets are
         returned.
         :param playlist_id: The playlist id.
         :param playlist_dir: The playlist directory.
+        :param watcher: The PlaylistWatcher of the directory, or None to read
+        the modification time of the playlist from the disk.
         :return: The bound Playlist object.
+        :raise OSError: When the playlist is not in the watched directory,
+        like os.path.getmtime for a missing file.
         """
         playlist_filename = BeetIdType.get_type(playlist_id)[1]
         location = os.path.join(playlist_dir, playlist_filename)
-        return self._get_playlist(location, username)
+        if watcher is None:
+            return self._get_playlist(location, username)
+        mtime = watcher.playlists.get(location)
+        if mtime is None:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), location)
+        return self._get_playlist(location, username, mtime)
 
     def get_album(self, album_id):
         """
@@ -499,23 +1233,26 @@ class BeetsModel(object):
         beet_id = BeetIdType.get_type(album_id)
         if beet_id[0] is not BeetIdType.album:
             raise ValueError('Wrong Album Id: {}'.format(album_id))
-        with self.lib.transaction() as tx:
-            album = self.lib.get_album(beet_id[1])
-            items = album.items()
+        query = 'SELECT {} FROM {} WHERE a.id=? GROUP BY a.id'.format(
+            ','.join(ALBUM_ID3_COLUMNS.values()), ALBUM_ID3_TABLES)
+        rows = self._query(query, (beet_id[1],))
+        if len(rows) == 0:
+            raise EntityNotFoundError('Album {} not found'.format(beet_id[1]))
+        album = dict(zip(ALBUM_ID3_COLUMNS.keys(), rows[0]))
 
-        children = [self._create_song(item) for item in items]
+        children = self._get_songs('album_id=?', (beet_id[1],))
         return utils.create_album_with_songs_id3(
-            id=BeetIdType.get_album_id(album.id),
-            name=album.album,
-            song_count=len(items),
-            duration=sum(item.length for item in items),
-            created=datetime.fromtimestamp(album.added),
+            id=BeetIdType.get_album_id(album['id']),
+            name=album['album'],
+            song_count=album['song_count'],
+            duration=album['duration'],
+            created=datetime.fromtimestamp(album['added']),
             children=children,
-            artist=album.albumartist,
-            artistId=BeetIdType.get_artist_id(album.albumartist),
-            coverArt=BeetIdType.get_album_id(album.id),
-            year=album.year,
-            genre=album.genre,
+            artist=album['albumartist'],
+            artistId=BeetIdType.get_artist_id(album['albumartist']),
+            coverArt=BeetIdType.get_album_id(album['id']),
+            year=album['year'],
+            genre=album['genre'],
         )
 
     def get_song(self, item_id):
@@ -527,8 +1264,10 @@ class BeetsModel(object):
         beet_id = BeetIdType.get_type(item_id)
         if beet_id[0] is not BeetIdType.item:
             raise ValueError('Wrong Item Id: {}'.format(item_id))
-        item = self.lib.get_item(beet_id[1])
-        return self._create_song(item)
+        songs = self._get_songs('id=?', (beet_id[1],), 'id')
+        if not songs:
+            raise EntityNotFoundError('Song {} not found'.format(beet_id[1]))
+        return songs[0]
 
     def get_artist_with_albums(self, artist_id):
         """
@@ -539,26 +1278,16 @@ class BeetsModel(object):
         beet_id = BeetIdType.get_type(artist_id)
         if beet_id[0] is not BeetIdType.artist:
             raise ValueError('Wrong Artist Id: {}'.format(artist_id))
-        albums = self.lib.albums('albumartist:{}'.format(beet_id[1]))
-        if len(albums) == 0:
+        query = 'SELECT {} FROM {} WHERE a.albumartist=? GROUP BY a.id ' \
+                'ORDER BY a.album COLLATE NOCASE, a.year'.format(
+                    ','.join(ALBUM_ID3_COLUMNS.values()), ALBUM_ID3_TABLES)
+        rows = self._query(query, (beet_id[1],))
+        if len(rows) == 0:
             raise EntityNotFoundError('Artist {} not found'.format(beet_id[1]))
-        album_id3s = []
-        for album in albums:
-            items = album.items()
-            album_id3s.append(
-                utils.create_album_id3(
-                    id=BeetIdType.get_album_id(album.id),
-                    name=album.album,
-                    song_count=len(items),
-                    duration=sum(item.length for item in items),
-                    created=datetime.fromtimestamp(album.added),
-                    artist=album.albumartist,
-                    artistId=BeetIdType.get_artist_id(album.albumartist),
-                    coverArt=BeetIdType.get_album_id(album.id),
-                    year=album.year,
-                    genre=album.genre,
-                )
-            )
+        album_id3s = [
+            self._create_album_id3(dict(zip(ALBUM_ID3_COLUMNS.keys(), row)))
+            for row in rows
+        ]
         return utils.create_artist_with_albums_id3(
             id=artist_id,
             name=beet_id[1],
@@ -571,8 +1300,7 @@ class BeetsModel(object):
         beet_id = BeetIdType.get_type(artist_id)
         if beet_id[0] is not BeetIdType.artist:
             raise ValueError('Wrong Artist Id: {}'.format(artist_id))
-        with self.lib.transaction() as tx:
-            rows = tx.query('SELECT DISTINCT mb_albumartistid FROM albums WHERE albumartist=?', (beet_id[1],))
+        rows = self._query('SELECT DISTINCT mb_albumartistid FROM albums WHERE albumartist=?', (beet_id[1],))
         if len(rows) < 1:
             raise EntityNotFoundError('Artist {} not found'.format(beet_id[1]))
         return rows[0][0]
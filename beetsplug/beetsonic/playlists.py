@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+The m3u playlists of the playlist directory.
+
+Listing the playlists only needs their song counts and durations, but
+getting them means matching every song of every m3u file with the library.
+They are kept in a SQLite database of the plugin, along with the
+modification time of the m3u file, the ids of the songs matched and a
+fingerprint of the library, see BeetsModel.get_library_fingerprint. The
+m3u files are only matched again when they change, or when the library
+changes and some of their songs were not found. Otherwise the song counts
+and durations are summed again from the ids, without reading the m3u files.
+Songs moved by beets are only noticed once their m3u files are updated,
+e.g. by beets' playlist plugin.
+
+The m3u files themselves are tracked by a PlaylistWatcher, with inotify when
+the inotify_simple package is installed, and else by scanning the directory
+every second, so that requests do not list and stat the directory.
+"""
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import collections
+import glob
+import json
+import os
+import threading
+
+from beets import logging
+
+from beetsplug.beetsonic import caches
+
+# Version of SCHEMA, see caches.Database.
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS playlists (
+    location TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    library_fingerprint TEXT NOT NULL,
+    items TEXT NOT NULL,
+    unmatched INTEGER NOT NULL,
+    song_count INTEGER NOT NULL,
+    duration REAL NOT NULL
+);
+'''
+
+# A playlist of a PlaylistCache. items is the list of the (item_id,
+# duration) tuples of the songs matched, in the order of the file, duration
+# being the one of their #EXTINF line, and unmatched the number of songs not
+# found in the library.
+CachedPlaylist = collections.namedtuple(
+    'CachedPlaylist', ['library_fingerprint', 'items', 'unmatched',
+                       'song_count', 'duration'])
+
+log = logging.getLogger('beets.beetsonic')
+
+# Number of seconds between the scans of a PlaylistWatcher without inotify,
+# and the longest a PlaylistWatcher takes to stop.
+POLL_INTERVAL = 1
+
+
+def scan(directory):
+    """
+    List the m3u and m3u8 files of a directory.
+    :param directory: The playlist directory.
+    :return: Dict of the modification times of the files, per path.
+    """
+    m3us = {}
+    for location in glob.glob(os.path.join(directory, '*.m3u*')):
+        try:
+            m3us[location] = os.path.getmtime(location)
+        except OSError:
+            # Removed since listed
+            pass
+    return m3us
+
+
+class PlaylistCache(caches.Database):
+    """
+    The database of the song counts and durations of the playlists.
+    """
+
+    SCHEMA = SCHEMA
+    SCHEMA_VERSION = SCHEMA_VERSION
+    TABLES = ['playlists']
+
+    def get(self, location, mtime):
+        """
+        Get a playlist.
+        :param location: The path of the m3u file.
+        :param mtime: The current modification time of the m3u file.
+        :return: The CachedPlaylist, or None when the playlist is not cached
+        or has changed.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT library_fingerprint, items, unmatched, song_count, '
+                'duration FROM playlists WHERE location=? AND mtime=?',
+                (location, mtime)).fetchone()
+        if row is None:
+            return None
+        return CachedPlaylist(row[0], [tuple(item)
+                                       for item in json.loads(row[1])],
+                              *row[2:])
+
+    def put(self, location, mtime, playlist):
+        """
+        Store a playlist, see get.
+        :param playlist: The CachedPlaylist.
+        """
+        with self._lock, self._connection as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO playlists (location, mtime, '
+                'library_fingerprint, items, unmatched, song_count, '
+                'duration) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (location, mtime, playlist.library_fingerprint,
+                 json.dumps(playlist.items), playlist.unmatched,
+                 playlist.song_count, playlist.duration))
+
+    def prune(self, locations):
+        """
+        Forget the playlists which are not in a list, e.g. deleted files.
+        :param locations: Iterable of the paths of the m3u files to keep.
+        """
+        locations = set(locations)
+        with self._lock, self._connection as connection:
+            stale = [row[0] for row in connection.execute(
+                'SELECT location FROM playlists')
+                if row[0] not in locations]
+            connection.executemany('DELETE FROM playlists WHERE location=?',
+                                   ((location,) for location in stale))
+
+
+class PlaylistWatcher(object):
+    """
+    The m3u files of a directory, kept up to date by a background thread.
+    """
+
+    def __init__(self, directory, on_change=None, interval=POLL_INTERVAL,
+                 use_inotify=True):
+        """
+        :param directory: The playlist directory.
+        :param on_change: Function called with the path of every m3u file
+        changed, added or removed, e.g. to invalidate its caches.
+        :param interval: The number of seconds between scans, without
+        inotify.
+        :param use_inotify: Whether to use inotify, when available.
+        """
+        self.directory = directory
+        self.on_change = on_change
+        self.interval = interval
+        self._m3us = scan(directory)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        inotify = self._create_inotify() if use_inotify else None
+        self.backend = u'polling' if inotify is None else u'inotify'
+        self._thread = threading.Thread(target=self._run, args=(inotify,),
+                                        name='beetsonic-playlists')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def playlists(self):
+        """
+        Dict of the modification times of the m3u files, per path, see scan.
+        """
+        with self._lock:
+            return dict(self._m3us)
+
+    def refresh(self):
+        """
+        Scan the directory again, calling on_change for every difference.
+        """
+        m3us = scan(self.directory)
+        with self._lock:
+            changed = [location
+                       for location in set(m3us) | set(self._m3us)
+                       if m3us.get(location) != self._m3us.get(location)]
+            self._m3us = m3us
+        if self.on_change is not None:
+            for location in changed:
+                self.on_change(location)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _create_inotify(self):
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            return None
+        try:
+            inotify = INotify()
+            inotify.add_watch(self.directory, flags.CLOSE_WRITE |
+                              flags.MOVED_TO | flags.MOVED_FROM |
+                              flags.CREATE | flags.DELETE | flags.ATTRIB)
+        except OSError as e:
+            log.warning(u'beetsonic: cannot watch {} with inotify: {}',
+                        self.directory, e)
+            return None
+        return inotify
+
+    def _run(self, inotify):
+        try:
+            while not self._stopped.is_set():
+                if inotify is None:
+                    if self._stopped.wait(self.interval):
+                        break
+                elif not inotify.read(timeout=int(self.interval * 1000)):
+                    continue
+                try:
+                    self.refresh()
+                except Exception as e:
+                    log.error(u'beetsonic: cannot scan {}: {}',
+                              self.directory, e)
+        finally:
+            if inotify is not None:
+                inotify.close()
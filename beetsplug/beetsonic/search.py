@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search of the library for search2.view and search3.view.
+
+The titles, albums and artists are indexed with SQLite's FTS5 in a database
+of the plugin, next to the play statistics. The index is built once, then
+kept up to date from the songs and albums marked as changed by the beets
+events the plugin listens to, in whatever process they happen. It is built
+again when INDEX_VERSION changes. Only one process of the server, e.g. one
+of the gunicorn workers, builds and updates it, see keep_updated; the library
+is searched by like_search until it is built.
+
+SQLite builds without FTS5 cannot create the index, the library is then
+searched with LIKE patterns by like_search.
+"""
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import errno
+import re
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks, e.g. on Windows, every process updates the index
+    fcntl = None
+
+from beets import logging
+
+from beetsplug.beetsonic import caches
+
+# Version of the index, to be increased when the schema or the indexed
+# content changes, so that existing indexes are built again.
+INDEX_VERSION = 2
+
+SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5 (
+    title, album, artist, albumartist, tokenize='unicode61 remove_diacritics 1'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS albums_fts USING fts5 (
+    album, albumartist, tokenize='unicode61 remove_diacritics 1'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS artists_fts USING fts5 (
+    name, tokenize='unicode61 remove_diacritics 1'
+);
+CREATE TABLE IF NOT EXISTS dirty_items (item_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS dirty_albums (album_id INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS marks (name TEXT PRIMARY KEY, value NUMERIC);
+'''
+
+# Tables of the index, dropped when it is built again.
+TABLES = ['songs_fts', 'albums_fts', 'artists_fts', 'dirty_items',
+          'dirty_albums', 'marks']
+
+log = logging.getLogger('beets.beetsonic')
+
+# Number of seconds between the updates of the index by keep_updated.
+UPDATE_INTERVAL = 60
+
+# Number of songs or albums read from the library and written to the index at
+# once. The artists of twice as many albums are looked up at once, which
+# must stay below SQLite's limit of 999 query parameters.
+UPDATE_BATCH_SIZE = 400
+
+# The FTS tables, along with the column of the results, searched by
+# SearchIndex.search.
+SEARCH_TABLES = {
+    'artist': ('artists_fts', 'name'),
+    'album': ('albums_fts', 'rowid'),
+    'song': ('songs_fts', 'rowid'),
+}
+
+# The tables of the library searched by like_search, along with the column
+# of the results and the columns matched.
+LIKE_TABLES = {
+    'artist': ('albums', 'albumartist', ['albumartist']),
+    'album': ('albums', 'id', ['album', 'albumartist']),
+    'song': ('items', 'id', ['title', 'album', 'artist', 'albumartist']),
+}
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def match_expression(query):
+    """
+    Turn a search query into an FTS5 expression matching all of its words,
+    as prefixes, e.g. "beatl abb" matches "Abbey Road" by "The Beatles".
+    :param query: The query of the client.
+    :return: The expression, or None when the query has no words, which
+    matches everything.
+    """
+    terms = _TERM_RE.findall(query or u'')
+    if not terms:
+        return None
+    return u' '.join(u'"{}"*'.format(term) for term in terms)
+
+
+def like_search(query, kind, text, count, offset=0):
+    """
+    Search the library without an index, for SQLite builds without FTS5.
+    Every word of the text has to be in one of the columns, ignoring the case
+    of ASCII letters only, and the results are not ranked.
+    :param query: Function running a read query on the library, see
+    SearchIndex.update.
+    :param kind: artist, album or song.
+    :param text: The query of the client, see match_expression.
+    :param count: The maximum number of results.
+    :param offset: The number of results to skip.
+    :return: The list of the names of the matching artists, or of the
+    beets ids of the matching albums or songs, see SearchIndex.search.
+    """
+    table, column, columns = LIKE_TABLES[kind]
+    filters = ['1=1']
+    params = []
+    for term in _TERM_RE.findall(text or u''):
+        filters.append('({})'.format(' OR '.join(
+            "{} LIKE ? ESCAPE '\\'".format(name) for name in columns)))
+        # Words may hold underscores, which LIKE matches as any character
+        params.extend([u'%{}%'.format(term.replace(u'_', u'\\_'))] *
+                      len(columns))
+    rows = query(
+        'SELECT DISTINCT {0} FROM {1} WHERE {2} ORDER BY {0} '
+        'LIMIT ? OFFSET ?'.format(column, table, ' AND '.join(filters)),
+        params + [count, offset])
+    return [row[0] for row in rows]
+
+
+def lock_file(path):
+    """
+    Take an exclusive lock of a file, held until the file is closed or the
+    process exits.
+    :param path: The path of the file, created if needed.
+    :return: The open file, or None when another process holds the lock.
+    """
+    f = open(path, 'a')
+    if fcntl is None:
+        return f
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        f.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return f
+
+
+def keep_updated(index, update, interval=UPDATE_INTERVAL):
+    """
+    Start a thread updating a search index at once, then periodically.
+    Processes sharing the index take turns through a lock file next to it:
+    only the process holding the lock updates the index, the others try to
+    take it over at every interval, e.g. when its gunicorn worker exits.
+    :param index: The SearchIndex.
+    :param update: Function updating the index, given as its argument, e.g.
+    BeetsModel.update_search_index.
+    :param interval: The number of seconds between the updates.
+    :return: The thread.
+    """
+    lock_path = None
+    if index.path != ':memory:':
+        lock_path = index.path + '.lock'
+
+    def run():
+        lock = None
+        while True:
+            try:
+                if lock is None and lock_path is not None:
+                    lock = lock_file(lock_path)
+                if lock is not None or lock_path is None:
+                    update(index)
+            except Exception as e:
+                log.error(u'beetsonic: cannot update the search index: {}', e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='beetsonic-search')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class SearchIndex(caches.Database):
+    """
+    The full-text index of the library. Its user_version is the
+    INDEX_VERSION it was last built by, see outdated.
+    """
+
+    SCHEMA = SCHEMA
+    TABLES = TABLES
+
+    def __init__(self, path):
+        """
+        :param path: The path of the database, created if needed, or
+        ':memory:'.
+        :raise sqlite3.Error: When the index cannot be created, e.g. when
+        SQLite has no FTS5.
+        """
+        super(SearchIndex, self).__init__(path)
+        self.state = None
+
+    def _create_schema(self, connection):
+        # Indexes of another version are built again by update
+        connection.executescript(self.SCHEMA)
+
+    @property
+    def outdated(self):
+        """
+        Whether the index was never built, or built by another INDEX_VERSION.
+        """
+        with self._lock:
+            version = self._connection.execute(
+                'PRAGMA user_version').fetchone()[0]
+        return version != INDEX_VERSION
+
+    def mark_dirty(self, item_ids=(), album_ids=()):
+        """
+        Mark songs and albums to be indexed again by the next update, e.g.
+        from the beets events of another process.
+        :param item_ids: Iterable of beets item ids, of changed, added or
+        removed songs.
+        :param album_ids: Iterable of beets album ids.
+        """
+        with self._lock, self._connection as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO dirty_items (item_id) VALUES (?)',
+                ((item_id,) for item_id in item_ids))
+            connection.executemany(
+                'INSERT OR IGNORE INTO dirty_albums (album_id) VALUES (?)',
+                ((album_id,) for album_id in album_ids))
+
+    def update(self, query, state=None):
+        """
+        Bring the index up to date with the library, indexing the songs and
+        albums marked dirty, or the whole library when the index is outdated.
+        The changes of processes without the plugin, or whose marks were
+        lost, are found from the library itself, see _reconcile.
+        :param query: Function running a read query on the library, given
+        the SQL and its parameters, and returning the rows, e.g. through the
+        read connections of BeetsModel.update_search_index.
+        :param state: The state of the library, see
+        BeetsModel.get_library_state. Nothing is done while the state stays
+        the same and nothing is marked dirty: other processes mark their
+        changes after committing them, possibly once this state was seen.
+        """
+        outdated = self.outdated
+        with self._lock:
+            if state is not None and state == self.state and \
+                    not self._has_dirty():
+                return
+            if outdated:
+                self._rebuild(query)
+            else:
+                self._apply_changes(query)
+            self.state = state
+
+    def _has_dirty(self):
+        return self._connection.execute(
+            'SELECT EXISTS (SELECT 1 FROM dirty_items) OR '
+            'EXISTS (SELECT 1 FROM dirty_albums)').fetchone()[0]
+
+    def _rebuild(self, query):
+        marks = self._read_marks(query)
+        item_ids = [row[0] for row in query('SELECT id FROM items')]
+        album_ids = [row[0] for row in query('SELECT id FROM albums')]
+        with self._connection as connection:
+            self._drop_tables(connection)
+            connection.executescript(self.SCHEMA)
+        with self._connection as connection:
+            self._index(query, connection, item_ids, album_ids)
+            self._write_marks(connection, marks)
+            connection.execute('PRAGMA user_version={}'.format(INDEX_VERSION))
+
+    def _apply_changes(self, query):
+        connection = self._connection
+        marks = self._read_marks(query)
+        item_ids = set(row[0] for row in connection.execute(
+            'SELECT item_id FROM dirty_items'))
+        album_ids = set(row[0] for row in connection.execute(
+            'SELECT album_id FROM dirty_albums'))
+        self._find_changes(query, item_ids, album_ids)
+        with connection:
+            self._index(query, connection, sorted(item_ids),
+                        sorted(album_ids))
+            self._reconcile(query, connection)
+            self._write_marks(connection, marks)
+
+    @staticmethod
+    def _read_marks(query):
+        """
+        Read the marks of the library, which the songs and albums added or
+        written since they were last read are above, see _find_changes.
+        """
+        marks = {}
+        for table, columns in [('items', ['id', 'added', 'mtime']),
+                               ('albums', ['id', 'added'])]:
+            row = query('SELECT {} FROM {}'.format(', '.join(
+                'ifnull(max({}), 0)'.format(column) for column in columns),
+                table))[0]
+            for column, value in zip(columns, row):
+                marks['{}.{}'.format(table, column)] = value
+        return marks
+
+    def _write_marks(self, connection, marks):
+        connection.executemany(
+            'INSERT OR REPLACE INTO marks (name, value) VALUES (?, ?)',
+            sorted(marks.items()))
+
+    def _find_changes(self, query, item_ids, album_ids):
+        """
+        Add the songs and albums added or written to their files since the
+        last update to the ids to index. The dates they were added at tell
+        the new ones apart when beets reuses the ids of removed ones. Tags
+        edited without writing the files, or removals, do not show in the
+        library, see _reconcile.
+        """
+        marks = dict(self._connection.execute('SELECT name, value FROM marks'))
+        for item_id, album_id in query(
+                'SELECT id, album_id FROM items '
+                'WHERE id > ? OR added > ? OR mtime > ?',
+                [marks.get('items.' + column, 0)
+                 for column in ['id', 'added', 'mtime']]):
+            item_ids.add(item_id)
+            if album_id is not None:
+                album_ids.add(album_id)
+        album_ids.update(row[0] for row in query(
+            'SELECT id FROM albums WHERE id > ? OR added > ?',
+            [marks.get('albums.' + column, 0) for column in ['id', 'added']]))
+
+    def _reconcile(self, query, connection):
+        """
+        Index the songs and albums whose ids differ between the index and the
+        library, e.g. those removed, when their numbers differ.
+        """
+        for table, library_table, index in [
+                ('songs_fts', 'items', self._index_songs),
+                ('albums_fts', 'albums', self._index_albums)]:
+            count = query('SELECT count(*) FROM {}'.format(library_table))
+            if connection.execute('SELECT count(*) FROM {}'.format(
+                    table)).fetchone()[0] == count[0][0]:
+                continue
+            ids = set(row[0] for row in connection.execute(
+                'SELECT rowid FROM {}'.format(table)))
+            ids.symmetric_difference_update(row[0] for row in query(
+                'SELECT id FROM {}'.format(library_table)))
+            ids = sorted(ids)
+            for start in range(0, len(ids), UPDATE_BATCH_SIZE):
+                index(query, connection, ids[start:start + UPDATE_BATCH_SIZE])
+
+    def _index(self, query, connection, item_ids, album_ids):
+        for start in range(0, len(item_ids), UPDATE_BATCH_SIZE):
+            self._index_songs(query, connection,
+                              item_ids[start:start + UPDATE_BATCH_SIZE])
+        for start in range(0, len(album_ids), UPDATE_BATCH_SIZE):
+            self._index_albums(query, connection,
+                               album_ids[start:start + UPDATE_BATCH_SIZE])
+
+    @staticmethod
+    def _index_songs(query, connection, item_ids):
+        """
+        Index songs again, removing those which are not in the library.
+        """
+        placeholders = ','.join('?' * len(item_ids))
+        rows = query(
+            'SELECT id, title, album, artist, albumartist '
+            'FROM items WHERE id IN ({})'.format(placeholders), item_ids)
+        for table, column in [('songs_fts', 'rowid'),
+                              ('dirty_items', 'item_id')]:
+            connection.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                table, column, placeholders), item_ids)
+        connection.executemany(
+            'INSERT INTO songs_fts (rowid, title, album, artist, '
+            'albumartist) VALUES (?, ?, ?, ?, ?)', (tuple(row) for row in rows))
+
+    @staticmethod
+    def _index_albums(query, connection, album_ids):
+        """
+        Index albums and their artists again, removing those which are not
+        in the library.
+        """
+        placeholders = ','.join('?' * len(album_ids))
+        rows = query(
+            'SELECT id, album, albumartist FROM albums '
+            'WHERE id IN ({})'.format(placeholders), album_ids)
+        # The artists of the albums before and after the changes
+        artists = set(row[0] for row in connection.execute(
+            'SELECT albumartist FROM albums_fts WHERE rowid IN ({})'.format(
+                placeholders), album_ids))
+        artists.update(row[2] for row in rows)
+        for table, column in [('albums_fts', 'rowid'),
+                              ('dirty_albums', 'album_id')]:
+            connection.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+                table, column, placeholders), album_ids)
+        connection.executemany(
+            'INSERT INTO albums_fts (rowid, album, albumartist) '
+            'VALUES (?, ?, ?)', (tuple(row) for row in rows))
+        if not artists:
+            return
+
+        artists = sorted(artists)
+        placeholders = ','.join('?' * len(artists))
+        remaining = set(row[0] for row in query(
+            'SELECT DISTINCT albumartist FROM albums '
+            'WHERE albumartist IN ({})'.format(placeholders), artists))
+        connection.execute(
+            'DELETE FROM artists_fts WHERE name IN ({})'.format(placeholders),
+            artists)
+        connection.executemany(
+            'INSERT INTO artists_fts (name) VALUES (?)',
+            ((name,) for name in artists if name in remaining))
+
+    def search(self, kind, query, count, offset=0):
+        """
+        Search the index.
+        :param kind: artist, album or song.
+        :param query: The query of the client, see match_expression. Queries
+        without words page through everything.
+        :param count: The maximum number of results.
+        :param offset: The number of results to skip.
+        :return: The list of the names of the matching artists, or of the
+        beets ids of the matching albums or songs, the best matches first.
+        """
+        table, column = SEARCH_TABLES[kind]
+        expression = match_expression(query)
+        if expression is None:
+            sql = 'SELECT {} FROM {} ORDER BY rowid LIMIT ? OFFSET ?'.format(
+                column, table)
+            params = (count, offset)
+        else:
+            sql = 'SELECT {0} FROM {1} WHERE {1} MATCH ? ORDER BY rank ' \
+                  'LIMIT ? OFFSET ?'.format(column, table)
+            params = (expression, count, offset)
+        with self._lock:
+            rows = self._connection.execute(sql, params).fetchall()
+        return [row[0] for row in rows]
@@ -0,0 +1,574 @@
+"""
+Lightweight serialization of Subsonic responses.
+
+Responses are built from slotted records mirroring the PyXB binding classes,
+and written straight to XML or to JSON-serializable objects, producing the
+same output PyXB would, without instantiating the PyXB object tree. The
+binding classes are only used as a schema, compiled once per class.
+"""
+
+import collections
+import functools
+import json
+import sys
+import time
+
+import pyxb
+import six
+from pyxb.binding import datatypes
+
+from beetsplug.beetsonic import bindings
+
+ROOT_ELEMENT = bindings.subsonic_response.name().localName()
+NAMESPACE = bindings.Namespace.uri()
+
+XML_DECLARATION = u'<?xml version="1.0" encoding="utf-8"?>'
+
+# Size of the blocks streamed responses are sent in.
+STREAM_BUFFER_SIZE = 64 * 1024
+
+# Types that have to be bound to a global element to be converted to PyXB.
+_GLOBAL_ELEMENTS = {
+    bindings.Response: bindings.subsonic_response,
+}
+
+STRING = 'string'
+INT = 'int'
+FLOAT = 'float'
+BOOLEAN = 'boolean'
+DATETIME = 'datetime'
+
+# xml.dom.minidom, which PyXB writes XML with, sorts the attributes of the
+# elements by name before Python 3.8, and keeps their order after.
+_SORTED_ATTRIBUTES = sys.version_info < (3, 8)
+
+
+def _kind(datatype):
+    """
+    Return the serialization kind of a PyXB simple datatype.
+    :param datatype: The PyXB simple type definition class.
+    :return: One of STRING, INT, FLOAT, BOOLEAN or DATETIME.
+    """
+    if issubclass(datatype, datatypes.boolean):
+        return BOOLEAN
+    if issubclass(datatype, datatypes.dateTime):
+        return DATETIME
+    if issubclass(datatype, six.integer_types):
+        return INT
+    if issubclass(datatype, float):
+        return FLOAT
+    return STRING
+
+
+def _location_key(location):
+    if location is None:
+        return (float('inf'), float('inf'))
+    return (location.lineNumber, location.columnNumber)
+
+
+def _content_order(binding):
+    """
+    Return the element declarations of a binding class in the order of its
+    content model, i.e. the order of their uses in the XSD, which is the
+    order PyXB writes them in. _ElementMap is a dict, unordered on Python 2.
+    :param binding: The PyXB binding class.
+    :return: List of the (name, declaration) pairs.
+    """
+    locations = {}
+    automaton = getattr(binding, '_Automaton', None)
+    if automaton is not None:
+        for state in automaton.states:
+            use = state.symbol
+            if isinstance(use, pyxb.binding.content.ElementUse):
+                key = use.elementDeclaration().name()
+                location = _location_key(use.xsdLocation())
+                locations[key] = min(location, locations.get(key, location))
+    return sorted(binding._ElementMap.items(),
+                  key=lambda pair: locations.get(pair[0],
+                                                 _location_key(None)))
+
+
+def _attribute_order(binding):
+    """
+    Return the attribute uses of a binding class in the order PyXB writes
+    them in, see _SORTED_ATTRIBUTES.
+    :param binding: The PyXB binding class.
+    :return: List of the (name, use) pairs.
+    """
+    if _SORTED_ATTRIBUTES:
+        return sorted(binding._AttributeMap.items(),
+                      key=lambda pair: pair[0].localName())
+    return sorted(binding._AttributeMap.items(),
+                  key=lambda pair: _location_key(pair[1]._UseLocation))
+
+
+def _escape(text):
+    """Escape text the same way xml.dom.minidom does."""
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;'). \
+        replace(u'"', u'&quot;').replace(u'>', u'&gt;')
+
+
+def _datetime_literal(value):
+    """Format a datetime the way PyXB does, i.e. timezoned values in UTC."""
+    timezone = u''
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+        timezone = u'Z'
+    iso = value.isoformat()
+    if u'.' in iso:
+        iso = iso.rstrip(u'0')
+    return iso + timezone
+
+
+def _float_literal(value):
+    value = float(value)
+    if value != value:
+        return u'NaN'
+    if value in (float('inf'), float('-inf')):
+        return u'INF' if value > 0 else u'-INF'
+    return u'%s' % (value,)
+
+
+_XML_LITERALS = {
+    STRING: six.text_type,
+    INT: lambda value: six.text_type(int(value)),
+    FLOAT: _float_literal,
+    BOOLEAN: lambda value: u'true' if value else u'false',
+    DATETIME: _datetime_literal,
+}
+
+_JSON_VALUES = {
+    STRING: six.text_type,
+    INT: int,
+    FLOAT: float,
+    BOOLEAN: bool,
+    DATETIME: lambda value: int(time.mktime(value.timetuple())),
+}
+
+
+class Schema(object):
+    """
+    The serialization layout of a binding class: its attributes and their
+    kinds, its child elements in content order and whether it has mixed
+    content, along with the value converters for each attribute and element,
+    so that serializing an instance needs no reflection on the binding.
+    """
+    __slots__ = ('binding', 'attributes', 'elements', 'mixed',
+                 'xml_attributes', 'xml_elements', 'json_attributes',
+                 'json_elements', '_appendable')
+
+    def __init__(self, binding):
+        self.binding = binding
+        self.attributes = tuple(
+            (name.localName(), _kind(use.dataType()))
+            for name, use in _attribute_order(binding)
+        )
+        elements = []
+        for name, declaration in _content_order(binding):
+            type_definition = declaration.elementBinding().typeDefinition()
+            if issubclass(type_definition,
+                          pyxb.binding.basis.complexTypeDefinition):
+                kind = None
+            else:
+                kind = _kind(type_definition)
+                type_definition = None
+            elements.append((name.localName(), declaration.isPlural(),
+                             type_definition, kind))
+        self.elements = tuple(elements)
+        self.mixed = binding._IsMixed()
+
+        self.xml_attributes = tuple(
+            (name, _XML_LITERALS[kind]) for name, kind in self.attributes)
+        self.xml_elements = tuple(
+            (name, plural, _XML_LITERALS.get(kind))
+            for name, plural, _, kind in self.elements)
+        self.json_attributes = tuple(
+            (name, _JSON_VALUES[kind]) for name, kind in self.attributes)
+        self.json_elements = tuple(
+            (name, plural, _JSON_VALUES.get(kind, element_obj))
+            for name, plural, _, kind in self.elements)
+        self._appendable = {}
+
+    def element_name(self, value):
+        """
+        Find the plural element a value appended to this type belongs to.
+        :param value: The appended record, binding or simple value.
+        :return: The name of the element.
+        """
+        value_type = _binding_of(value)
+        try:
+            return self._appendable[value_type]
+        except KeyError:
+            pass
+        candidates = [(name, type_definition)
+                      for name, plural, type_definition, _ in self.elements
+                      if plural]
+        if value_type is None:
+            names = [name for name, type_definition in candidates
+                     if type_definition is None]
+        else:
+            names = [name for name, type_definition in candidates
+                     if type_definition is value_type]
+            names += [name for name, type_definition in candidates
+                      if type_definition is not None and
+                      issubclass(value_type, type_definition)]
+        if not names:
+            raise TypeError('Cannot append {} to {}'.format(
+                type(value).__name__, self.binding.__name__))
+        self._appendable[value_type] = names[0]
+        return names[0]
+
+
+_schemas = {}
+
+
+def get_schema(binding):
+    """
+    Return the compiled Schema of a binding class, compiling it on first use.
+    :param binding: The PyXB binding class.
+    :return: The Schema object.
+    """
+    try:
+        return _schemas[binding]
+    except KeyError:
+        schema = _schemas[binding] = Schema(binding)
+        return schema
+
+
+class Record(object):
+    """
+    Base class of the slotted records standing in for the binding classes.
+    Use record_type() to get the record class for a binding class.
+    """
+    __slots__ = ()
+    _schema = None
+    _fields = ()
+    _plurals = ()
+
+    def __init__(self, *content, **kwargs):
+        for name in self._fields:
+            setattr(self, name, None)
+        for name in self._plurals:
+            setattr(self, name, [])
+        self._content = u' '.join(content) if content else None
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def append(self, value):
+        """
+        Append a child to the plural element matching its type.
+        :param value: The record, binding or simple value to append.
+        """
+        getattr(self, self._schema.element_name(value)).append(value)
+
+
+_record_types = {}
+
+
+def record_type(binding):
+    """
+    Return the record class for a binding class, creating it on first use.
+    :param binding: The PyXB binding class.
+    :return: The Record subclass.
+    """
+    try:
+        return _record_types[binding]
+    except KeyError:
+        pass
+    schema = get_schema(binding)
+    fields = tuple(name for name, _ in schema.attributes) + tuple(
+        name for name, plural, _, _ in schema.elements if not plural)
+    plurals = tuple(name for name, plural, _, _ in schema.elements if plural)
+    cls = _record_types[binding] = type(binding.__name__, (Record,), {
+        '__slots__': fields + plurals + ('_content',),
+        '_schema': schema,
+        '_fields': fields,
+        '_plurals': plurals,
+    })
+    return cls
+
+
+def record(binding, *content, **kwargs):
+    """
+    Create a record for a binding class.
+    :param binding: The PyXB binding class.
+    :param content: The character content, for mixed types.
+    :param kwargs: The attributes and elements of the record.
+    :return: The Record object.
+    """
+    return record_type(binding)(*content, **kwargs)
+
+
+def _binding_of(value):
+    if isinstance(value, Record):
+        return value._schema.binding
+    if isinstance(value, pyxb.binding.basis.complexTypeDefinition):
+        return type(value)
+    return None
+
+
+def _schema_of(node):
+    if isinstance(node, Record):
+        return node._schema
+    return get_schema(type(node))
+
+
+def _content_of(node):
+    """
+    Return the character content of a record or a mixed binding.
+    :return: The content, or None if there is no content.
+    """
+    if isinstance(node, Record):
+        return node._content
+    content = [c.value for c in node.orderedContent()
+               if isinstance(c, pyxb.binding.basis.NonElementContent)]
+    return u' '.join(content) if content else None
+
+
+def iter_xml(node, name=ROOT_ELEMENT):
+    """
+    Serialize a response to XML, chunk by chunk.
+    :param node: The response record (or binding) to serialize.
+    :param name: The name of the root element.
+    :return: A generator of unicode chunks.
+    """
+    yield XML_DECLARATION
+    for chunk in _iter_xml_element(node, name,
+                                   u' xmlns="{}"'.format(NAMESPACE)):
+        yield chunk
+
+
+def _iter_xml_element(node, name, extra_attributes=u''):
+    schema = _schema_of(node)
+    start = [u'<', name]
+    for attribute, literal in schema.xml_attributes:
+        value = getattr(node, attribute)
+        if value is not None:
+            start.append(u' {}="{}"'.format(attribute, _escape(literal(value))))
+    start.append(extra_attributes)
+    start = u''.join(start)
+
+    empty = True
+    if schema.mixed:
+        content = _content_of(node)
+        if content is not None:
+            yield start + u'>' + _escape(content)
+            empty = False
+    for element, plural, literal in schema.xml_elements:
+        value = getattr(node, element)
+        if value is None:
+            continue
+        for child in (value if plural else (value,)):
+            if empty:
+                yield start + u'>'
+                empty = False
+            if literal is None:
+                for chunk in _iter_xml_element(child, element):
+                    yield chunk
+            else:
+                yield u'<{0}>{1}</{0}>'.format(element,
+                                               _escape(literal(child)))
+    if empty:
+        yield start + u'/>'
+    else:
+        yield u'</' + name + u'>'
+
+
+def to_xml(node, name=ROOT_ELEMENT):
+    """
+    Serialize a response to an UTF-8 encoded XML document.
+    :param node: The response record (or binding) to serialize.
+    :param name: The name of the root element.
+    :return: The XML document, as bytes.
+    """
+    return u''.join(iter_xml(node, name)).encode('utf-8')
+
+
+_encode_json_value = json.JSONEncoder().encode
+
+# The separator of the items of indented containers, u', ' on Python 2
+_INDENTED_ITEM_SEPARATOR = json.JSONEncoder(indent=1).item_separator
+
+
+def iter_json(node, name=ROOT_ELEMENT, indent=None):
+    """
+    Serialize a response to JSON, chunk by chunk, producing the same document
+    as json.dumps(to_obj(node), indent=indent) without building the object.
+    Plural elements may be any iterable, e.g. generators reading rows from
+    the database, which are consumed as the document is written.
+    :param node: The response record (or binding) to serialize.
+    :param name: The name of the root element.
+    :param indent: The indentation of the document, None for a compact one.
+    :return: A generator of unicode chunks.
+    """
+    writer = _JsonWriter(indent)
+    root = [(name, functools.partial(writer.element, node))]
+    return writer.container(root, 0, u'{', u'}')
+
+
+class _JsonWriter(object):
+    """
+    Write JSON objects and arrays lazily, formatted the way the json module
+    does. Values are written by functions taking their nesting level.
+    """
+
+    def __init__(self, indent):
+        self.indent = indent
+
+    def container(self, members, level, opening, closing):
+        """
+        Write a JSON object or array.
+        :param members: Iterable of (key, write function) pairs, the key
+        being None for the items of an array.
+        :param level: The nesting level of the container.
+        :param opening: The opening bracket.
+        :param closing: The closing bracket.
+        :return: A generator of unicode chunks.
+        """
+        if self.indent is None:
+            separator = u', '
+            start = opening
+            end = closing
+        else:
+            newline = u'\n' + u' ' * (self.indent * (level + 1))
+            separator = _INDENTED_ITEM_SEPARATOR + newline
+            start = opening + newline
+            end = u'\n' + u' ' * (self.indent * level) + closing
+        empty = True
+        for key, write in members:
+            if empty:
+                yield start
+                empty = False
+            else:
+                yield separator
+            if key is not None:
+                yield _encode_json_value(key) + u': '
+            for chunk in write(level + 1):
+                yield chunk
+        if empty:
+            yield opening + closing
+        else:
+            yield end
+
+    def element(self, node, level):
+        return self.container(self._members(node), level, u'{', u'}')
+
+    def _members(self, node):
+        schema = _schema_of(node)
+        for attribute, convert in schema.json_attributes:
+            value = getattr(node, attribute)
+            if value is not None:
+                yield attribute, self._writer(value, convert)
+        for element, plural, convert in schema.json_elements:
+            value = getattr(node, element)
+            if value is None:
+                continue
+            if plural:
+                yield element, functools.partial(self._array, value, convert)
+            else:
+                yield element, self._writer(value, convert)
+        if schema.mixed:
+            yield 'value', self._writer(_content_of(node) or u'',
+                                        six.text_type)
+
+    def _writer(self, value, convert):
+        if convert is element_obj:
+            return functools.partial(self.element, value)
+        return functools.partial(self._scalar, convert(value))
+
+    def _array(self, values, convert, level):
+        items = ((None, self._writer(value, convert)) for value in values)
+        return self.container(items, level, u'[', u']')
+
+    @staticmethod
+    def _scalar(value, level):
+        yield _encode_json_value(value)
+
+
+def buffered(chunks, size=STREAM_BUFFER_SIZE, encoding='utf-8'):
+    """
+    Group unicode chunks into encoded blocks of about the given size, so that
+    streamed responses are not written to the socket element by element.
+    :param chunks: Iterable of unicode chunks.
+    :param size: The minimum size of a block, in characters.
+    :param encoding: The encoding of the blocks.
+    :return: A generator of encoded blocks.
+    """
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield u''.join(buffer).encode(encoding)
+            buffer = []
+            length = 0
+    if buffer:
+        yield u''.join(buffer).encode(encoding)
+
+
+def to_obj(node, name=ROOT_ELEMENT):
+    """
+    Convert a response to a Python object that can be serialized to JSON,
+    with the same layout as utils.element_to_obj.
+    :param node: The response record (or binding) to convert.
+    :param name: The name of the root element.
+    :return: The converted object.
+    """
+    return {name: element_obj(node)}
+
+
+def element_obj(node):
+    """
+    Convert an element to a Python object that can be serialized to JSON,
+    leaving out the name of the element.
+    :param node: The record or binding to convert.
+    :return: The converted object.
+    """
+    schema = _schema_of(node)
+    obj = collections.OrderedDict()
+    for attribute, convert in schema.json_attributes:
+        value = getattr(node, attribute)
+        if value is not None:
+            obj[attribute] = convert(value)
+    for element, plural, convert in schema.json_elements:
+        value = getattr(node, element)
+        if value is None:
+            continue
+        if plural:
+            obj[element] = [convert(child) for child in value]
+        else:
+            obj[element] = convert(value)
+    if schema.mixed:
+        obj['value'] = _content_of(node) or u''
+    return obj
+
+
+def to_binding(node):
+    """
+    Build the PyXB binding equivalent to a record, e.g. to validate it
+    against the schema in tests.
+    :param node: The record to convert.
+    :return: The PyXB binding object.
+    """
+    if not isinstance(node, Record):
+        return node
+    schema = node._schema
+    content = () if node._content is None else (node._content,)
+    attributes = {}
+    for attribute, _ in schema.attributes:
+        value = getattr(node, attribute)
+        if value is not None:
+            attributes[attribute] = value
+    factory = _GLOBAL_ELEMENTS.get(schema.binding, schema.binding)
+    binding = factory(*content, **attributes)
+    for element, plural, _, _ in schema.elements:
+        value = getattr(node, element)
+        if value is None:
+            continue
+        if plural:
+            for child in value:
+                getattr(binding, element).append(to_binding(child))
+        else:
+            setattr(binding, element, to_binding(value))
+    return binding
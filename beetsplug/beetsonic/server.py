@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI servers running the SubsonicServer application.
+
+The backend is chosen in the server section of the configuration:
+
+    server:
+        backend: waitress
+        workers: 2
+        threads: 8
+        shutdown_timeout: 30
+
+- development: Flask's development server, for debugging.
+- waitress: a multi-threaded server, in a single process.
+- gunicorn: pre-forked worker processes, each with its own threads, for
+  using several cores (Unix only).
+
+Every gunicorn worker creates its own application, so that the SQLite
+connections of the library are never shared between processes.
+"""
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import signal
+
+from beets import logging
+
+log = logging.getLogger('beets.beetsonic')
+
+BACKENDS = ['development', 'waitress', 'gunicorn']
+
+DEFAULT_CONFIG = {
+    u'backend': u'development',
+    # Processes of the gunicorn backend
+    u'workers': 2,
+    # Request threads, per process
+    u'threads': 8,
+    # Seconds given to the current requests to finish on shutdown
+    u'shutdown_timeout': 30,
+}
+
+
+class ServerError(Exception):
+    """
+    Raised when a server backend cannot be used.
+    """
+    pass
+
+
+def serve(create_app, host, port, config, debug=False):
+    """
+    Run the application until the server is stopped.
+    :param create_app: Function without arguments creating the WSGI
+    application, called once per process.
+    :param host: The host to listen on.
+    :param port: The port to listen on.
+    :param config: Dict of the DEFAULT_CONFIG keys.
+    :param debug: Whether to run Flask's debugger, with the development
+    backend.
+    :raise ServerError: When the backend is unknown or not installed.
+    """
+    backend = config[u'backend']
+    if backend == 'development':
+        create_app().run(host=host, port=port, debug=debug, threaded=True)
+    elif backend == 'waitress':
+        serve_waitress(create_app(), host, port, config)
+    elif backend == 'gunicorn':
+        serve_gunicorn(create_app, host, port, config)
+    else:
+        raise ServerError(u'Unknown server backend {}, expected one of {}'
+                          .format(backend, u', '.join(BACKENDS)))
+
+
+def serve_waitress(app, host, port, config):
+    """
+    Run an application with waitress. SIGTERM and SIGINT stop accepting
+    connections, and wait for the current requests to finish.
+    """
+    try:
+        from waitress.server import create_server
+    except ImportError:
+        raise ServerError(u'waitress is required by the waitress backend')
+    server = create_server(app, host=host, port=port,
+                           threads=int(config[u'threads']))
+
+    def shutdown(signum, frame):
+        log.info(u'beetsonic: shutting down')
+        server.close()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    log.info(u'beetsonic: serving on http://{}:{} with {} threads', host,
+             port, config[u'threads'])
+    try:
+        server.run()
+    finally:
+        server.task_dispatcher.shutdown(
+            timeout=int(config[u'shutdown_timeout']))
+
+
+def serve_gunicorn(create_app, host, port, config):
+    """
+    Run an application with gunicorn. gunicorn handles the signals itself:
+    SIGTERM stops the workers gracefully, SIGINT at once.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ServerError(u'gunicorn is required by the gunicorn backend')
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': '{}:{}'.format(host, port),
+                'workers': int(config[u'workers']),
+                'threads': int(config[u'threads']),
+                'worker_class': 'gthread',
+                'graceful_timeout': int(config[u'shutdown_timeout']),
+                # Streams last as long as songs
+                'timeout': 0,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return create_app()
+
+    Application().run()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Play statistics and starred albums, which beets does not track.
+
+They are kept in a SQLite database of their own, next to the caches of the
+plugin, so that the library is never written to. Counters are aggregated
+per album when plays are recorded, and indexed, so that the frequent, recent
+and starred album lists of getAlbumList2 are read by an index scan.
+
+Plays are recorded through a PlayQueue, which writes them in batches from a
+thread of its own, so that requests never wait for the database.
+"""
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import threading
+import time
+
+from beets import logging
+from six.moves import queue
+
+from beetsplug.beetsonic import caches
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS item_plays (
+    item_id INTEGER PRIMARY KEY,
+    album_id INTEGER,
+    play_count INTEGER NOT NULL DEFAULT 0,
+    last_played REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS album_plays (
+    album_id INTEGER PRIMARY KEY,
+    play_count INTEGER NOT NULL DEFAULT 0,
+    last_played REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS album_plays_by_count
+    ON album_plays (play_count DESC, album_id);
+CREATE INDEX IF NOT EXISTS album_plays_by_time
+    ON album_plays (last_played DESC, album_id);
+CREATE TABLE IF NOT EXISTS starred_albums (
+    album_id INTEGER PRIMARY KEY,
+    starred REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS starred_albums_by_time
+    ON starred_albums (starred DESC, album_id);
+'''
+
+log = logging.getLogger('beets.beetsonic')
+
+# Number of plays written at once by a PlayQueue.
+FLUSH_SIZE = 100
+
+# Number of seconds after which a PlayQueue writes the plays it holds, even
+# when there are fewer than FLUSH_SIZE.
+FLUSH_INTERVAL = 5
+
+# The SQL query of the album ids of each list type of getAlbumList2.
+ALBUM_LIST_QUERIES = {
+    'frequent': 'SELECT album_id FROM album_plays '
+                'ORDER BY play_count DESC, album_id LIMIT ? OFFSET ?',
+    'recent': 'SELECT album_id FROM album_plays '
+              'ORDER BY last_played DESC, album_id LIMIT ? OFFSET ?',
+    'starred': 'SELECT album_id FROM starred_albums '
+               'ORDER BY starred DESC, album_id LIMIT ? OFFSET ?',
+}
+
+
+class PlayStats(caches.Database):
+    """
+    The database of play statistics and starred albums.
+    """
+
+    SCHEMA = SCHEMA
+
+    def record_plays(self, plays):
+        """
+        Count plays of songs, along with their albums.
+        :param plays: Iterable of (item_id, album_id, time) tuples, album_id
+        being None for singletons and time a timestamp, or None for now.
+        """
+        now = time.time()
+        with self._lock, self._connection as connection:
+            for item_id, album_id, played in plays:
+                played = played or now
+                connection.execute(
+                    'INSERT OR IGNORE INTO item_plays (item_id, album_id) '
+                    'VALUES (?, ?)', (item_id, album_id))
+                connection.execute(
+                    'UPDATE item_plays SET play_count=play_count+1, '
+                    'last_played=MAX(last_played, ?) WHERE item_id=?',
+                    (played, item_id))
+                if album_id is None:
+                    continue
+                connection.execute(
+                    'INSERT OR IGNORE INTO album_plays (album_id) VALUES (?)',
+                    (album_id,))
+                connection.execute(
+                    'UPDATE album_plays SET play_count=play_count+1, '
+                    'last_played=MAX(last_played, ?) WHERE album_id=?',
+                    (played, album_id))
+
+    def record_play(self, item_id, album_id, played=None):
+        """
+        Count a play of a song, see record_plays.
+        """
+        self.record_plays([(item_id, album_id, played)])
+
+    def star_album(self, album_id):
+        with self._lock, self._connection as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO starred_albums (album_id, starred) '
+                'VALUES (?, ?)', (album_id, time.time()))
+
+    def unstar_album(self, album_id):
+        with self._lock, self._connection as connection:
+            connection.execute(
+                'DELETE FROM starred_albums WHERE album_id=?', (album_id,))
+
+    def get_album_ids(self, list_type, size, offset=0):
+        """
+        Get a page of the album ids of a list type.
+        :param list_type: frequent, recent or starred.
+        :param size: The maximum number of ids.
+        :param offset: The number of ids to skip.
+        :return: The list of beets album ids.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                ALBUM_LIST_QUERIES[list_type], (size, offset)).fetchall()
+        return [row[0] for row in rows]
+
+
+class PlayQueue(object):
+    """
+    Queue of plays written to a PlayStats database by a background thread,
+    in one transaction every `flush_size` plays or `flush_interval` seconds.
+    """
+
+    _STOP = object()
+
+    def __init__(self, stats, flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        """
+        :param stats: The PlayStats database.
+        :param flush_size: The maximum number of plays written at once.
+        :param flush_interval: The maximum number of seconds a play waits
+        before being written.
+        """
+        self.stats = stats
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run,
+                                        name='beetsonic-plays')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item_id, album_id, played=None):
+        """
+        Queue a play of a song, see PlayStats.record_plays.
+        """
+        self._queue.put((item_id, album_id, played or time.time()))
+
+    def join(self):
+        """
+        Wait until all the queued plays are written.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Write the queued plays and stop the thread.
+        """
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        plays = []
+        deadline = None
+        stopped = False
+        while not stopped:
+            timeout = None
+            if plays:
+                timeout = max(0, deadline - time.time())
+            try:
+                play = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                play = None
+            if play is self._STOP:
+                stopped = True
+            elif play is not None:
+                if not plays:
+                    deadline = time.time() + self.flush_interval
+                plays.append(play)
+                if len(plays) < self.flush_size:
+                    continue
+            elif not plays:
+                continue
+            self._write(plays)
+            for _ in range(len(plays) + stopped):
+                self._queue.task_done()
+            plays = []
+
+    def _write(self, plays):
+        if not plays:
+            return
+        try:
+            self.stats.record_plays(plays)
+        except Exception as e:
+            log.error(u'beetsonic: {} plays lost: {}', len(plays), e)
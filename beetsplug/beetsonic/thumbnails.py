@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Resized cover art for getCoverArt.view.
+
+Thumbnails are resized with beets' ArtResizer, which uses Pillow or
+ImageMagick, whichever is available, and kept in a DirectoryCache.
+"""
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import hashlib
+import multiprocessing
+import os
+
+import six
+from beets import logging
+from beets.util import bytestring_path
+from beets.util.artresizer import ArtResizer
+
+from beetsplug.beetsonic import caches
+
+# Sizes the thumbnails are generated in. Requested sizes are rounded up to
+# the next one, so that clients asking for slightly different sizes share the
+# same thumbnails. Larger sizes get the original cover art.
+THUMBNAIL_SIZES = [64, 128, 160, 256, 320, 512, 640, 1024]
+
+# Sizes generated in advance by the sonic-warm command.
+DEFAULT_WARM_SIZES = [160, 320]
+
+log = logging.getLogger('beets.beetsonic')
+
+
+def bucket_size(size):
+    """
+    Get the size of the thumbnail to send for a requested size.
+    :param size: The requested size, in pixels.
+    :return: The thumbnail size, or None for the original cover art.
+    """
+    for bucket in THUMBNAIL_SIZES:
+        if size <= bucket:
+            return bucket
+    return None
+
+
+class ThumbnailCache(caches.DirectoryCache):
+    """
+    Directory of resized cover art, keyed by the path and modification time
+    of the original and the thumbnail size.
+    """
+
+    def path(self, artpath, mtime, size):
+        """
+        Get the path of a thumbnail in the cache, whether it is cached or not.
+        :param artpath: The path of the original cover art.
+        :param mtime: The modification time of the original.
+        :param size: The thumbnail size, see bucket_size.
+        :return: The path.
+        """
+        if isinstance(artpath, six.text_type):
+            artpath = artpath.encode('utf-8')
+        name = u'{}-{}-{}{}'.format(
+            hashlib.sha1(artpath).hexdigest(), int(mtime), size,
+            self.suffix(artpath))
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def suffix(artpath):
+        """
+        Get the file name suffix of thumbnails, the one of the original.
+        """
+        suffix = os.path.splitext(artpath)[1].lower() or b'.jpg'
+        if not isinstance(suffix, six.text_type):
+            suffix = suffix.decode('utf-8', 'ignore')
+        return suffix
+
+    def thumbnail(self, artpath, size):
+        """
+        Get the thumbnail of a cover art, resizing it if it is not cached.
+        :param artpath: The path of the original cover art.
+        :param size: The requested size, in pixels.
+        :return: The path of the thumbnail, or artpath when the requested
+        size is too large or when the cover art cannot be resized.
+        """
+        bucket = bucket_size(size)
+        if bucket is None:
+            return artpath
+        try:
+            mtime = os.path.getmtime(artpath)
+        except OSError:
+            return artpath
+        path = self.path(artpath, mtime, bucket)
+        if self.get(path):
+            return path
+        if not ArtResizer.shared.local:
+            return artpath
+
+        fd, temp_path = self.temp_file(self.suffix(artpath))
+        os.close(fd)
+        resized = ArtResizer.shared.resize(bucket, bytestring_path(artpath),
+                                           bytestring_path(temp_path))
+        if resized != bytestring_path(temp_path) or \
+                not os.path.getsize(temp_path):
+            # ArtResizer gives back the original when it fails
+            os.remove(temp_path)
+            return artpath
+        self.add(temp_path, path)
+        return path
+
+    def warm(self, artpath, sizes):
+        """
+        Generate the missing thumbnails of a cover art.
+        :param artpath: The path of the original cover art.
+        :param sizes: The requested sizes, in pixels.
+        :return: The list of the paths of the thumbnails generated.
+        """
+        try:
+            mtime = os.path.getmtime(artpath)
+        except OSError:
+            return []
+        generated = []
+        for bucket in set(bucket_size(size) for size in sizes):
+            if bucket is None or \
+                    os.path.exists(self.path(artpath, mtime, bucket)):
+                continue
+            path = self.thumbnail(artpath, bucket)
+            if path != artpath:
+                generated.append(path)
+        return generated
+
+
+# The cache of the processes of warm_all, without a size limit
+_worker_cache = None
+
+
+def _init_worker(directory):
+    global _worker_cache
+    _worker_cache = ThumbnailCache(directory, None)
+
+
+def _warm(args):
+    artpath, sizes = args
+    return _worker_cache.warm(artpath, sizes)
+
+
+def warm_all(artpaths, directory, max_size, sizes, processes=None):
+    """
+    Generate the missing thumbnails of many cover arts in a process pool.
+    Thumbnails of cover art that did not change since they were generated are
+    kept, so an interrupted run can simply be started again.
+
+    The size of the cache is only kept by this process, which counts the
+    thumbnails of the workers as they are generated.
+    :param artpaths: Iterable of paths of cover art.
+    :param directory: The directory of the ThumbnailCache.
+    :param max_size: The maximum size of the cache, in bytes.
+    :param sizes: The requested sizes, in pixels.
+    :param processes: The number of processes, one per CPU by default.
+    :return: A generator of the number of thumbnails generated per cover art,
+    in no particular order. It stops once the cache is full, as the next
+    thumbnails would evict the ones just generated.
+    """
+    cache = ThumbnailCache(directory, max_size)
+    pool = multiprocessing.Pool(processes, _init_worker, (directory,))
+    try:
+        for paths in pool.imap_unordered(
+                _warm, ((artpath, sizes) for artpath in artpaths),
+                chunksize=4):
+            for path in paths:
+                cache.track(path)
+            yield len(paths)
+            if cache.evicted:
+                log.warning(u'beetsonic: the thumbnail cache is full, only '
+                            u'part of the cover art is warmed')
+                return
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        # Counts the thumbnails the workers were generating when stopped
+        cache.trim()
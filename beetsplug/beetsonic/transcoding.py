@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+On-the-fly transcoding of songs for stream.view.
+
+Songs are transcoded by an external encoder, ffmpeg by default, whose
+command line is configured per profile, e.g.:
+
+    transcoding:
+        workers: 2
+        default_profile: mp3
+        profiles:
+            mp3:
+                command: ffmpeg -v quiet -ss $offset -i $source -map 0:a:0
+                         -b:a ${bitrate}k -f mp3 -
+                mimetype: audio/mpeg
+                bitrate: 192
+
+The encoder writes the transcoded song to its standard output, which is
+streamed to the client while it is produced.
+"""
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import os
+import shlex
+import string
+import subprocess
+import threading
+
+from beetsplug.beetsonic import caches
+
+# Size of the chunks the encoder's output is read in.
+CHUNK_SIZE = 64 * 1024
+
+# Number of encoders allowed to run at the same time.
+DEFAULT_WORKERS = 2
+
+DEFAULT_PROFILES = {
+    u'mp3': {
+        u'command': u'ffmpeg -v quiet -ss $offset -i $source -map 0:a:0 '
+                    u'-b:a ${bitrate}k -f mp3 -',
+        u'mimetype': u'audio/mpeg',
+        u'bitrate': 192,
+    },
+    u'opus': {
+        u'command': u'ffmpeg -v quiet -ss $offset -i $source -map 0:a:0 '
+                    u'-c:a libopus -b:a ${bitrate}k -f ogg -',
+        u'mimetype': u'audio/ogg',
+        u'suffix': u'ogg',
+        u'bitrate': 128,
+    },
+}
+
+
+class TranscoderBusyError(Exception):
+    """
+    Raised when all the workers are busy transcoding other songs.
+    """
+    pass
+
+
+class TranscodingProfile(object):
+    """
+    An encoder command line, along with the kind of files it produces.
+    """
+
+    def __init__(self, name, command, mimetype, suffix=None, bitrate=128):
+        """
+        :param name: The name of the profile, also used as the format
+        requested by the clients.
+        :param command: The command template. $source is replaced with the
+        path of the song, $bitrate with the bitrate in kbps and $offset with
+        the number of seconds to skip at the start of the song.
+        :param mimetype: The MIME type of the encoder's output.
+        :param suffix: The suffix of the produced files, the name of the
+        profile by default.
+        :param bitrate: The bitrate to transcode to, in kbps, when the client
+        does not ask for a lower one.
+        """
+        self.name = name
+        self.command = shlex.split(command)
+        self.mimetype = mimetype
+        self.suffix = suffix or name
+        self.bitrate = int(bitrate)
+
+    def args(self, path, bitrate, offset=0):
+        """
+        Get the arguments of the encoder process for a song.
+        :param path: The path of the song.
+        :param bitrate: The bitrate to transcode to, in kbps.
+        :param offset: The number of seconds to skip at the start.
+        :return: The list of arguments.
+        """
+        values = {
+            u'source': path,
+            u'bitrate': str(bitrate),
+            u'offset': str(offset),
+        }
+        return [string.Template(arg).safe_substitute(values)
+                for arg in self.command]
+
+
+class TranscodingStream(object):
+    """
+    Iterable over the output of an encoder process, to be used as the body of
+    a response. Closing it stops the process and frees its worker.
+    """
+
+    def __init__(self, process, profile, release):
+        self.process = process
+        self.profile = profile
+        self.mimetype = profile.mimetype
+        self.complete = False
+        self._release = release
+        self._closed = False
+
+    def __iter__(self):
+        while True:
+            data = self.process.stdout.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+        self.complete = True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if not self.complete and self.process.poll() is None:
+                self.process.kill()
+            self.process.stdout.close()
+            self.process.wait()
+        finally:
+            self._release()
+
+    @property
+    def succeeded(self):
+        """
+        Whether the whole output was read and the encoder exited normally.
+        """
+        return self.complete and self.process.returncode == 0
+
+
+class CachingStream(object):
+    """
+    Iterable over a TranscodingStream which also writes its output to a
+    temporary file, moved into the TranscodeCache once the encoder succeeded.
+    """
+
+    def __init__(self, stream, cache, path):
+        self.stream = stream
+        self.mimetype = stream.mimetype
+        self._cache = cache
+        self._path = path
+        fd, self._temp_path = cache.temp_file()
+        self._file = os.fdopen(fd, 'wb')
+        self._closed = False
+
+    def __iter__(self):
+        for data in self.stream:
+            self._file.write(data)
+            yield data
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._file.close()
+        self.stream.close()
+        if self.stream.succeeded:
+            self._cache.add(self._temp_path, self._path)
+        else:
+            os.remove(self._temp_path)
+
+
+class TranscodeCache(caches.DirectoryCache):
+    """
+    Directory of transcoded songs, keyed by item id, item modification time,
+    profile and bitrate.
+    """
+
+    def path(self, item_id, mtime, profile, bitrate):
+        """
+        Get the path of a transcoded song in the cache, whether it is cached
+        or not.
+        :param item_id: The beets id of the item.
+        :param mtime: The modification time of the item.
+        :param profile: The TranscodingProfile.
+        :param bitrate: The bitrate in kbps.
+        :return: The path.
+        """
+        name = u'{}-{}-{}-{}.{}'.format(item_id, int(mtime or 0),
+                                        profile.name, bitrate, profile.suffix)
+        return os.path.join(self.directory, name)
+
+    def wrap(self, stream, path):
+        """
+        Cache the output of a transcoding while it is streamed.
+        :param stream: The TranscodingStream.
+        :param path: The path of the song in the cache, see path().
+        :return: The CachingStream to send instead.
+        """
+        return CachingStream(stream, self, path)
+
+
+class Transcoder(object):
+    """
+    Choose the profile to stream songs with, and run the encoders, at most
+    `workers` of them at the same time.
+    """
+
+    def __init__(self, profiles, default_profile=None,
+                 workers=DEFAULT_WORKERS):
+        """
+        :param profiles: List of TranscodingProfile objects.
+        :param default_profile: The name of the profile used when the client
+        does not request a format, but asks for a lower bitrate.
+        :param workers: The maximum number of encoders running at once.
+        """
+        self.profiles = dict((profile.name, profile) for profile in profiles)
+        self.default_profile = self.profiles.get(default_profile)
+        self.workers = workers
+        self._workers = threading.BoundedSemaphore(workers)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a Transcoder from the transcoding configuration of the plugin.
+        :param config: Dict with the workers, default_profile and profiles
+        keys, profiles mapping names to the arguments of TranscodingProfile.
+        :return: The Transcoder.
+        """
+        profiles = [TranscodingProfile(name, **options)
+                    for name, options in config[u'profiles'].items()]
+        return cls(profiles, config.get(u'default_profile'),
+                   config.get(u'workers', DEFAULT_WORKERS))
+
+    def get_profile(self, name):
+        """
+        Get a profile by its name or by the suffix of the files it produces.
+        :param name: The name or suffix.
+        :return: The TranscodingProfile, or None.
+        """
+        if name in self.profiles:
+            return self.profiles[name]
+        for profile in self.profiles.values():
+            if profile.suffix == name:
+                return profile
+        return None
+
+    def select(self, song_format, song_bitrate, requested_format=None,
+               max_bitrate=0, offset=0):
+        """
+        Choose how to stream a song, following the stream.view arguments.
+        :param song_format: The format of the song, as stored by beets.
+        :param song_bitrate: The bitrate of the song, in bps.
+        :param requested_format: The format requested by the client, 'raw'
+        to disable transcoding.
+        :param max_bitrate: The maximum bitrate in kbps, 0 for no limit.
+        :param offset: The number of seconds to skip at the start.
+        :return: A tuple of the TranscodingProfile and the bitrate in kbps,
+        or None to send the song as it is.
+        """
+        if requested_format == u'raw':
+            return None
+        profile = None
+        if requested_format:
+            profile = self.get_profile(requested_format)
+        needed = bool(offset) or bool(
+            max_bitrate and (song_bitrate or 0) > max_bitrate * 1000)
+        if profile is not None and \
+                profile.suffix != (song_format or u'').lower():
+            needed = True
+        profile = profile or self.default_profile
+        if not needed or profile is None:
+            return None
+        bitrate = profile.bitrate
+        if max_bitrate:
+            bitrate = min(bitrate, max_bitrate)
+        return profile, bitrate
+
+    def transcode(self, path, profile, bitrate, offset=0):
+        """
+        Start transcoding a song.
+        :param path: The path of the song.
+        :param profile: The TranscodingProfile to use.
+        :param bitrate: The bitrate in kbps.
+        :param offset: The number of seconds to skip at the start.
+        :return: The TranscodingStream of the encoder's output.
+        :raise TranscoderBusyError: When all the workers are busy.
+        :raise OSError: When the encoder cannot be started.
+        """
+        if not self._workers.acquire(False):
+            raise TranscoderBusyError(
+                'All {} transcoding workers are busy'.format(self.workers))
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                process = subprocess.Popen(
+                    profile.args(path, bitrate, offset),
+                    stdin=devnull, stdout=subprocess.PIPE, stderr=devnull,
+                    bufsize=CHUNK_SIZE)
+        except Exception:
+            self._workers.release()
+            raise
+        return TranscodingStream(process, profile, self._workers.release)
@@ -2,21 +2,31 @@
 Utilities module
 """
 
+import codecs
+import collections
 import io
+import itertools
 import json
 import os
 import time
 from datetime import datetime
-from functools import reduce
 
 import pyxb
+from six.moves.urllib.parse import unquote, urlparse
 
 from beetsplug.beetsonic import bindings
+from beetsplug.beetsonic import serializers
+
+# An entry of a m3u playlist, see parse_m3u. The duration, in seconds, and the
+# title are those of its #EXTINF line, or None.
+M3uEntry = collections.namedtuple('M3uEntry', ['path', 'duration', 'title'])
 
 
 def element_to_obj(element, use_name=True):
     """
     Convert a bound element to a Python object that can be serialized.
+    The attributes and child elements of each binding class are looked up
+    once, in the compiled schema of the class (see serializers.get_schema).
     :param pyxb.binding.basis.complexTypeDefinition element: The bound element.
     :param use_name: Whether to use element name as the key or not.
     :return: The converted Object.
@@ -26,26 +36,7 @@ def element_to_obj(element, use_name=True):
         element_name = element._PluralBinding__elementBinding.name().localName()
         return {element_name: child_elements}
     elif isinstance(element, pyxb.binding.basis.complexTypeDefinition):
-        attributes = [attr.localName() for attr in element._AttributeMap.keys()]
-        attr_map = {attr: getattr(element, attr)
-                    for attr in attributes
-                    if getattr(element, attr) is not None}
-
-        child_elements = [el.localName()
-                          for el in element._ElementMap.keys()
-                          if getattr(element, el.localName()) is not None]
-        for child_element in child_elements:
-            child = getattr(element, child_element)
-            child_obj = element_to_obj(child, True)
-            if child == child_obj:
-                child_obj = {child_element: child_obj}
-            attr_map.update(child_obj)
-        if element._IsMixed():
-            content = ' '.join([c.value
-                                for c in element.orderedContent()
-                                if isinstance(c, pyxb.binding.basis.NonElementContent)])
-            attr_map.update({'value': content})
-
+        attr_map = serializers.element_obj(element)
         if use_name:
             attr_map = {element._element().name().localName(): attr_map}
         return attr_map
@@ -55,7 +46,8 @@ def element_to_obj(element, use_name=True):
 
 def create_subsonic_response(version, status=bindings.ResponseStatus.ok,
                              **kwargs):
-    response = bindings.subsonic_response(
+    response = serializers.record(
+        bindings.Response,
         version=version,
         status=status,
         **kwargs
@@ -63,13 +55,33 @@ def create_subsonic_response(version, status=bindings.ResponseStatus.ok,
     return response
 
 
+def create_error(code, message):
+    """
+    Helper method to create an Error object.
+    :param code: The Subsonic error code.
+    :param message: The error message.
+    :return: The Error object
+    """
+    return serializers.record(bindings.Error, code=code, message=message)
+
+
+def create_license(valid):
+    """
+    Helper method to create a License object.
+    :param valid: Whether the license is valid or not.
+    :return: The License object
+    """
+    return serializers.record(bindings.License, valid=valid)
+
+
 def create_artist(id, name, **kwargs):
     """
     Helper method to create an Artist object.
     :param name: Name of the artist
     :return: The Artist object
     """
-    return bindings.Artist(
+    return serializers.record(
+        bindings.Artist,
         id=id,
         name=name,
         **kwargs
@@ -84,7 +96,8 @@ def create_artist_id3(id, name, album_count, **kwargs):
     :return: The ArtistID3 object
     """
 
-    return bindings.ArtistID3(
+    return serializers.record(
+        bindings.ArtistID3,
         id=id,
         name=name,
         albumCount=album_count,
@@ -102,7 +115,8 @@ def create_artist_with_albums_id3(id, name, album_count, albums=[], **kwargs):
     the artist.
     :return: The ArtistWithAlbumsID3 object.
     """
-    artist = bindings.ArtistWithAlbumsID3(
+    artist = serializers.record(
+        bindings.ArtistWithAlbumsID3,
         id=id,
         name=name,
         albumCount=album_count,
@@ -114,7 +128,7 @@ def create_artist_with_albums_id3(id, name, album_count, albums=[], **kwargs):
 
 
 def create_album_list2(albums=[]):
-    albumlist = bindings.AlbumList2()
+    albumlist = serializers.record(bindings.AlbumList2)
     for album in albums:
         albumlist.append(album)
     return albumlist
@@ -127,7 +141,8 @@ def create_song(id, title, **kwargs):
     :param kwargs: The other properties of the song.
     :return: The Child object
     """
-    return bindings.Child(
+    return serializers.record(
+        bindings.Child,
         id=id,
         title=title,
         isDir=False,
@@ -143,7 +158,8 @@ def create_album(id, title, **kwargs):
     :param kwargs: The other properties of the album.
     :return: The Child object.
     """
-    return bindings.Child(
+    return serializers.record(
+        bindings.Child,
         id=id,
         title=title,
         album=title,
@@ -161,7 +177,8 @@ def create_directory(id, name, children=[], **kwargs):
     :param kwargs: The other properties of the Directory.
     :return: The Directory object
     """
-    directory = bindings.Directory(
+    directory = serializers.record(
+        bindings.Directory,
         id=id,
         name=name,
         **kwargs
@@ -182,7 +199,8 @@ def create_album_id3(id, name, song_count, duration, created, **kwargs):
     :param kwargs: Other properties of the album.
     :return: The AlbumID3 object.
     """
-    album = bindings.AlbumID3(
+    album = serializers.record(
+        bindings.AlbumID3,
         id=id,
         name=name,
         songCount=song_count,
@@ -206,7 +224,8 @@ def create_album_with_songs_id3(id, name, song_count, duration, created,
     :param kwargs: Other properties of the album.
     :return: The AlbumWithSongsID3 object.
     """
-    album = bindings.AlbumWithSongsID3(
+    album = serializers.record(
+        bindings.AlbumWithSongsID3,
         id=id,
         name=name,
         songCount=song_count,
@@ -223,7 +242,8 @@ def create_user(username, scrobbling_enabled, admin_role, settings_role,
                 download_role, upload_role, playlist_role, cover_art_role,
                 comment_role, podcast_role, stream_role, jukebox_role,
                 share_role, video_conversion_role, folder_ids, **kwargs):
-    user = bindings.User(
+    user = serializers.record(
+        bindings.User,
         username=username,
         scrobblingEnabled=scrobbling_enabled,
         adminRole=admin_role,
@@ -245,43 +265,59 @@ def create_user(username, scrobbling_enabled, admin_role, settings_role,
     return user
 
 
+def create_users(users):
+    """
+    Create a Users object from a list of User objects.
+    :param users: List of User objects.
+    :return: The Users object.
+    """
+    users_obj = serializers.record(bindings.Users)
+    for user in users:
+        users_obj.append(user)
+    return users_obj
+
+
+def index_name(name, ignored_articles_str):
+    """
+    Get the index an artist belongs to.
+    :param name: The name of the artist.
+    :param ignored_articles_str: Space separated words to ignore at the
+    start of the name.
+    :return: The uppercase first character of the name.
+    """
+    ignored_articles = ignored_articles_str.split(' ')
+    name_parts = (name or '').split(' ')
+    while len(name_parts) > 1 and name_parts[0] in ignored_articles:
+        name_parts.pop(0)
+    return name_parts[0][:1].upper()
+
+
 def _create_indexes(artists, ignored_articles_str, indexes_type, index_type):
     """
     Create indexes from a list of Artist objects.
     An index consists of an uppercase character, mapping to all the Artists
     whose name starts with that character.
-    :param artists: List of Artist objects.
+    :param artists: List of Artist objects, or an iterator of Artist objects
+    already ordered by index name. The indexes are then only built while the
+    response is written.
     :param ignoredArticles: List of words to ignore while building the indexes.
     :return: An Indexes object
     """
-    ignored_articles = ignored_articles_str.split(' ')
-    indexes = indexes_type()
+    indexes = serializers.record(indexes_type)
     indexes.ignoredArticles = ignored_articles_str
 
-    def index_func(map, artist):
-        """
-        The reducer function to index the list
-        """
-        name_parts = artist.name.split(' ')
-        while name_parts[0] in ignored_articles:
-            name_parts.pop(0)
-        first_char = name_parts[0][:1].upper()
-        if first_char not in map:
-            map[first_char] = []
-        map[first_char].append(artist)
-        return map
-
-    char_map = reduce(
-        index_func,
-        artists,
-        dict()
-    )
-    for char, artists in sorted(char_map.items()):
-        index = index_type(name=char)
-        for artist in artists:
-            index.append(artist)
-        indexes.append(index)
+    def artist_index(artist):
+        return index_name(artist.name, ignored_articles_str)
 
+    streamed = not isinstance(artists, (list, tuple))
+    if not streamed:
+        artists = sorted(artists, key=artist_index)
+    indexes.index = (
+        serializers.record(index_type, name=char, artist=list(group))
+        for char, group in itertools.groupby(artists, artist_index)
+    )
+    if not streamed:
+        indexes.index = list(indexes.index)
     return indexes
 
 
@@ -301,7 +337,7 @@ def create_music_folders(music_folders):
     :param music_folders: List of Music Folder objects
     :return: Music Folders object
     """
-    folders = bindings.MusicFolders()
+    folders = serializers.record(bindings.MusicFolders)
     for music_folder in music_folders:
         folders.append(music_folder)
     return folders
@@ -314,7 +350,8 @@ def create_music_folder(id, **kwargs):
     :param kwargs: The other keyword arguments
     :return: The Music Folder object
     """
-    return bindings.MusicFolder(
+    return serializers.record(
+        bindings.MusicFolder,
         id=id,
         **kwargs
     )
@@ -326,19 +363,43 @@ def create_songs(child_objects):
     :param child_objects: List of Child objects.
     :return: a Songs object.
     """
-    songs = bindings.Songs()
+    songs = serializers.record(bindings.Songs)
     for child in child_objects:
         songs.append(child)
     return songs
 
 
+def create_search_result2(artists=[], albums=[], songs=[]):
+    """
+    Create a SearchResult2 object.
+    :param artists: List of Artist objects.
+    :param albums: List of Child objects representing albums.
+    :param songs: List of Child objects representing songs.
+    :return: The SearchResult2 object.
+    """
+    return serializers.record(bindings.SearchResult2, artist=list(artists),
+                              album=list(albums), song=list(songs))
+
+
+def create_search_result3(artists=[], albums=[], songs=[]):
+    """
+    Create a SearchResult3 object.
+    :param artists: List of ArtistID3 objects.
+    :param albums: List of AlbumID3 objects.
+    :param songs: List of Child objects.
+    :return: The SearchResult3 object.
+    """
+    return serializers.record(bindings.SearchResult3, artist=list(artists),
+                              album=list(albums), song=list(songs))
+
+
 def create_artist_info(mb_artistid, **kwargs):
     """
     Create an ArtistInfo object.
     :param kwargs: The properties of the ArtistInfo object.
     :return: The ArtistInfo object.
     """
-    info = bindings.ArtistInfo(**kwargs)
+    info = serializers.record(bindings.ArtistInfo, **kwargs)
     info.musicBrainzId = mb_artistid
     return info
 
@@ -349,7 +410,7 @@ def create_artist_info2(mb_artistid, **kwargs):
     :param kwargs: The properties of the ArtistInfo2 object.
     :return: The ArtistInfo2 object.
     """
-    info = bindings.ArtistInfo2(**kwargs)
+    info = serializers.record(bindings.ArtistInfo2, **kwargs)
     info.musicBrainzId = mb_artistid
     return info
 
@@ -361,7 +422,7 @@ def create_lyrics(content, **kwargs):
     :param kwargs: Other properties of the Lyrics object.
     :return: The Lyrics object.
     """
-    lyrics = bindings.Lyrics(content, **kwargs)
+    lyrics = serializers.record(bindings.Lyrics, content, **kwargs)
     return lyrics
 
 
@@ -371,7 +432,7 @@ def create_genres(genre_objs):
     :param genre_obs: List of Genre objects.
     :return: The Genres object.
     """
-    genres = bindings.Genres()
+    genres = serializers.record(bindings.Genres)
     for genre_obj in genre_objs:
         genres.append(genre_obj)
     return genres
@@ -385,7 +446,8 @@ def create_genre(name, album_count, song_count):
     :param album_count: The number of albums in the genre.
     :return: The Genre object.
     """
-    return bindings.Genre(name, songCount=song_count, albumCount=album_count)
+    return serializers.record(bindings.Genre, name, songCount=song_count,
+                              albumCount=album_count)
 
 
 def create_playlists(playlists):
@@ -395,12 +457,41 @@ def create_playlists(playlists):
     :param kwargs: Other properties of the Playlists.
     :return: The Playlists object.
     """
-    playlists_obj = bindings.Playlists()
+    playlists_obj = serializers.record(bindings.Playlists)
     for playlist in playlists:
         playlists_obj.append(playlist)
     return playlists_obj
 
 
+def create_playlist_summary(allowed_users, playlist_id, name, song_count,
+                            duration, created, changed, **kwargs):
+    """
+    Create a Playlist object, without its songs, as listed in Playlists.
+    :param allowed_users: List of allowed users.
+    :param playlist_id: Id of the playlist.
+    :param name: Name of the playlist.
+    :param song_count: Number of songs in the playlist.
+    :param duration: Duration of the playlist.
+    :param created: When the playlist was created.
+    :param changed: When the playlist was last changed.
+    :param kwargs: Other properties of the playlist.
+    :return: The Playlist object.
+    """
+    playlist = serializers.record(
+        bindings.Playlist,
+        id=playlist_id,
+        name=name,
+        songCount=song_count,
+        duration=duration,
+        created=created,
+        changed=changed,
+        **kwargs
+    )
+    for user in allowed_users:
+        playlist.append(user)
+    return playlist
+
+
 def create_playlist(songs, allowed_users, playlist_id, name, song_count,
                     duration, created, changed, **kwargs):
     """
@@ -416,7 +507,8 @@ def create_playlist(songs, allowed_users, playlist_id, name, song_count,
     :param kwargs: Other properties of the playlist.
     :return: The Playlist object.
     """
-    playlist = bindings.PlaylistWithSongs(
+    playlist = serializers.record(
+        bindings.PlaylistWithSongs,
         id=playlist_id,
         name=name,
         songCount=song_count,
@@ -438,7 +530,7 @@ def create_podcasts():
     Create a Podcasts object.
     :return: A Podcasts object.
     """
-    return bindings.Podcasts()
+    return serializers.record(bindings.Podcasts)
 
 
 def get_music_type():
@@ -451,16 +543,63 @@ def get_music_type():
 
 def parse_m3u(m3u_location):
     """
-    Parse a m3u file.
+    Parse a m3u or m3u8 file, line by line. Lines are read as UTF-8, with or
+    without a BOM, or else as Latin-1. Relative paths are relative to the
+    directory of the playlist, file URLs are turned into paths, and other
+    URLs are skipped.
     :param m3u_location: Location of the m3u playlist.
-    :return: A list of absolute paths to the songs that are in the playlist.
-    """
-    with io.open(m3u_location, encoding='utf-8') as m3u:
-        items = m3u.readlines()
-    items = [os.path.abspath(item)
-             for item in items
-             if not item.startswith(u'#')]
-    return items
+    :return: A generator of M3uEntry objects, with absolute and normalized
+    paths, in the order of the playlist.
+    """
+    directory = os.path.dirname(os.path.abspath(m3u_location))
+    duration = title = None
+    with io.open(m3u_location, 'rb') as m3u:
+        for number, line in enumerate(m3u):
+            if number == 0 and line.startswith(codecs.BOM_UTF8):
+                line = line[len(codecs.BOM_UTF8):]
+            line = _decode_m3u_line(line).strip()
+            if not line:
+                continue
+            if line.startswith(u'#'):
+                if line.startswith(u'#EXTINF:'):
+                    duration, title = _parse_extinf(line[len(u'#EXTINF:'):])
+                continue
+            path = _m3u_path(line)
+            if path is not None:
+                yield M3uEntry(os.path.normpath(os.path.join(directory, path)),
+                               duration, title)
+            duration = title = None
+
+
+def _decode_m3u_line(line):
+    try:
+        return line.decode('utf-8')
+    except UnicodeDecodeError:
+        return line.decode('latin-1')
+
+
+def _parse_extinf(info):
+    """
+    Parse the "<duration> [attributes],<title>" of an #EXTINF line.
+    :return: A (duration, title) tuple, duration being None when unknown.
+    """
+    duration, _, title = info.partition(u',')
+    try:
+        duration = float(duration.split()[0])
+    except (IndexError, ValueError):
+        duration = None
+    if duration is not None and duration < 0:
+        duration = None
+    return duration, title.strip() or None
+
+
+def _m3u_path(location):
+    if u'://' not in location:
+        return location
+    url = urlparse(location)
+    if url.scheme != u'file':
+        return None
+    return unquote(url.path)
 
 
 class JsonEncoder(json.JSONEncoder):
@@ -1,11 +1,14 @@
+import atexit
 import hashlib
-import json
+import itertools
 import mimetypes
 import os
-import re
+import sqlite3
+import uuid
+from datetime import datetime
 from functools import wraps
 
-import pyxb.utils.domutils
+from beets import logging
 from flask import Blueprint
 from flask import Flask
 from flask import Response
@@ -14,41 +17,140 @@ from flask import request
 from flask import send_file
 from flask.views import View
 from flask_cors import CORS
+from werkzeug.http import is_resource_modified
+from werkzeug.http import parse_range_header
+from werkzeug.wsgi import wrap_file
 
 from beetsplug.beetsonic import bindings
+from beetsplug.beetsonic import caches
 from beetsplug.beetsonic import errors
+from beetsplug.beetsonic import lyrics
+from beetsplug.beetsonic import playlists
+from beetsplug.beetsonic import search
+from beetsplug.beetsonic import serializers
+from beetsplug.beetsonic import stats
+from beetsplug.beetsonic import thumbnails
+from beetsplug.beetsonic import transcoding
 from beetsplug.beetsonic import utils
-from beetsplug.beetsonic.models import EntityNotFoundError
+from beetsplug.beetsonic.models import BeetIdType, EntityNotFoundError
 
 SUBSONIC_API_VERSION = u'1.16.1'
 
+log = logging.getLogger('beets.beetsonic')
+
+# Query arguments that change from one request to the other without changing
+# the response, left out of the entity tags.
+VOLATILE_ARGUMENTS = frozenset(['p', 't', 's'])
+
+# Size of the chunks files are read in when sending byte ranges.
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Number of seconds clients may cache cover art without revalidating it.
+COVER_ART_MAX_AGE = 24 * 60 * 60
+
+# Range headers with more ranges than this are ignored, and the whole file is
+# sent instead.
+MAX_RANGES = 16
+
+MIMETYPES = {
+    'json': 'application/json',
+    'jsonp': 'application/javascript',
+}
+
 
 class ResponseView(View):
     """
     Used for common responses that contain the API results
     """
-    def __init__(self, generate_response_func=None):
+    def __init__(self, generate_response_func=None, validator_func=None):
         self.generate_response_func = generate_response_func
+        self.validator_func = validator_func
         self.response = utils.create_subsonic_response(SUBSONIC_API_VERSION)
 
     def dispatch_request(self, *args, **kwargs):
+        state = None
+        if self.validator_func and request.method in ('GET', 'HEAD'):
+            state = self.validator_func()
+        if state is not None:
+            etag = self.entity_tag(state.generation)
+            last_modified = datetime.utcfromtimestamp(int(state.last_modified))
+            if not is_resource_modified(request.environ, etag,
+                                        last_modified=last_modified):
+                rv = Response(status=304)
+                rv.set_etag(etag)
+                rv.last_modified = last_modified
+                return rv
+
+        rv = self.build_response()
+        if state is not None:
+            rv.set_etag(etag)
+            rv.last_modified = last_modified
+        return rv
+
+    def build_response(self):
+        document = None
         if self.generate_response_func:
-            self.generate_response_func(self.response)
+            document = self.generate_response_func(self.response)
         return_format = request.args.get('f', 'xml')
-        if return_format in ['json', 'jsonp']:
-            obj = utils.element_to_obj(self.response)
-            if return_format == 'json':
-                content = json.dumps(obj, cls=utils.JsonEncoder, indent=3)
-                mimetype = 'application/json'
-            else:
-                content = json.dumps(obj, cls=utils.JsonEncoder)
-                callback = request.args.get(u'callback', 'callback')
-                content = callback + '(' + content + ')'
-                mimetype = 'application/javascript'
+        if isinstance(document, bytes):
+            # Already serialized, see serialize()
+            blocks = [document]
         else:
-            content = self.response.toxml('utf-8')
-            mimetype = 'text/xml'
-        return Response(content, mimetype=mimetype)
+            blocks = serializers.buffered(
+                self.iter_document(self.response, return_format))
+        if return_format == 'jsonp':
+            callback = request.args.get(u'callback', 'callback')
+            blocks = itertools.chain([(callback + '(').encode('utf-8')],
+                                     blocks, [b')'])
+        return self.stream(blocks, MIMETYPES.get(return_format, 'text/xml'))
+
+    @staticmethod
+    def entity_tag(generation):
+        """
+        Get the entity tag of the response to the current request, for a
+        given generation of the library.
+        """
+        message = hashlib.md5()
+        message.update(u'{}\n{}'.format(generation, request.path).encode(
+            'utf-8'))
+        for key, value in sorted(request.args.items(multi=True)):
+            if key not in VOLATILE_ARGUMENTS:
+                message.update(u'\n{}={}'.format(key, value).encode('utf-8'))
+        return message.hexdigest()
+
+    @staticmethod
+    def iter_document(response, return_format):
+        """
+        Serialize a response in the requested format, chunk by chunk. JSONP
+        documents are left without their callback.
+        """
+        if return_format == 'json':
+            return serializers.iter_json(response, indent=3)
+        elif return_format == 'jsonp':
+            return serializers.iter_json(response)
+        return serializers.iter_xml(response)
+
+    @classmethod
+    def serialize(cls, response, return_format):
+        """
+        Serialize a response at once, for routes returning cached documents
+        instead of filling the response.
+        :return: The document, as bytes.
+        """
+        return u''.join(cls.iter_document(response, return_format)).encode(
+            'utf-8')
+
+    @staticmethod
+    def stream(blocks, mimetype):
+        """
+        Send the response body in one piece when it fits in a couple of
+        blocks, and stream it otherwise, so that large lists are written
+        while they are read from the database.
+        """
+        head = list(itertools.islice(blocks, 2))
+        if len(head) < 2:
+            return Response(b''.join(head), mimetype=mimetype)
+        return Response(itertools.chain(head, blocks), mimetype=mimetype)
 
 
 class BinaryView(View):
@@ -56,8 +158,9 @@ class BinaryView(View):
     Used for responses that contain binary data
     """
 
-    def __init__(self, location_fn):
+    def __init__(self, location_fn, max_age=None):
         self.location_fn = location_fn
+        self.max_age = max_age
         self.error_response = utils.create_subsonic_response(
             SUBSONIC_API_VERSION,
             bindings.ResponseStatus.failed
@@ -65,50 +168,144 @@ class BinaryView(View):
 
     def dispatch_request(self, *args, **kwargs):
         location = self.location_fn(self.error_response)
-        if isinstance(location, bindings.Response):
+        if isinstance(location, serializers.Record):
             # This is a convention we use to denote that there is an error
-            content = location.toxml('utf-8')
+            content = serializers.to_xml(location)
             mimetype = 'text/xml'
             return Response(content, mimetype=mimetype)
+        elif isinstance(location, (transcoding.TranscodingStream,
+                                   transcoding.CachingStream)):
+            return Response(location, mimetype=location.mimetype,
+                            direct_passthrough=True)
+        elif self.max_age is not None:
+            return self.send_file_cached(location, self.max_age)
         else:
             return self.send_file_partial(location)
 
-    @staticmethod
-    def send_file_partial(path):
+    @classmethod
+    def send_file_cached(cls, path, max_age):
+        """
+        Send a file that clients may cache for max_age seconds, with an ETag
+        to revalidate it afterwards.
+        """
+        stat = os.stat(path)
+        message = hashlib.md5()
+        message.update(u'{}\n{}\n{}'.format(
+            path, stat.st_mtime, stat.st_size).encode('utf-8'))
+        etag = message.hexdigest()
+        if is_resource_modified(request.environ, etag):
+            rv = cls.send_file_partial(path)
+        else:
+            rv = Response(status=304)
+        rv.set_etag(etag)
+        rv.cache_control.public = True
+        rv.cache_control.max_age = max_age
+        return rv
+
+    @classmethod
+    def send_file_partial(cls, path):
         """
         Simple wrapper around send_file which handles HTTP 206 Partial Content
         (byte ranges).
+        The file is never read in memory at once: ranges reaching the end of
+        the file go through the server's file wrapper, which can use
+        sendfile, and other ranges are read in chunks of FILE_CHUNK_SIZE.
+        Multiple ranges are sent as multipart/byteranges.
         """
-        range_header = request.headers.get('Range', None)
-        if not range_header: return send_file(path)
+        ranges = parse_range_header(request.headers.get('Range', None))
+        if ranges is None or ranges.units != 'bytes' or \
+                len(ranges.ranges) > MAX_RANGES:
+            return send_file(path)
 
         size = os.path.getsize(path)
-        byte1, byte2 = 0, None
-
-        m = re.search('(\d+)-(\d*)', range_header)
-        g = m.groups()
-
-        if g[0]: byte1 = int(g[0])
-        if g[1]: byte2 = int(g[1])
-
-        length = size - byte1
-        if byte2 is not None:
-            length = byte2 - byte1
-
-        data = None
-        with open(path, 'rb') as f:
-            f.seek(byte1)
-            data = f.read(length)
+        byte_ranges = cls.satisfiable_ranges(ranges.ranges, size)
+        if not byte_ranges:
+            rv = Response(status=416)
+            rv.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return rv
+
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if len(byte_ranges) == 1:
+            start, stop = byte_ranges[0]
+            f = open(path, 'rb')
+            f.seek(start)
+            if stop == size:
+                body = wrap_file(request.environ, f, FILE_CHUNK_SIZE)
+            else:
+                body = cls.iter_file_range(f, [(start, stop)])
+            rv = Response(body, 206, mimetype=mimetype,
+                          direct_passthrough=True)
+            rv.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stop - 1, size)
+            rv.content_length = stop - start
+            return rv
+
+        boundary = uuid.uuid4().hex
+        headers = [
+            ('\r\n--{}\r\nContent-Type: {}\r\n'
+             'Content-Range: bytes {}-{}/{}\r\n\r\n').format(
+                boundary, mimetype, start, stop - 1, size).encode('ascii')
+            for start, stop in byte_ranges
+        ]
+        trailer = '\r\n--{}--\r\n'.format(boundary).encode('ascii')
+        rv = Response(
+            cls.iter_file_range(open(path, 'rb'), byte_ranges, headers,
+                                trailer),
+            206,
+            mimetype='multipart/byteranges; boundary=' + boundary,
+            direct_passthrough=True)
+        rv.content_length = sum(len(header) for header in headers) + sum(
+            stop - start for start, stop in byte_ranges) + len(trailer)
+        return rv
 
-        rv = Response(data,
-                      206,
-                      mimetype=mimetypes.guess_type(path)[0],
-                      direct_passthrough=True)
-        rv.headers.add('Content-Range',
-                       'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1,
-                                                  size))
+    @staticmethod
+    def satisfiable_ranges(ranges, size):
+        """
+        Resolve the ranges of a Range header against the size of a file.
+        :param ranges: List of (start, stop) tuples as parsed by werkzeug,
+        with a negative start for suffix ranges and an exclusive or None stop.
+        :param size: The size of the file.
+        :return: List of satisfiable (start, stop) tuples, with stop
+        exclusive, in the order of the request.
+        """
+        byte_ranges = []
+        for start, stop in ranges:
+            if start < 0:
+                start = max(size + start, 0)
+                stop = size
+            elif stop is None or stop > size:
+                stop = size
+            if start < stop:
+                byte_ranges.append((start, stop))
+        return byte_ranges
 
-        return rv
+    @staticmethod
+    def iter_file_range(f, byte_ranges, headers=None, trailer=None):
+        """
+        Read byte ranges of a file in chunks of FILE_CHUNK_SIZE, closing the
+        file once done or when the response is closed.
+        :param f: The file, opened in binary mode.
+        :param byte_ranges: List of (start, stop) tuples, stop exclusive.
+        :param headers: Optional list of bytes sent before each range.
+        :param trailer: Optional bytes sent after the last range.
+        :return: A generator of bytes.
+        """
+        try:
+            for i, (start, stop) in enumerate(byte_ranges):
+                if headers:
+                    yield headers[i]
+                f.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    data = f.read(min(FILE_CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+            if trailer:
+                yield trailer
+        finally:
+            f.close()
 
 
 class ApiBlueprint(Blueprint):
@@ -116,54 +313,159 @@ class ApiBlueprint(Blueprint):
         super(ApiBlueprint, self).__init__(*args, **kwargs)
         self.model = model
         self.configs = configs
+        self.artists_cache = caches.DocumentCache()
+        self.thumbnails = None
+        if configs.get(u'thumbnails'):
+            self.thumbnails = thumbnails.ThumbnailCache.from_config(
+                configs[u'thumbnails'])
+        self.transcoder = None
+        self.transcode_cache = None
+        if configs.get(u'transcoding'):
+            self.transcoder = transcoding.Transcoder.from_config(
+                configs[u'transcoding'])
+            self.transcode_cache = transcoding.TranscodeCache.from_config(
+                configs[u'transcoding'])
+        self.stats = None
+        self.plays = None
+        # Whether plays are counted when songs are streamed, for clients
+        # which do not scrobble, rather than when they are scrobbled
+        self.count_streams = configs.get(u'count_streams', False)
+        if configs.get(u'stats_db'):
+            self.stats = stats.PlayStats(configs[u'stats_db'])
+            self.plays = stats.PlayQueue(self.stats)
+        # The search index, built and updated in the background from the
+        # start of the server, see get_search_index
+        self.search_index = None
+        if configs.get(u'search_db'):
+            self.search_index = self._open_search_index(configs[u'search_db'])
+        self.lyrics = None
+        if configs.get(u'lyrics_db'):
+            self.lyrics = lyrics.LyricsFetcher(
+                lyrics.LyricsCache(configs[u'lyrics_db']))
+        self.playlists = None
+        if configs.get(u'playlists_db'):
+            self.playlists = playlists.PlaylistCache(configs[u'playlists_db'])
+        self.playlist_watcher = None
+        if configs.get(u'playlist_dir') and \
+                os.path.isdir(configs[u'playlist_dir']):
+            self.playlist_watcher = playlists.PlaylistWatcher(
+                configs[u'playlist_dir'], model.forget_playlist)
+        atexit.register(self.close)
 
         self._set_up_error_handlers()
         self._set_up_routes(model, configs)
 
+    def close(self):
+        """
+        Stop the threads of the blueprint, once the queued plays are written.
+        """
+        if self.plays is not None:
+            self.plays.close()
+        if self.lyrics is not None:
+            self.lyrics.close()
+        if self.playlist_watcher is not None:
+            self.playlist_watcher.close()
+
+    def _open_search_index(self, path):
+        try:
+            index = search.SearchIndex(path)
+        except sqlite3.Error as e:
+            log.warning(u'beetsonic: cannot create the search index, '
+                        u'searching the library without it: {}', e)
+            return None
+        search.keep_updated(index, self.model.update_search_index)
+        return index
+
+    def get_search_index(self):
+        """
+        Get the search index, once it is built.
+        :return: The SearchIndex, or None while it is being built, or when it
+        cannot be created, e.g. when SQLite has no FTS5, for the library to
+        be searched without it.
+        """
+        if self.search_index is None:
+            return None
+        try:
+            if self.search_index.outdated:
+                return None
+        except sqlite3.Error as e:
+            log.debug(u'beetsonic: cannot read the search index: {}', e)
+            return None
+        return self.search_index
+
     def _set_up_error_handlers(self):
         self.register_error_handler(403, self.unauthenticated)
         self.register_error_handler(404, self.data_not_found)
         self.register_error_handler(EntityNotFoundError, self.data_not_found)
 
     def _set_up_routes(self, model, configs):
+        # The responses of the routes validated by the library state are
+        # cached by the clients, see ResponseView
+        library_state = model.get_library_state
+
         @self.route('/ping.view')
         def ping(_):
             pass
 
         @self.route('/getLicense.view')
         def get_licenses(response):
-            response.license = bindings.License(valid=True)
+            response.license = utils.create_license(True)
 
-        @self.route('/getMusicFolders.view')
+        @self.route('/getMusicFolders.view', validator=library_state)
         def get_music_folders(response):
             response.musicFolders = model.get_music_folders()
 
-        @self.route('/getIndexes.view')
+        @self.route('/getIndexes.view', validator=library_state)
         def get_indexes(response):
-            if_modified_since = request.args.get('ifModifiedSince', 0)
-            last_modified = model.get_last_modified()
+            if_modified_since = request.args.get('ifModifiedSince', 0,
+                                                 type=float)
+            # Clients send back the lastModified of the indexes, which is
+            # written as an integer
+            last_modified = int(model.get_last_modified())
             if last_modified <= if_modified_since:
                 return
 
-            album_artists = model.get_album_artists()
-            indexes = utils.create_indexes(album_artists,
-                                           configs['ignoredArticles'])
-            indexes.lastModified = last_modified
+            ignored_articles = configs['ignoredArticles']
+            return_format = request.args.get('f', 'xml')
 
-            # Get items without albums
-            # TODO get singletons as part of album if possible
-            children = model.get_singletons()
-            for child in children:
-                indexes.append(child)
-            response.indexes = indexes
+            def build():
+                album_artists = model.get_album_artists(ignored_articles)
+                indexes = utils.create_indexes(album_artists, ignored_articles)
+                indexes.lastModified = last_modified
 
-        @self.route('/getArtists.view')
-        def get_artists(response):
-            album_artists = model.get_album_artists_id3()
-            response.artists = utils.create_artists(album_artists,
-                                           configs['ignoredArticles'])
+                # Get items without albums
+                # TODO get singletons as part of album if possible
+                indexes.child = model.get_singletons()
+                response.indexes = indexes
+                return ResponseView.serialize(response, return_format)
+
+            return self.artists_cache.get(
+                ('getIndexes', return_format), model.get_library_state(),
+                build)
 
-        @self.route('/getAlbumList2.view')
+        @self.route('/getArtists.view', validator=library_state)
+        def get_artists(response):
+            ignored_articles = configs['ignoredArticles']
+            return_format = request.args.get('f', 'xml')
+
+            def build():
+                album_artists = model.get_album_artists_id3(ignored_articles)
+                response.artists = utils.create_artists(album_artists,
+                                                        ignored_articles)
+                return ResponseView.serialize(response, return_format)
+
+            return self.artists_cache.get(
+                ('getArtists', return_format), model.get_library_state(),
+                build)
+
+        def album_list_state():
+            # The play statistics are not part of the library state
+            if request.args.get(u'type') in stats.ALBUM_LIST_QUERIES or \
+                    request.args.get(u'type') == 'random':
+                return None
+            return library_state()
+
+        @self.route('/getAlbumList2.view', validator=album_list_state)
         @self.require_arguments([u'type'])
         def get_album_list2(response):
             query_type = request.args.get(u'type')
@@ -192,6 +494,12 @@ class ApiBlueprint(Blueprint):
             to_year = request.args.get('toYear', None)
             genre = request.args.get('genre', None)
 
+            if self.stats is not None and \
+                    query_type in stats.ALBUM_LIST_QUERIES:
+                response.albumList2 = model.get_album_list2_from_ids(
+                    self.stats.get_album_ids(query_type, size, max(offset, 0)))
+                return
+
             response.albumList2 = model.get_album_list2(
                 query_type=query_type,
                 size=size,
@@ -211,8 +519,8 @@ class ApiBlueprint(Blueprint):
 
         @self.route('/getUsers.view')
         def get_users(response):
-            response.users = bindings.Users()
-            response.users.append(model.get_user(configs[u'username']))
+            response.users = utils.create_users(
+                [model.get_user(configs[u'username'])])
 
         @self.route('/getRandomSongs.view')
         def get_random_songs(response):
@@ -229,24 +537,63 @@ class ApiBlueprint(Blueprint):
                                                           from_year, to_year,
                                                           music_folder_id)
 
-        @self.route('/getMusicDirectory.view')
+        @self.route('/getMusicDirectory.view', validator=library_state)
         @self.require_arguments([u'id'])
         def get_music_directory(response):
             response.directory = model.get_music_directory(request.args[u'id'])
 
-        @self.route('/getSong.view')
+        @self.route('/getSong.view', validator=library_state)
         @self.require_arguments([u'id'])
         def get_song(response):
             response.song = model.get_song(request.args[u'id'])
 
+        def search_ids(index, kind):
+            count = min(max(
+                request.args.get(kind + u'Count', 20, type=int), 0), 500)
+            offset = max(request.args.get(kind + u'Offset', 0, type=int), 0)
+            if index is not None:
+                try:
+                    return index.search(kind, request.args[u'query'], count,
+                                        offset)
+                except sqlite3.Error as e:
+                    # e.g. while another process updates the index
+                    log.debug(u'beetsonic: cannot search the index, '
+                              u'searching the library without it: {}', e)
+            return model.search_library(kind, request.args[u'query'], count,
+                                        offset)
+
+        @self.route('/search2.view', validator=library_state)
+        @self.require_arguments([u'query'])
+        def search2(response):
+            if not configs.get(u'search_db'):
+                self.forbidden(response)
+                return response
+            index = self.get_search_index()
+            response.searchResult2 = utils.create_search_result2(
+                model.get_artists_from_names(search_ids(index, u'artist')),
+                model.get_albums_from_ids(search_ids(index, u'album')),
+                model.get_songs_from_ids(search_ids(index, u'song')))
+
+        @self.route('/search3.view', validator=library_state)
+        @self.require_arguments([u'query'])
+        def search3(response):
+            if not configs.get(u'search_db'):
+                self.forbidden(response)
+                return response
+            index = self.get_search_index()
+            response.searchResult3 = utils.create_search_result3(
+                model.get_artist_id3s_from_names(search_ids(index, u'artist')),
+                model.get_album_id3s_from_ids(search_ids(index, u'album')),
+                model.get_songs_from_ids(search_ids(index, u'song')))
+
         # TODO contact MusicBrainz for artist information
-        @self.route('/getArtistInfo.view')
+        @self.route('/getArtistInfo.view', validator=library_state)
         @self.require_arguments([u'id'])
         def get_artist_info(response):
             response.artistInfo = utils.create_artist_info(model.get_artist_mbid(request.args[u'id']))
 
         # TODO contact MusicBrainz for artist information
-        @self.route('/getArtistInfo2.view')
+        @self.route('/getArtistInfo2.view', validator=library_state)
         @self.require_arguments([u'id'])
         def get_artist_info2(response):
             response.artistInfo2 = utils.create_artist_info2(model.get_artist_mbid(request.args[u'id']))
@@ -259,16 +606,17 @@ class ApiBlueprint(Blueprint):
                 artist = request.args[u'artist']
             if u'title' in request.args:
                 title = request.args[u'title']
-            response.lyrics = model.get_lyrics(artist, title)
+            response.lyrics = model.get_lyrics(artist, title, self.lyrics)
 
-        @self.route('/getGenres.view')
+        @self.route('/getGenres.view', validator=library_state)
         def get_genres(response):
             response.genres = model.get_genres()
 
         @self.route('/getPlaylists.view')
         def get_playlists(response):
             response.playlists = model.get_playlists(
-                configs[u'playlist_dir'], configs[u'username'])
+                configs[u'playlist_dir'], configs[u'username'],
+                self.playlists, self.playlist_watcher)
 
         @self.route('/getPlaylist.view')
         @self.require_arguments([u'id'])
@@ -277,17 +625,18 @@ class ApiBlueprint(Blueprint):
                 response.playlist = model.get_playlist(
                     request.args.get(u'id'),
                     configs[u'playlist_dir'],
-                    configs[u'username']
+                    configs[u'username'],
+                    self.playlist_watcher
                 )
             except OSError:
                 abort(404)
 
-        @self.route('/getAlbum.view')
+        @self.route('/getAlbum.view', validator=library_state)
         @self.require_arguments([u'id'])
         def get_album(response):
             response.album = model.get_album(request.args.get(u'id'))
 
-        @self.route('/getArtist.view')
+        @self.route('/getArtist.view', validator=library_state)
         @self.require_arguments([u'id'])
         def get_artist(response):
             response.artist = model.get_artist_with_albums(
@@ -297,8 +646,7 @@ class ApiBlueprint(Blueprint):
         def get_podcasts(response):
             response.podcasts = utils.create_podcasts()
 
-        # TODO handle sizing request
-        @self.route_binary('/getCoverArt.view')
+        @self.route_binary('/getCoverArt.view', max_age=COVER_ART_MAX_AGE)
         @self.require_arguments([u'id'])
         def get_cover_art(error_response):
             object_id = request.args.get(u'id')
@@ -306,18 +654,56 @@ class ApiBlueprint(Blueprint):
             if not location:
                 self.data_not_found(error_response)
                 return error_response
+            size = request.args.get(u'size', 0, type=int)
+            if size > 0 and self.thumbnails is not None:
+                return self.thumbnails.thumbnail(location, size)
             return location
 
-        # TODO transcode the music
         @self.route_binary('/stream.view')
         @self.require_arguments([u'id'])
         def stream(error_response):
             id = request.args.get(u'id')
             try:
-                return model.get_song_location(id)
+                song = model.get_song_file(id)
             except ValueError:
                 self.data_not_found(error_response)
                 return error_response
+            if self.plays is not None and self.count_streams and \
+                    self.is_new_play():
+                self.plays.put(song.id, song.album_id)
+            if self.transcoder is None:
+                return song.path
+
+            offset = request.args.get(u'timeOffset', 0, type=int)
+            selected = self.transcoder.select(
+                song.format, song.bitrate,
+                requested_format=request.args.get(u'format'),
+                max_bitrate=request.args.get(u'maxBitRate', 0, type=int),
+                offset=offset)
+            if selected is None:
+                return song.path
+            profile, bitrate = selected
+            cache_path = None
+            if self.transcode_cache is not None and not offset:
+                cache_path = self.transcode_cache.path(song.id, song.mtime,
+                                                       profile, bitrate)
+                if self.transcode_cache.get(cache_path):
+                    return cache_path
+            try:
+                stream = self.transcoder.transcode(song.path, profile,
+                                                   bitrate, offset)
+            except transcoding.TranscoderBusyError as e:
+                # Send the song as it is, so that playback goes on at the
+                # original quality rather than failing
+                log.debug(u'beetsonic: {}, sending {} as it is', e,
+                          song.path)
+                return song.path
+            except OSError:
+                # The encoder is missing, send the song as it is
+                return song.path
+            if cache_path is not None:
+                return self.transcode_cache.wrap(stream, cache_path)
+            return stream
 
         @self.route_binary('/download.view')
         @self.require_arguments([u'id'])
@@ -329,6 +715,60 @@ class ApiBlueprint(Blueprint):
                 self.data_not_found(error_response)
                 return error_response
 
+        def star_albums(response, star_album):
+            if self.stats is None:
+                self.forbidden(response)
+                return response
+            # Only albums can be starred for now
+            try:
+                album_ids = [BeetIdType.get_type(album_id)[1]
+                             for album_id in request.args.getlist(u'albumId')]
+            except ValueError:
+                self.data_not_found(response)
+                return response
+            for album_id in album_ids:
+                star_album(album_id)
+
+        @self.route('/star.view')
+        def star(response):
+            return star_albums(response, self.stats and self.stats.star_album)
+
+        @self.route('/unstar.view')
+        def unstar(response):
+            return star_albums(response,
+                               self.stats and self.stats.unstar_album)
+
+        @self.route('/scrobble.view')
+        @self.require_arguments([u'id'])
+        def scrobble(response):
+            if self.plays is None:
+                self.forbidden(response)
+                return response
+            # "Now playing" notifications are not counted, nor are the
+            # submissions of the songs already counted when streamed
+            if self.count_streams or \
+                    request.args.get(u'submission', u'true') == u'false':
+                return
+            ids = request.args.getlist(u'id')
+            # The times of the ids, by position, in milliseconds
+            try:
+                times = [int(value) / 1000.0
+                         for value in request.args.getlist(u'time')]
+            except ValueError:
+                self.create_error_response(
+                    response, errors.GENERIC_ERROR_CODE,
+                    errors.INVALID_PARAMETER_ERROR_MSG.format(u'time'))
+                return response
+            try:
+                album_ids = [model.get_song_album_id(id) for id in ids]
+            except ValueError:
+                self.data_not_found(response)
+                return response
+            for i, id in enumerate(ids):
+                played = times[i] if i < len(times) else None
+                self.plays.put(BeetIdType.get_type(id)[1], album_ids[i],
+                               played)
+
         self.add_common_errors({
             '/createUser.view': 'create_user',
             '/updateUser.view': 'update_user',
@@ -337,10 +777,7 @@ class ApiBlueprint(Blueprint):
             '/createPlaylist.view': 'create_playlist',
             '/updatePlaylist.view': 'update_playlist',
             '/deletePlaylist.view': 'delete_playlist',
-            '/star.view': 'star',
-            '/unstar.view': 'unstar',
             '/setRating.view': 'set_rating',
-            '/scrobble.view': 'scrobble',
             '/createShare.view': 'create_share',
             '/updateShare.view': 'update_share',
             '/deleteShare.view': 'delete_share',
@@ -406,7 +843,7 @@ class ApiBlueprint(Blueprint):
     @staticmethod
     def create_error_response(response, code, message):
         response.status = bindings.ResponseStatus.failed
-        response.error = bindings.Error(code=code, message=message)
+        response.error = utils.create_error(code, message)
 
     def unauthenticated(self, response):
         self.create_error_response(
@@ -450,10 +887,13 @@ class ApiBlueprint(Blueprint):
             errors.SERVER_UPGRADE_ERROR_MSG
         )
 
-    def route(self, rule, **options):
+    def route(self, rule, validator=None, **options):
         """
         Custom route decorator for the API Blueprint
         :param rule: The URL rule for this route
+        :param validator: Function returning the LibraryState the response
+        depends on, or None, to answer conditional requests. The response
+        must then only depend on that state and the request arguments.
         :param options: The options kwargs
         :return: The decorated function
         """
@@ -462,17 +902,20 @@ class ApiBlueprint(Blueprint):
                 rule,
                 view_func=ResponseView.as_view(
                     generate_response_func.__name__,
-                    generate_response_func=generate_response_func
+                    generate_response_func=generate_response_func,
+                    validator_func=validator
                 )
             )
             return generate_response_func
 
         return decorator
 
-    def route_binary(self, rule, **options):
+    def route_binary(self, rule, max_age=None, **options):
         """
         Custom route_binary decorator for the API Blueprint
         :param rule: The URL rule for this route
+        :param max_age: The number of seconds clients may cache the files,
+        None to leave them uncached
         :param options: The options kwargs
         :return: The decorated function
         """
@@ -482,7 +925,8 @@ class ApiBlueprint(Blueprint):
                 rule,
                 view_func=BinaryView.as_view(
                     location_fn.__name__,
-                    location_fn=location_fn
+                    location_fn=location_fn,
+                    max_age=max_age
                 )
             )
             return location_fn
@@ -510,6 +954,17 @@ class ApiBlueprint(Blueprint):
 
         return decorator
 
+    @staticmethod
+    def is_new_play():
+        """
+        Whether a stream request starts playing a song, rather than resuming
+        it or fetching another part of it.
+        """
+        if request.args.get(u'timeOffset', 0, type=int):
+            return False
+        byte_range = parse_range_header(request.headers.get('Range'))
+        return byte_range is None or byte_range.ranges[0][0] == 0
+
     def register_error_handler(self, code_or_exception, f):
         """
         Override Blueprint method to use ResponseView.
@@ -548,11 +1003,14 @@ class SubsonicServer(Flask):
     def __init__(self, model, configs, *args, **kwargs):
         super(SubsonicServer, self).__init__(*args, **kwargs)
 
-        pyxb.utils.domutils.BindingDOMSupport.SetDefaultNamespace(
-            bindings.Namespace)
-
         api = ApiBlueprint(model, configs, 'api', __name__)
 
         self.register_blueprint(api, url_prefix='/rest')
         if configs['cors']:
             CORS(self, resources={r"/*": {"origins": configs['cors']}})
+
+    def close(self):
+        """
+        Stop the threads of the server, see ApiBlueprint.close.
+        """
+        self.blueprints['api'].close()
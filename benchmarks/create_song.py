@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the creation of songs from beets' Item objects against the
+projection of the SONG_COLUMNS, on an in-memory library of 10k tracks.
+
+Usage: python benchmarks/create_song.py [number of tracks]
+"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import sys
+import timeit
+
+import beets.library
+
+from beetsplug.beetsonic.models import BeetsModel
+
+TRACKS = 10000
+TRACKS_PER_ALBUM = 10
+
+
+def create_library(tracks):
+    lib = beets.library.Library(':memory:', directory='/music')
+    with lib.transaction():
+        for i in range(tracks // TRACKS_PER_ALBUM):
+            album = beets.library.Album(album='album {}'.format(i),
+                                        albumartist='artist {}'.format(i % 50),
+                                        year=2000, genre='genre')
+            lib.add(album)
+            for track in range(TRACKS_PER_ALBUM):
+                item = beets.library.Item(
+                    title='title {}'.format(track), album=album.album,
+                    artist=album.albumartist, albumartist=album.albumartist,
+                    year=2000, genre='genre', track=track + 1, length=200.0,
+                    format='FLAC', album_id=album.id,
+                    path='/music/artist/album {}/{:02d}.flac'.format(i, track))
+                # Flexible attributes, as set by many plugins
+                item['play_count'] = 1
+                item['mood'] = 'happy'
+                lib.add(item)
+    return lib
+
+
+def main(tracks):
+    lib = create_library(tracks)
+    model = BeetsModel(lib)
+    sort = lib.get_default_item_sort()
+
+    def hydrated():
+        return [model._create_song(item) for item in lib.items(sort=sort)]
+
+    def projected():
+        return model._get_songs('1')
+
+    assert [song.id for song in hydrated()] == \
+        [song.id for song in projected()]
+    print('{:<12}{:>12}{:>14}'.format('', 'total', 'per song'))
+    results = []
+    for name, func in [('Item', hydrated), ('projection', projected)]:
+        best = min(timeit.repeat(func, number=1, repeat=3))
+        results.append(best)
+        print('{:<12}{:>10.0f}ms{:>12.1f}us'.format(
+            name, best * 1000, best / tracks * 1e6))
+    print('speedup: {:.1f}x'.format(results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else TRACKS)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark utils.element_to_obj against the former reflective implementation,
+which walked _AttributeMap and _ElementMap for every node.
+
+Usage: python benchmarks/element_to_obj.py [number of runs]
+"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import sys
+import timeit
+from datetime import datetime
+
+import pyxb
+
+from beetsplug.beetsonic import bindings
+from beetsplug.beetsonic import serializers
+from beetsplug.beetsonic import utils
+
+TREE_SIZE = 500
+
+
+def reflective_element_to_obj(element, use_name=True):
+    """The element_to_obj implementation before the compiled schemas."""
+    if isinstance(element, pyxb.binding.content._PluralBinding):
+        child_elements = [reflective_element_to_obj(el, False)
+                          for el in element]
+        element_name = element._PluralBinding__elementBinding.name().localName()
+        return {element_name: child_elements}
+    elif isinstance(element, pyxb.binding.basis.complexTypeDefinition):
+        attributes = [attr.localName() for attr in element._AttributeMap.keys()]
+        attr_map = {attr: getattr(element, attr)
+                    for attr in attributes
+                    if getattr(element, attr) is not None}
+
+        child_elements = [el.localName()
+                          for el in element._ElementMap.keys()
+                          if getattr(element, el.localName()) is not None]
+        for child_element in child_elements:
+            child = getattr(element, child_element)
+            child_obj = reflective_element_to_obj(child, True)
+            if child == child_obj:
+                child_obj = {child_element: child_obj}
+            attr_map.update(child_obj)
+        if element._IsMixed():
+            content = ' '.join(
+                [c.value for c in element.orderedContent()
+                 if isinstance(c, pyxb.binding.basis.NonElementContent)])
+            attr_map.update({'value': content})
+
+        if use_name:
+            attr_map = {element._element().name().localName(): attr_map}
+        return attr_map
+    else:
+        return element
+
+
+def songs_tree():
+    response = bindings.subsonic_response(version='1.16.1', status='ok')
+    response.randomSongs = bindings.Songs()
+    for i in range(TREE_SIZE):
+        response.randomSongs.append(bindings.Child(
+            id='item:{}'.format(i), title='title {}'.format(i), isDir=False,
+            album='album', artist='artist', year=2000, genre='genre',
+            coverArt='album:1', path='some/path.flac', parent='album:1',
+            track=i, duration=200, type=bindings.MediaType.music,
+            isVideo=False, suffix='flac'))
+    return response
+
+
+def album_list2_tree():
+    response = bindings.subsonic_response(version='1.16.1', status='ok')
+    response.albumList2 = bindings.AlbumList2()
+    for i in range(TREE_SIZE):
+        response.albumList2.append(bindings.AlbumID3(
+            id='album:{}'.format(i), name='album {}'.format(i), songCount=10,
+            duration=3000, created=datetime(2017, 1, 1), artist='artist',
+            artistId='artist:artist', coverArt='album:{}'.format(i),
+            year=2000, genre='genre'))
+    return response
+
+
+def indexes_tree():
+    response = bindings.subsonic_response(version='1.16.1', status='ok')
+    indexes = bindings.Indexes(ignoredArticles='The', lastModified=0)
+    for letter in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+        index = bindings.Index(name=letter)
+        for i in range(TREE_SIZE // 26):
+            name = '{} artist {}'.format(letter, i)
+            index.append(bindings.Artist(id='artist:' + name, name=name))
+        indexes.append(index)
+    response.indexes = indexes
+    return response
+
+
+def main(number):
+    trees = [
+        ('Child ({} songs)'.format(TREE_SIZE), songs_tree()),
+        ('AlbumID3 ({} albums)'.format(TREE_SIZE), album_list2_tree()),
+        ('Indexes ({} artists)'.format(TREE_SIZE), indexes_tree()),
+    ]
+    # Compile the schemas outside of the measurements.
+    for _, tree in trees:
+        utils.element_to_obj(tree)
+    print('{:<26}{:>14}{:>14}{:>10}'.format('tree', 'reflective', 'compiled',
+                                             'speedup'))
+    for name, tree in trees:
+        old = min(timeit.repeat(lambda: reflective_element_to_obj(tree),
+                                number=number, repeat=3)) / number
+        new = min(timeit.repeat(lambda: utils.element_to_obj(tree),
+                                number=number, repeat=3)) / number
+        print('{:<26}{:>12.2f}ms{:>12.2f}ms{:>9.1f}x'.format(
+            name, old * 1000, new * 1000, old / new))
+    print('{} binding classes compiled'.format(len(serializers._schemas)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the lyrics module"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import threading
+import time
+
+import unittest2 as unittest
+from mock import MagicMock
+
+from beetsplug.beetsonic import lyrics
+
+
+class LyricsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = lyrics.LyricsCache(':memory:', found_ttl=100,
+                                        missing_ttl=10)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get(self):
+        self.assertEqual((False, None), self.cache.get(u'Artist', u'Title'))
+        self.cache.put(u'Artist', u'Title', u'la la')
+        self.assertEqual((True, u'la la'),
+                         self.cache.get(u' artist', u'TITLE'))
+        self.cache.put(u'Artist', u'Other', None)
+        self.assertEqual((True, None), self.cache.get(u'Artist', u'Other'))
+
+    def test_expired(self):
+        now = time.time()
+        self.cache.put(u'Artist', u'Title', u'la la', now - 50)
+        self.cache.put(u'Artist', u'Other', None, now - 50)
+        self.assertEqual((True, u'la la'), self.cache.get(u'Artist', u'Title'))
+        # Songs without lyrics expire sooner
+        self.assertEqual((False, None), self.cache.get(u'Artist', u'Other'))
+
+
+class LyricsFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = lyrics.LyricsCache(':memory:')
+        self.fetch = MagicMock(return_value=u'la la')
+        self.fetcher = lyrics.LyricsFetcher(self.cache, self.fetch, timeout=5)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.cache.close()
+
+    def test_get(self):
+        self.assertEqual(u'la la', self.fetcher.get(u'Artist', u'Title'))
+        self.assertEqual(u'la la', self.fetcher.get(u'Artist', u'Title'))
+        self.fetch.assert_called_once_with(u'Artist', u'Title')
+
+    def test_missing(self):
+        self.fetch.return_value = None
+        self.assertIsNone(self.fetcher.get(u'Artist', u'Title'))
+        self.assertIsNone(self.fetcher.get(u'Artist', u'Title'))
+        self.fetch.assert_called_once_with(u'Artist', u'Title')
+
+    def test_error(self):
+        self.fetch.side_effect = [IOError('unreachable'), u'la la']
+        self.assertIsNone(self.fetcher.get(u'Artist', u'Title'))
+        # Failed lookups are tried again
+        self.assertEqual(u'la la', self.fetcher.get(u'Artist', u'Title'))
+
+    def test_timeout(self):
+        release = threading.Event()
+
+        def fetch(artist, title):
+            release.wait()
+            return u'la la'
+
+        self.fetcher.fetch = fetch
+        self.fetcher.timeout = 0.01
+        self.assertIsNone(self.fetcher.get(u'Artist', u'Title'))
+        # The lookup goes on in the background, for the next requests
+        release.set()
+        self.fetcher.timeout = 5
+        self.assertEqual(u'la la', self.fetcher.get(u'Artist', u'Title'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,13 +10,25 @@ from __future__ import (
     unicode_literals,
 )
 
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
 from datetime import datetime
 
 import beets
 import unittest2 as unittest
 from beets.library import Item
+from mock import MagicMock, patch
 
-from beetsplug.beetsonic.models import BeetsModel, BeetIdType
+from beetsplug.beetsonic import serializers
+from beetsplug.beetsonic import utils
+from beetsplug.beetsonic.playlists import PlaylistCache, PlaylistWatcher
+from beetsplug.beetsonic.search import SearchIndex
+from beetsplug.beetsonic.utils import M3uEntry
+from beetsplug.beetsonic.models import BeetsModel, BeetIdType, \
+    EntityNotFoundError
 
 # Dummy item creation.
 _item_ident = 0
@@ -137,4 +149,433 @@ class BeetsModelTest(unittest.TestCase):
         self.assertEqual(artist_id, artist.id)
         self.assertEqual(another.albumartist, artist.name)
         self.assertEqual(artist_id, artist.coverArt)
-        self.assertEqual(2, len(artist.orderedContent()))
+        self.assertEqual(2, len(artist.album))
+
+    def test_get_artist_with_albums_exact_match(self):
+        another = album()
+        another.albumartist = 'some album artist and friends'
+        self.lib.add(another)
+
+        artist_id = BeetIdType.get_artist_id(self.a.albumartist)
+        artist = self.model.get_artist_with_albums(artist_id)
+        self.assertEqual(1, len(artist.album))
+        self.assertEqual(1, artist.album[0].songCount)
+        self.assertEqual(BeetIdType.get_album_id(self.a.id),
+                         artist.album[0].id)
+
+        with self.assertRaises(EntityNotFoundError):
+            self.model.get_artist_with_albums(
+                BeetIdType.get_artist_id('some album'))
+
+    def test_get_album_artists(self):
+        for name in [u'The Zombies', u'abba', u'Les Rita']:
+            another = album()
+            another.albumartist = name
+            self.lib.add(another)
+
+        artists = self.model.get_album_artists(u'The La Les')
+        self.assertEqual([u'abba', u'Les Rita', u'some album artist',
+                          u'The Zombies'],
+                         [artist.name for artist in artists])
+
+    def test_get_singletons(self):
+        singleton = item(self.lib)
+        songs = list(self.model.get_singletons())
+        self.assertEqual(1, len(songs))
+        self.assertEqual(BeetIdType.get_item_id(singleton.id), songs[0].id)
+        self.assertEqual(singleton.title, songs[0].title)
+        self.assertEqual(60, songs[0].duration)
+
+    def test_indexes_with_singletons(self):
+        singleton = item(self.lib)
+        response = utils.create_subsonic_response('1.16.1')
+        indexes = utils.create_indexes(self.model.get_album_artists(), u'')
+        indexes.child = self.model.get_singletons()
+        response.indexes = indexes
+        document = serializers.to_xml(response)
+        self.assertIn('id="{}"'.format(
+            BeetIdType.get_item_id(singleton.id)).encode('utf-8'), document)
+
+    def test_get_music_directory(self):
+        album_id = BeetIdType.get_album_id(self.a.id)
+        directory = self.model.get_music_directory(album_id)
+        self.assertEqual(self.a.album, directory.name)
+        self.assertEqual(BeetIdType.get_artist_id(self.a.albumartist),
+                         directory.parent)
+        songs = list(directory.child)
+        self.assertEqual(1, len(songs))
+        self.assertEqual(BeetIdType.get_item_id(self.i.id), songs[0].id)
+        self.assertEqual(album_id, songs[0].parent)
+        self.assertTrue(songs[0].path.startswith('somepath'))
+
+        item_id = BeetIdType.get_item_id(self.i.id)
+        directory = self.model.get_music_directory(item_id)
+        self.assertEqual(self.i.title, directory.name)
+        self.assertEqual(album_id, directory.parent)
+
+    def test_get_song(self):
+        song = self.model.get_song(BeetIdType.get_item_id(self.i.id))
+        self.assertEqual(self.i.title, song.title)
+        self.assertEqual('flac', song.suffix)
+        with self.assertRaises(EntityNotFoundError):
+            self.model.get_song(BeetIdType.get_item_id(self.i.id + 1))
+
+    def test_get_lyrics(self):
+        fetcher = MagicMock()
+        fetcher.get.return_value = u'fetched lyrics'
+        lyrics = self.model.get_lyrics(u'The Artist', u'the title', fetcher)
+        self.assertEqual(u'the lyrics', lyrics._content)
+        self.assertFalse(fetcher.get.called)
+
+        lyrics = self.model.get_lyrics(u'the artist', u'other', fetcher)
+        self.assertEqual(u'fetched lyrics', lyrics._content)
+        fetcher.get.assert_called_once_with(u'the artist', u'other')
+        self.assertFalse(
+            self.model.get_lyrics(u'the artist', u'other')._content)
+
+    def test_get_lyrics_unicode(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        lib = beets.library.Library(os.path.join(directory, 'library.db'))
+        self.addCleanup(lib._connection().close)
+        song = item()
+        song.artist = u'Sigur Rós'
+        song.title = u'Hoppípolla'
+        song.lyrics = u'Brosandi, hendumst í hringi'
+        lib.add(song)
+        lyrics = BeetsModel(lib).get_lyrics(u'sigur rós', u'Hoppípolla')
+        self.assertEqual(song.lyrics, lyrics._content)
+        self.assertEqual(u'sigur rós', lyrics.artist)
+
+    def test_get_random_songs(self):
+        another = item()
+        another.genre = u'other genre'
+        self.lib.add(another)
+
+        songs = list(self.model.get_random_songs(size=10).song)
+        self.assertEqual(2, len(songs))
+        songs = list(self.model.get_random_songs(genre=u'other').song)
+        self.assertEqual([BeetIdType.get_item_id(another.id)],
+                         [song.id for song in songs])
+
+        for year in range(2000, 2020):
+            song = item()
+            song.year = year
+            self.lib.add(song)
+        songs = list(self.model.get_random_songs(size=5).song)
+        self.assertEqual(5, len(set(song.id for song in songs)))
+        songs = list(self.model.get_random_songs(
+            size=10, from_year=u'2010', to_year=u'2011').song)
+        self.assertEqual([2010, 2011], sorted(song.year for song in songs))
+
+        # The ids are looked up by batches, below SQLite's parameter limit
+        with patch('beetsplug.beetsonic.models.PLAYLIST_BATCH_SIZE', 3), \
+                patch.object(self.model, '_query',
+                             wraps=self.model._query) as query:
+            songs = list(self.model.get_random_songs(size=10).song)
+        self.assertEqual(10, len(set(song.id for song in songs)))
+        self.assertLessEqual(max(len(call[0][1]) for call in
+                                 query.call_args_list), 3)
+
+    def test_get_album_list2(self):
+        for name in [u'b', u'c', u'a', u'd']:
+            another = album()
+            another.album = name
+            self.lib.add(another)
+        self.model.create_indexes()
+
+        def names(albums):
+            return [album.name for album in albums.album]
+
+        albums = self.model.get_album_list2('alphabeticalByName', 2, 0,
+                                            None, None, None)
+        self.assertEqual([u'a', u'b'], names(albums))
+        albums = self.model.get_album_list2('alphabeticalByName', 2, 2,
+                                            None, None, None)
+        self.assertEqual([u'c', u'd'], names(albums))
+        albums = self.model.get_album_list2('alphabeticalByName', 10, 4,
+                                            None, None, None)
+        self.assertEqual([u'the album'], names(albums))
+        self.assertEqual(1, albums.album[0].songCount)
+        self.assertEqual(60, albums.album[0].duration)
+
+    def test_get_album_list2_random(self):
+        for _ in range(10):
+            self.lib.add(album())
+        another = album()
+        another.genre = u'other genre'
+        self.lib.add(another)
+
+        albums = self.model.get_album_list2('random', 5, 0, None, None, None)
+        # Not named album, which would hide the function on Python 2
+        ids = [album_id3.id for album_id3 in albums.album]
+        self.assertEqual(5, len(ids))
+        self.assertEqual(5, len(set(ids)))
+        albums = self.model.get_album_list2('random', 20, 0, None, None, None)
+        self.assertEqual(12, len(albums.album))
+        albums = self.model.get_album_list2('random', 5, 0, None, None,
+                                            u'other genre')
+        self.assertEqual([BeetIdType.get_album_id(another.id)],
+                         [album_id3.id for album_id3 in albums.album])
+
+        # The ids are looked up by batches, below SQLite's parameter limit
+        with patch('beetsplug.beetsonic.models.PLAYLIST_BATCH_SIZE', 3), \
+                patch.object(self.model, '_query',
+                             wraps=self.model._query) as query:
+            albums = self.model.get_album_list2('random', 10, 0, None, None,
+                                                None)
+        self.assertEqual(10, len(albums.album))
+        self.assertLessEqual(max(len(call[0][1]) for call in
+                                 query.call_args_list), 3)
+
+    def test_get_from_ids(self):
+        another = item(self.lib)
+        songs = self.model.get_songs_from_ids([another.id, 1000, self.i.id])
+        self.assertEqual([BeetIdType.get_item_id(another.id),
+                          BeetIdType.get_item_id(self.i.id)],
+                         [song.id for song in songs])
+        artists = self.model.get_artist_id3s_from_names(
+            [u'unknown', self.a.albumartist])
+        self.assertEqual([self.a.albumartist], [a.name for a in artists])
+        self.assertEqual(1, artists[0].albumCount)
+        albums = self.model.get_albums_from_ids([self.a.id])
+        self.assertEqual([self.a.album], [a.title for a in albums])
+
+        # The ids are looked up by batches, below SQLite's parameter limit
+        another_album = album(self.lib)
+        another_album.albumartist = u'another artist'
+        another_album.store()
+        with patch('beetsplug.beetsonic.models.PLAYLIST_BATCH_SIZE', 1), \
+                patch.object(self.model, '_query',
+                             wraps=self.model._query) as query:
+            albums = self.model.get_albums_from_ids(
+                [another_album.id, self.a.id])
+            artists = self.model.get_artist_id3s_from_names(
+                [another_album.albumartist, self.a.albumartist])
+        self.assertEqual([BeetIdType.get_album_id(another_album.id),
+                          BeetIdType.get_album_id(self.a.id)],
+                         [a.id for a in albums])
+        self.assertEqual([another_album.albumartist, self.a.albumartist],
+                         [a.name for a in artists])
+        self.assertEqual(4, query.call_count)
+        self.assertEqual(1, max(len(call[0][1]) for call in
+                                query.call_args_list))
+
+    def test_get_library_state(self):
+        state = self.model.get_library_state()
+        self.assertEqual(state, self.model.get_library_state())
+        self.assertEqual(state.last_modified, self.model.get_last_modified())
+
+        self.model.invalidate()
+        new_state = self.model.get_library_state()
+        self.assertNotEqual(state.generation, new_state.generation)
+        self.assertGreaterEqual(new_state.last_modified, state.last_modified)
+
+    def test_library_state_commits(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        lib = beets.library.Library(os.path.join(directory, 'library.db'))
+        self.addCleanup(lib._connection().close)
+        song = item(lib)
+        model = BeetsModel(lib)
+        state = model.get_library_state()
+        self.assertEqual(song.added, state.last_modified)
+        self.assertEqual(state, model.get_library_state())
+
+        # Every commit of the library starts a new generation, including
+        # those which change no dates
+        song.title = u'other title'
+        song.store()
+        new_state = model.get_library_state()
+        self.assertNotEqual(state.generation, new_state.generation)
+        self.assertGreater(new_state.last_modified, state.last_modified)
+        self.assertEqual(new_state, model.get_library_state())
+
+    def test_read_connections(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        lib = beets.library.Library(os.path.join(directory, 'library.db'))
+        song = item(lib)
+        model = BeetsModel(lib)
+        self.assertEqual(song.id, model._query('SELECT id FROM items')[0][0])
+        with self.assertRaises(sqlite3.OperationalError):
+            model._query('DELETE FROM items')
+
+        # Each thread reads through its own connection
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(model._connections.get()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(model._connections.get(), connections[0])
+        self.assertIs(model._connections.get(), model._connections.get())
+
+        # Changes written by the library are seen
+        item(lib)
+        self.assertEqual(2, model._query('SELECT COUNT(1) FROM items')[0][0])
+        lib._connection().close()
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc')
+    def test_read_connections_closed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'library.db')
+        lib = beets.library.Library(path)
+        self.addCleanup(lib._connection().close)
+        item(lib)
+        model = BeetsModel(lib)
+
+        def open_files():
+            return sum(1 for fd in os.listdir('/proc/self/fd')
+                       if os.path.realpath(os.path.join('/proc/self/fd', fd))
+                       .startswith(os.path.realpath(path)))
+
+        model.get_library_state()
+        before = open_files()
+        for _ in range(20):
+            thread = threading.Thread(target=model.get_library_state)
+            thread.start()
+            thread.join()
+        # The connections of the threads are closed once they end, though
+        # SQLite keeps a few of their files open for the next connections
+        self.assertLess(open_files(), before + 10)
+
+    def test_get_playlist(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        first, second, third = item(), item(), item()
+        first.path = os.path.join(directory, u'first.mp3')
+        second.path = os.path.join(directory, u'second.mp3')
+        third.path = os.path.join(directory, u'third.mp3')
+        third.length = 0
+        for song in [first, second, third]:
+            self.lib.add(song)
+        self.model.basedir = directory
+        m3u = os.path.join(directory, u'list.m3u')
+        with open(m3u, 'wb') as f:
+            f.write(b'\xef\xbb\xbf#EXTM3U\r\n'
+                    b'#EXTINF:120,Second\r\nsecond.mp3\r\n'
+                    b'missing.mp3\r\n\r\n'
+                    b'#EXTINF:-1,First\r\n./first.mp3\r\n'
+                    b'file://' + directory.encode('utf-8') +
+                    b'/second.mp3\r\n'
+                    b'http://example.com/stream.mp3\r\n'
+                    b'#EXTINF:30 tvg-id="3",Third\r\nthird.mp3')
+
+        with patch('beetsplug.beetsonic.utils.parse_m3u',
+                   wraps=utils.parse_m3u) as parse_m3u:
+            with patch('beetsplug.beetsonic.models.PLAYLIST_BATCH_SIZE', 2):
+                playlist = self.model.get_playlist(
+                    BeetIdType.get_playlist_id(u'list.m3u'), directory,
+                    u'user')
+                songs = list(playlist.entry)
+            self.assertEqual([BeetIdType.get_item_id(song.id)
+                              for song in [second, first, second, third]],
+                             [song.id for song in songs])
+            self.assertEqual(4, playlist.songCount)
+            # The songs without a length count for their #EXTINF duration
+            self.assertEqual(210, playlist.duration)
+
+            # The songs are only looked up again once the m3u file changes
+            self.model.get_playlist(BeetIdType.get_playlist_id(u'list.m3u'),
+                                    directory, u'user')
+            self.assertEqual(1, parse_m3u.call_count)
+            os.utime(m3u, (0, 0))
+            self.model.get_playlist(BeetIdType.get_playlist_id(u'list.m3u'),
+                                    directory, u'user')
+            self.assertEqual(2, parse_m3u.call_count)
+
+    def test_get_watched_playlist(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        open(os.path.join(directory, u'list.m3u'), 'w').close()
+        watcher = PlaylistWatcher(directory, use_inotify=False)
+        self.addCleanup(watcher.close)
+
+        playlist = self.model.get_playlist(
+            BeetIdType.get_playlist_id(u'list.m3u'), directory, u'user',
+            watcher)
+        self.assertEqual(u'list', playlist.name)
+        # Like a missing file when the directory is not watched
+        with self.assertRaises(OSError):
+            self.model.get_playlist(BeetIdType.get_playlist_id(u'other.m3u'),
+                                    directory, u'user', watcher)
+
+    def test_get_playlist_unicode(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        lib = beets.library.Library(os.path.join(directory, 'library.db'),
+                                    directory)
+        self.addCleanup(lib._connection().close)
+        song = item()
+        song.path = os.path.join(directory, u'Hoppípolla.mp3')
+        lib.add(song)
+        with open(os.path.join(directory, u'list.m3u8'), 'wb') as f:
+            f.write(u'#EXTM3U\nHoppípolla.mp3\n'.encode('utf-8'))
+
+        playlist = BeetsModel(lib).get_playlist(
+            BeetIdType.get_playlist_id(u'list.m3u8'), directory, u'user')
+        self.assertEqual([BeetIdType.get_item_id(song.id)],
+                         [entry.id for entry in playlist.entry])
+
+    def test_get_playlists(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.i.path = os.path.join(directory, u'song.mp3')
+        self.i.store()
+        for name in [u'b.m3u', u'a.m3u8']:
+            open(os.path.join(directory, name), 'w').close()
+        cache = PlaylistCache(':memory:')
+        self.addCleanup(cache.close)
+
+        entries = [M3uEntry(self.i.path, None, None)]
+        with patch('beetsplug.beetsonic.utils.parse_m3u',
+                   return_value=entries) as parse_m3u:
+            playlists = self.model.get_playlists(directory, u'user', cache)
+            self.assertEqual([u'a', u'b'],
+                             [playlist.name for playlist in playlists.playlist])
+            self.assertEqual([1, 1], [playlist.songCount
+                                      for playlist in playlists.playlist])
+            self.assertEqual(2, parse_m3u.call_count)
+
+            # Only the changed playlists are matched again
+            self.model.get_playlists(directory, u'user', cache)
+            self.assertEqual(2, parse_m3u.call_count)
+            os.utime(os.path.join(directory, u'b.m3u'), (0, 0))
+            self.model.get_playlists(directory, u'user', cache)
+            self.assertEqual(3, parse_m3u.call_count)
+
+            def song_counts():
+                self.model.invalidate()
+                playlists = self.model.get_playlists(directory, u'user',
+                                                     cache)
+                return [playlist.songCount
+                        for playlist in playlists.playlist]
+
+            # Nor after a restart, or when the songs did not change
+            self.model = BeetsModel(self.lib)
+            self.assertEqual([1, 1], song_counts())
+            self.assertEqual(3, parse_m3u.call_count)
+            # Songs added or removed are summed from the ids of the songs
+            item(self.lib)
+            self.assertEqual([1, 1], song_counts())
+            self.i.remove()
+            self.assertEqual([0, 0], song_counts())
+            self.assertEqual(3, parse_m3u.call_count)
+            # Until songs are missing, and may have been added
+            song = item()
+            song.path = self.i.path
+            self.lib.add(song)
+            self.assertEqual([1, 1], song_counts())
+            self.assertEqual(5, parse_m3u.call_count)
+
+    def test_update_search_index(self):
+        index = SearchIndex(':memory:')
+        self.addCleanup(index.close)
+        self.i.title = u'Because'
+        self.i.store()
+        # Read through the connection of the thread, without beets' lock
+        with patch.object(self.lib, 'transaction') as transaction:
+            self.model.update_search_index(index)
+        self.assertFalse(transaction.called)
+        self.assertEqual([self.i.id], index.search('song', u'because', 10))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the playlists module"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import unittest2 as unittest
+from mock import MagicMock
+
+from beetsplug.beetsonic import playlists
+
+
+class PlaylistCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = playlists.PlaylistCache(':memory:')
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get(self):
+        playlist = playlists.CachedPlaylist(u'1-1-0.0', [(1, 60), (2, 0)], 1,
+                                            2, 180.0)
+        self.assertIsNone(self.cache.get(u'/a.m3u', 10))
+        self.cache.put(u'/a.m3u', 10, playlist)
+        self.assertEqual(playlist, self.cache.get(u'/a.m3u', 10))
+        # Changed playlists are matched again
+        self.assertIsNone(self.cache.get(u'/a.m3u', 20))
+        self.cache.put(u'/a.m3u', 20, playlist._replace(song_count=1))
+        self.assertEqual(1, self.cache.get(u'/a.m3u', 20).song_count)
+
+    def test_prune(self):
+        playlist = playlists.CachedPlaylist(u'1-1-0.0', [(1, 60)], 0, 1, 60.0)
+        self.cache.put(u'/a.m3u', 10, playlist)
+        self.cache.put(u'/b.m3u', 10, playlist)
+        self.cache.prune([u'/b.m3u'])
+        self.assertIsNone(self.cache.get(u'/a.m3u', 10))
+        self.assertEqual(playlist, self.cache.get(u'/b.m3u', 10))
+
+    def test_old_schema(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'playlists.db')
+        connection = sqlite3.connect(path)
+        connection.executescript(
+            'CREATE TABLE playlists (location TEXT PRIMARY KEY, mtime REAL, '
+            'library_generation TEXT, song_count INTEGER, duration REAL);'
+            "INSERT INTO playlists VALUES ('/a.m3u', 10, '1-1', 3, 180.0);"
+            'PRAGMA user_version=1;')
+        connection.close()
+        cache = playlists.PlaylistCache(path)
+        self.addCleanup(cache.close)
+        self.assertIsNone(cache.get(u'/a.m3u', 10))
+        playlist = playlists.CachedPlaylist(u'1-1-0.0', [(1, 60)], 0, 1, 60.0)
+        cache.put(u'/a.m3u', 10, playlist)
+        self.assertEqual(playlist, cache.get(u'/a.m3u', 10))
+
+
+class PlaylistWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.first = os.path.join(self.directory, u'first.m3u')
+        open(self.first, 'w').close()
+        open(os.path.join(self.directory, u'notes.txt'), 'w').close()
+        self.on_change = MagicMock()
+        self.watcher = playlists.PlaylistWatcher(
+            self.directory, self.on_change, interval=60, use_inotify=False)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.directory)
+
+    def test_refresh(self):
+        self.assertEqual(u'polling', self.watcher.backend)
+        self.assertEqual([self.first], list(self.watcher.playlists))
+        self.watcher.refresh()
+        self.assertFalse(self.on_change.called)
+
+        second = os.path.join(self.directory, u'second.m3u8')
+        open(second, 'w').close()
+        os.utime(self.first, (0, 0))
+        self.watcher.refresh()
+        self.assertEqual({self.first: 0, second: os.path.getmtime(second)},
+                         self.watcher.playlists)
+        self.assertEqual(sorted([self.first, second]),
+                         sorted(call[0][0] for call
+                                in self.on_change.call_args_list))
+
+        os.remove(second)
+        self.on_change.reset_mock()
+        self.watcher.refresh()
+        self.on_change.assert_called_once_with(second)
+        self.assertEqual([self.first], list(self.watcher.playlists))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the beets plugin"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import beets
+import unittest2 as unittest
+from beets import config
+from mock import patch
+
+from beetsplug.beetsonic import BeetsonicPlugin
+from beetsplug.beetsonic import search
+from test.test_models import album, item
+
+
+class BeetsonicPluginTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.search_db = os.path.join(self.dir, 'search.db')
+        config.clear()
+        config.read(user=False, defaults=True)
+        config['beetsonic']['search_db'] = self.search_db
+        self.plugin = BeetsonicPlugin()
+        self.lib = beets.library.Library(':memory:')
+        self.album = album()
+        self.album.album = u'Abbey Road'
+        self.lib.add(self.album)
+        self.song = item()
+        self.song.title = u'Something'
+        self.song.album_id = self.album.id
+        self.lib.add(self.song)
+
+    def tearDown(self):
+        self.lib._connection().close()
+        shutil.rmtree(self.dir)
+        config.clear()
+        config.read(user=False, defaults=True)
+
+    def query(self, sql, params=()):
+        with self.lib.transaction() as tx:
+            return tx.query(sql, params)
+
+    def send(self, event, **arguments):
+        """Send an event to the listeners of the plugin, like beets does."""
+        cls = type(self.plugin)
+        for func, listener in zip(cls._raw_listeners[event],
+                                  cls.listeners[event]):
+            if func.__self__ is self.plugin:
+                listener(**arguments)
+
+    def create_index(self):
+        index = search.SearchIndex(self.search_db)
+        self.addCleanup(index.close)
+        index.update(self.query)
+        return index
+
+    def test_changes(self):
+        index = self.create_index()
+        changed = self.song
+        changed.title = u'Octopus\'s Garden'
+        changed.store()
+        self.send('database_change', lib=self.lib, model=changed)
+        another = album()
+        another.album = u'Let It Be'
+        self.lib.add(another)
+        imported = item()
+        imported.title = u'Across the Universe'
+        imported.album_id = another.id
+        self.lib.add(imported)
+        self.send('album_imported', lib=self.lib, album=another)
+        singleton = item()
+        singleton.title = u'Because'
+        self.lib.add(singleton)
+        self.send('item_imported', lib=self.lib, item=singleton)
+        self.send('item_removed', item=singleton)
+        singleton.remove()
+
+        # Marked in the index when the command exits
+        self.assertFalse(index._has_dirty())
+        self.send('cli_exit', lib=self.lib)
+        self.assertTrue(index._has_dirty())
+        self.assertEqual(set(), self.plugin.dirty_items)
+        index.update(self.query)
+        self.assertEqual([changed.id], index.search('song', u'octopus', 10))
+        self.assertEqual([imported.id], index.search('song', u'universe', 10))
+        self.assertEqual([another.id], index.search('album', u'let', 10))
+        self.assertEqual([], index.search('song', u'because', 10))
+
+    def test_cli_exit_without_index(self):
+        self.send('item_imported', lib=self.lib, item=self.song)
+        self.send('cli_exit', lib=self.lib)
+        # The index is built by the server from the whole library
+        self.assertFalse(os.path.exists(self.search_db))
+        self.assertEqual(set(), self.plugin.dirty_items)
+
+    def test_cli_exit_locked(self):
+        self.create_index()
+        self.send('item_imported', lib=self.lib, item=self.song)
+        with patch.object(search.SearchIndex, 'mark_dirty',
+                          side_effect=sqlite3.OperationalError(
+                              'database is locked')):
+            # Logged rather than failing the command
+            self.send('cli_exit', lib=self.lib)
+        self.assertEqual(set(), self.plugin.dirty_items)
+
+
+if __name__ == '__main__':
+    unittest.main()
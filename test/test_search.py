@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the search module"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import os
+import shutil
+import tempfile
+import time
+
+import beets
+import unittest2 as unittest
+from mock import Mock
+
+from beetsplug.beetsonic import search
+from test.test_models import album, item
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.lib = beets.library.Library(':memory:')
+        self.album = album()
+        self.album.album = u'Abbey Road'
+        self.album.albumartist = u'The Beatles'
+        self.lib.add(self.album)
+        self.songs = []
+        for title in [u'Come Together', u'Something', u'Here Comes the Sun']:
+            song = item()
+            song.title = title
+            song.album_id = self.album.id
+            self.lib.add(song)
+            self.songs.append(song)
+        self.index = search.SearchIndex(':memory:')
+        self.index.update(self.query)
+
+    def tearDown(self):
+        self.index.close()
+        self.lib._connection().close()
+
+    def query(self, sql, params=()):
+        with self.lib.transaction() as tx:
+            return tx.query(sql, params)
+
+    def test_match_expression(self):
+        self.assertEqual(u'"Come"* "to"*',
+                         search.match_expression(u'Come to"'))
+        self.assertIsNone(search.match_expression(u'""'))
+        self.assertIsNone(search.match_expression(None))
+
+    def test_search(self):
+        self.assertEqual([u'The Beatles'],
+                         self.index.search('artist', u'beat', 10))
+        self.assertEqual([self.album.id],
+                         self.index.search('album', u'abb beatles', 10))
+        self.assertEqual([], self.index.search('album', u'something', 10))
+        self.assertEqual(sorted([self.songs[0].id, self.songs[2].id]),
+                         sorted(self.index.search('song', u'come', 10)))
+        self.assertEqual(1, len(self.index.search('song', u'come', 1, 1)))
+
+    def test_empty_query(self):
+        ids = [song.id for song in self.songs]
+        self.assertEqual(ids, self.index.search('song', u'', 10))
+        self.assertEqual(ids[1:], self.index.search('song', u'""', 10, 1))
+
+    def test_like_search(self):
+        self.assertEqual([u'The Beatles'],
+                         search.like_search(self.query, 'artist', u'beat', 10))
+        self.assertEqual([self.album.id], search.like_search(
+            self.query, 'album', u'abb beatles', 10))
+        self.assertEqual([], search.like_search(
+            self.query, 'album', u'something', 10))
+        self.assertEqual([self.songs[0].id, self.songs[2].id],
+                         search.like_search(self.query, 'song', u'come', 10))
+        self.assertEqual([self.songs[2].id], search.like_search(
+            self.query, 'song', u'come', 10, 1))
+        # Underscores are not wildcards
+        self.assertEqual([], search.like_search(
+            self.query, 'song', u'come_together', 10))
+        self.assertEqual(3, len(search.like_search(
+            self.query, 'song', u'', 10)))
+
+    def test_update(self):
+        changed, removed = self.songs[0], self.songs[1]
+        changed.title = u'Octopus\'s Garden'
+        changed.store()
+        removed.remove()
+        another = album()
+        another.albumartist = u'Rolling Stones'
+        self.lib.add(another)
+
+        # Tags edited without writing the files are only indexed again once
+        # marked dirty
+        self.index.update(self.query)
+        self.assertEqual([], self.index.search('song', u'octopus', 10))
+        self.index.mark_dirty([changed.id, removed.id], [another.id])
+        self.index.update(self.query)
+        self.assertEqual([changed.id],
+                         self.index.search('song', u'octopus', 10))
+        self.assertEqual([], self.index.search('song', u'something', 10))
+        self.assertEqual([u'Rolling Stones'],
+                         self.index.search('artist', u'roll', 10))
+
+        another.remove()
+        self.index.mark_dirty(album_ids=[another.id])
+        self.index.update(self.query)
+        self.assertEqual([], self.index.search('artist', u'roll', 10))
+        self.assertEqual([u'The Beatles'],
+                         self.index.search('artist', u'', 10))
+
+        # Unchanged library states are not read again...
+        self.index.update(self.query, 'state')
+        query = Mock(side_effect=self.query)
+        self.index.update(query, 'state')
+        self.assertFalse(query.called)
+        # ...unless changes were marked after the state was seen
+        self.index.mark_dirty([item(self.lib).id])
+        self.index.update(self.query, 'state')
+        self.assertEqual(3, len(self.index.search('song', u'', 10)))
+
+    def test_rebuild(self):
+        self.assertFalse(self.index.outdated)
+        song = self.songs[0]
+        song.title = u'Because'
+        song.store()
+        self.index.update(self.query)
+        self.assertEqual([], self.index.search('song', u'because', 10))
+
+        # Indexes of another version are built again
+        with self.index._connection as connection:
+            connection.execute('PRAGMA user_version=0')
+        self.assertTrue(self.index.outdated)
+        self.index.update(self.query)
+        self.assertEqual([song.id], self.index.search('song', u'because', 10))
+        self.assertFalse(self.index.outdated)
+
+    def test_reconcile(self):
+        # Changed by processes without the plugin
+        written, removed = self.songs[0], self.songs[1]
+        written.title = u'Octopus\'s Garden'
+        written.mtime = 1500000000
+        written.store()
+        removed.remove()
+        another = album()
+        another.album = u'Let It Be'
+        another.albumartist = u'The Rolling Stones'
+        self.lib.add(another)
+        added = item()
+        added.title = u'Across the Universe'
+        added.album_id = another.id
+        self.lib.add(added)
+
+        self.index.update(self.query)
+        self.assertEqual([written.id],
+                         self.index.search('song', u'octopus', 10))
+        self.assertEqual([], self.index.search('song', u'something', 10))
+        self.assertEqual([added.id],
+                         self.index.search('song', u'universe', 10))
+        self.assertEqual([another.id], self.index.search('album', u'let', 10))
+
+        # Removed along with an album added, in the same update
+        another.remove(with_items=True)
+        newer = album()
+        newer.album = u'Help!'
+        newer.albumartist = u'The Beatles'
+        self.lib.add(newer)
+        self.index.update(self.query)
+        self.assertEqual([], self.index.search('song', u'universe', 10))
+        self.assertEqual([], self.index.search('album', u'let', 10))
+        self.assertEqual([], self.index.search('artist', u'roll', 10))
+        self.assertEqual([newer.id], self.index.search('album', u'help', 10))
+
+        # Nothing is read again without changes
+        self.assertEqual([written.id],
+                         self.index.search('song', u'octopus', 10))
+        query = Mock(side_effect=self.query)
+        self.index.update(query)
+        self.assertFalse(any('WHERE id IN' in call[0][0]
+                             for call in query.call_args_list))
+
+
+class KeepUpdatedTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = search.SearchIndex(os.path.join(self.dir, 'search.db'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def test_lock_file(self):
+        path = os.path.join(self.dir, 'search.db.lock')
+        lock = search.lock_file(path)
+        self.assertIsNotNone(lock)
+        self.assertIsNone(search.lock_file(path))
+        lock.close()
+        search.lock_file(path).close()
+
+    def test_single_process(self):
+        # Held by another process
+        lock = search.lock_file(self.index.path + '.lock')
+        update = Mock()
+        search.keep_updated(self.index, update, 0.01)
+        time.sleep(0.1)
+        self.assertFalse(update.called)
+
+        # Taken over once released
+        lock.close()
+        time.sleep(0.1)
+        update.assert_called_with(self.index)
+
+
+if __name__ == '__main__':
+    unittest.main()
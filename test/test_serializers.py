@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the serializers module"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import json
+from datetime import datetime
+
+import pyxb.utils.domutils
+import unittest2 as unittest
+
+from beetsplug.beetsonic import bindings
+from beetsplug.beetsonic import serializers
+from beetsplug.beetsonic import utils
+
+
+def song(item_id, **kwargs):
+    return utils.create_song(
+        'item:{}'.format(item_id), 'title & <more> "quoted"',
+        album='the album', artist='the artist', year=2001, genre='genre',
+        coverArt='album:1', path='the/path.flac', parent='album:1', track=3,
+        duration=187.62, type=utils.get_music_type(), isVideo=False,
+        suffix='flac', **kwargs)
+
+
+def album_id3(album_id):
+    return utils.create_album_id3(
+        id='album:{}'.format(album_id), name='album {}'.format(album_id),
+        song_count=12, duration=3012.4,
+        created=datetime(2017, 3, 4, 5, 6, 7, 120000),
+        artist='artist', artistId='artist:artist', coverArt='album:1',
+        year=1999, genre='genre')
+
+
+class SerializersTest(unittest.TestCase):
+    """Compare the serializers' output with PyXB's, which is used to validate
+    the records against the Subsonic schema."""
+
+    def setUp(self):
+        pyxb.utils.domutils.BindingDOMSupport.SetDefaultNamespace(
+            bindings.Namespace)
+
+    def assertSameOutput(self, response):
+        binding = serializers.to_binding(response)
+        self.assertEqual(binding.toxml('utf-8'), serializers.to_xml(response))
+        self.assertEqual(
+            json.loads(json.dumps(utils.element_to_obj(binding),
+                                  cls=utils.JsonEncoder)),
+            json.loads(json.dumps(serializers.to_obj(response),
+                                  cls=utils.JsonEncoder)))
+
+    def test_empty_response(self):
+        response = utils.create_subsonic_response('1.16.1')
+        self.assertSameOutput(response)
+
+    def test_error_response(self):
+        response = utils.create_subsonic_response(
+            '1.16.1', bindings.ResponseStatus.failed)
+        response.error = utils.create_error(70, 'Not <found>')
+        self.assertSameOutput(response)
+
+    def test_album_list2(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.albumList2 = utils.create_album_list2(
+            [album_id3(i) for i in range(5)])
+        self.assertSameOutput(response)
+
+    def test_music_directory(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.directory = utils.create_directory(
+            'album:1', 'the album', [song(i) for i in range(5)],
+            parent='artist:artist')
+        self.assertSameOutput(response)
+
+    def test_indexes(self):
+        response = utils.create_subsonic_response('1.16.1')
+        artists = [utils.create_artist('artist:' + name, name)
+                   for name in ['The Band', 'abba', 'Zappa', 'Les Rita']]
+        indexes = utils.create_indexes(artists, 'The La Les')
+        indexes.lastModified = 1490000000
+        indexes.append(song(1))
+        response.indexes = indexes
+        self.assertSameOutput(response)
+
+    def test_empty_indexes(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.indexes = utils.create_indexes([], 'The')
+        response.indexes.lastModified = 0
+        self.assertSameOutput(response)
+
+    def test_user(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.user = utils.create_user(
+            'user', False, True, False, True, False, True, True, False,
+            False, True, False, False, False, folder_ids=[1, 2])
+        self.assertSameOutput(response)
+
+    def test_lyrics(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.lyrics = utils.create_lyrics('la la\nla & "lo"',
+                                              artist='a', title='t')
+        self.assertSameOutput(response)
+
+    def test_empty_lyrics(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.lyrics = utils.create_lyrics('', artist='a', title='t')
+        self.assertSameOutput(response)
+
+    def test_genres(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.genres = utils.create_genres([
+            utils.create_genre('Rock & Roll', 2, 10),
+            utils.create_genre('Jazz', 1, 5),
+        ])
+        self.assertSameOutput(response)
+
+    def test_artist_info(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.artistInfo2 = utils.create_artist_info2('some-mbid')
+        self.assertSameOutput(response)
+
+    def test_playlist(self):
+        now = datetime(2017, 1, 2, 3, 4, 5)
+        response = utils.create_subsonic_response('1.16.1')
+        response.playlist = utils.create_playlist(
+            [song(1), song(2)], ['user'], 'playlist:p.m3u', 'p', 2, 375, now,
+            now, owner='user')
+        self.assertSameOutput(response)
+
+    def test_playlists(self):
+        now = datetime(2017, 1, 2, 3, 4, 5)
+        response = utils.create_subsonic_response('1.16.1')
+        response.playlists = utils.create_playlists([
+            utils.create_playlist_summary(['user'], 'playlist:p.m3u', 'p', 2,
+                                          375, now, now, owner='user')])
+        self.assertSameOutput(response)
+
+    def test_binding_children(self):
+        response = utils.create_subsonic_response('1.16.1')
+        album = bindings.AlbumWithSongsID3(id='id', name='name', songCount=1,
+                                           duration=60,
+                                           created=datetime(2017, 1, 1))
+        album.append(bindings.Child(id='item:1', isDir=False, title='t'))
+        response.album = album
+        self.assertSameOutput(response)
+
+    def test_element_to_obj_plural(self):
+        album_list = bindings.AlbumList2()
+        album_list.append(bindings.AlbumID3(id='album:1', name='name',
+                                            songCount=1, duration=60,
+                                            created=datetime(2017, 1, 1)))
+        obj = utils.element_to_obj(album_list.album)
+        self.assertEqual(['album'], list(obj.keys()))
+        self.assertEqual('album:1', obj['album'][0]['id'])
+        self.assertEqual(60, obj['album'][0]['duration'])
+
+    def test_iter_json(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.albumList2 = utils.create_album_list2(
+            [album_id3(i) for i in range(3)])
+        response.albumList2.album[0].name = 'caf\xe9 "<&>"'
+        obj = serializers.to_obj(response)
+        for indent in [None, 3]:
+            self.assertEqual(
+                json.dumps(obj, cls=utils.JsonEncoder, indent=indent),
+                ''.join(serializers.iter_json(response, indent=indent)))
+
+    def test_iter_json_empty_plurals(self):
+        response = utils.create_subsonic_response('1.16.1')
+        response.directory = utils.create_directory('album:1', 'the album',
+                                                    [])
+        obj = serializers.to_obj(response)
+        for indent in [None, 3]:
+            self.assertEqual(
+                json.dumps(obj, cls=utils.JsonEncoder, indent=indent),
+                ''.join(serializers.iter_json(response, indent=indent)))
+
+    def test_streamed_plurals(self):
+        def make_response():
+            response = utils.create_subsonic_response('1.16.1')
+            artists = (utils.create_artist('artist:' + name, name)
+                       for name in ['abba', 'The Band', 'Les Rita', 'Zappa'])
+            indexes = utils.create_indexes(artists, 'The La Les')
+            indexes.lastModified = 1490000000
+            indexes.child = (song(i) for i in range(3))
+            response.indexes = indexes
+            return response
+
+        self.assertEqual(serializers.to_binding(make_response()).toxml('utf-8'),
+                         serializers.to_xml(make_response()))
+        self.assertEqual(
+            json.loads(''.join(serializers.iter_json(make_response()))),
+            json.loads(json.dumps(serializers.to_obj(make_response()),
+                                  cls=utils.JsonEncoder)))
+        names = [index.name for index in make_response().indexes.index]
+        self.assertEqual(['A', 'B', 'R', 'Z'], names)
+
+    def test_buffered(self):
+        blocks = list(serializers.buffered(['ab', 'c', '\xe9', 'd'], size=3))
+        self.assertEqual([b'abc', '\xe9d'.encode('utf-8')], blocks)
+
+    def test_append_unknown_type(self):
+        with self.assertRaises(TypeError):
+            utils.create_songs([album_id3(1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the server module"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import sys
+
+import unittest2 as unittest
+from mock import MagicMock, patch
+
+from beetsplug.beetsonic import server
+
+
+class ServeTest(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(server.DEFAULT_CONFIG)
+        self.app = MagicMock()
+        self.create_app = MagicMock(return_value=self.app)
+
+    def test_development(self):
+        server.serve(self.create_app, '127.0.0.1', 5000, self.config, True)
+        self.app.run.assert_called_once_with(host='127.0.0.1', port=5000,
+                                             debug=True, threaded=True)
+
+    def test_unknown_backend(self):
+        self.config['backend'] = 'unknown'
+        with self.assertRaises(server.ServerError):
+            server.serve(self.create_app, '127.0.0.1', 5000, self.config)
+
+    def test_missing_backend(self):
+        for backend, module in [('waitress', 'waitress.server'),
+                                ('gunicorn', 'gunicorn.app.base')]:
+            self.config['backend'] = backend
+            with patch.dict(sys.modules, {module: None}):
+                with self.assertRaises(server.ServerError):
+                    server.serve(self.create_app, '127.0.0.1', 5000,
+                                 self.config)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the stats module"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import unittest2 as unittest
+
+from beetsplug.beetsonic import stats
+
+
+class PlayStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = stats.PlayStats(':memory:')
+
+    def tearDown(self):
+        self.stats.close()
+
+    def test_frequent(self):
+        self.stats.record_plays([(1, 10, 100), (2, 10, 200), (3, 20, 300),
+                                 (4, None, 400)])
+        self.stats.record_play(5, 30, 50)
+        self.assertEqual([10, 20, 30],
+                         self.stats.get_album_ids('frequent', 10))
+        self.assertEqual([20, 30], self.stats.get_album_ids('frequent', 2, 1))
+
+    def test_recent(self):
+        self.stats.record_plays([(1, 10, 100), (2, 20, 300), (3, 10, 200)])
+        self.assertEqual([20, 10], self.stats.get_album_ids('recent', 10))
+        # Plays recorded late do not go back in time
+        self.stats.record_play(2, 20, 50)
+        self.assertEqual([20, 10], self.stats.get_album_ids('recent', 10))
+
+    def test_starred(self):
+        self.stats.star_album(10)
+        self.stats.star_album(20)
+        self.stats.star_album(10)
+        self.assertEqual([10, 20],
+                         sorted(self.stats.get_album_ids('starred', 10)))
+        self.stats.unstar_album(10)
+        self.assertEqual([20], self.stats.get_album_ids('starred', 10))
+
+    def test_play_queue(self):
+        plays = stats.PlayQueue(self.stats, flush_size=2, flush_interval=0.1)
+        plays.put(1, 10, 100)
+        plays.put(2, 20, 200)
+        plays.put(3, 20, 300)
+        plays.join()
+        self.assertEqual([20, 10], self.stats.get_album_ids('frequent', 10))
+        plays.put(4, 30, 400)
+        plays.close()
+        self.assertEqual([30, 20, 10],
+                         self.stats.get_album_ids('recent', 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
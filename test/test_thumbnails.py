@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the thumbnails module"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import os
+import shutil
+import tempfile
+
+import unittest2 as unittest
+from mock import MagicMock, patch
+
+from beetsplug.beetsonic import caches
+from beetsplug.beetsonic import thumbnails
+
+
+def fake_resize(maxwidth, path_in, path_out=None, quality=0,
+                max_filesize=0):
+    with open(path_out, 'wb') as f:
+        f.write('{} pixels'.format(maxwidth).encode('utf-8'))
+    return path_out
+
+
+class ThumbnailsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.artpath = os.path.join(self.dir, 'cover.jpg')
+        with open(self.artpath, 'wb') as f:
+            f.write(b'\xff' * 1000)
+        self.cache = thumbnails.ThumbnailCache(
+            os.path.join(self.dir, 'cache'), 1 << 20)
+        self.resizer = MagicMock(local=True)
+        self.resizer.resize.side_effect = fake_resize
+        patcher = patch.object(thumbnails, 'ArtResizer',
+                               MagicMock(shared=self.resizer))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_bucket_size(self):
+        self.assertEqual(64, thumbnails.bucket_size(1))
+        self.assertEqual(160, thumbnails.bucket_size(150))
+        self.assertEqual(160, thumbnails.bucket_size(160))
+        self.assertEqual(1024, thumbnails.bucket_size(1024))
+        self.assertIsNone(thumbnails.bucket_size(1025))
+
+    def test_thumbnail(self):
+        path = self.cache.thumbnail(self.artpath, 150)
+        self.assertTrue(path.startswith(self.cache.directory))
+        self.assertTrue(path.endswith('-160.jpg'))
+        with open(path, 'rb') as f:
+            self.assertEqual(b'160 pixels', f.read())
+        # Cached, with the other sizes of the same bucket
+        self.assertEqual(path, self.cache.thumbnail(self.artpath, 160))
+        self.assertEqual(1, self.resizer.resize.call_count)
+        # A new version of the cover art gets new thumbnails
+        os.utime(self.artpath, (1, 1))
+        self.assertNotEqual(path, self.cache.thumbnail(self.artpath, 160))
+        self.assertEqual(2, self.resizer.resize.call_count)
+
+    def test_original(self):
+        self.assertEqual(self.artpath,
+                         self.cache.thumbnail(self.artpath, 3000))
+        self.resizer.local = False
+        self.assertEqual(self.artpath, self.cache.thumbnail(self.artpath, 64))
+        self.resizer.resize.assert_not_called()
+
+    def test_resize_failure(self):
+        self.resizer.resize.side_effect = lambda maxwidth, path_in, *args: \
+            path_in
+        self.assertEqual(self.artpath, self.cache.thumbnail(self.artpath, 64))
+        self.assertEqual([], os.listdir(self.cache.directory))
+
+    def test_warm(self):
+        self.assertEqual(2, len(self.cache.warm(self.artpath,
+                                                [100, 128, 160])))
+        # Incremental
+        self.assertEqual([], self.cache.warm(self.artpath, [128, 160]))
+        self.assertEqual(1, len(self.cache.warm(self.artpath, [320])))
+        self.assertEqual(3, self.resizer.resize.call_count)
+        os.utime(self.artpath, (1, 1))
+        self.assertEqual(1, len(self.cache.warm(self.artpath, [160])))
+        self.assertEqual([], self.cache.warm(
+            os.path.join(self.dir, 'missing.jpg'), [160]))
+
+    def test_warm_all_full(self):
+        artpaths = []
+        for i in range(40):
+            artpaths.append(os.path.join(self.dir, '{}.jpg'.format(i)))
+            shutil.copy(self.artpath, artpaths[-1])
+        directory = os.path.join(self.dir, 'full')
+        # Room for five thumbnails of 10 bytes, shared by the processes
+        generated = list(thumbnails.warm_all(artpaths, directory, 55, [160],
+                                             4))
+        # Warming stops once the cache evicts thumbnails
+        self.assertEqual([1] * 6, generated)
+        # Left aside the temporary files of the workers stopped while writing
+        self.assertEqual(5, len([name for name in os.listdir(directory)
+                                 if not name.startswith(caches.TEMP_PREFIX)]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the transcoding module"""
+
+from __future__ import (
+    division,
+    absolute_import,
+    print_function,
+    unicode_literals,
+)
+
+import os
+import shutil
+import sys
+import tempfile
+
+import unittest2 as unittest
+from mock import patch
+
+from beetsplug.beetsonic import transcoding
+
+# Stand-in for the encoder: writes its arguments, then the source file.
+ENCODER_SCRIPT = '''
+import sys
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+out.write(' '.join(sys.argv[2:]).encode('utf-8') + b'\\n')
+with open(sys.argv[1], 'rb') as f:
+    out.write(f.read())
+'''
+
+
+class TranscodingTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.encoder = os.path.join(self.dir, 'encoder.py')
+        with open(self.encoder, 'w') as f:
+            f.write(ENCODER_SCRIPT)
+        self.song = os.path.join(self.dir, 'the song.flac')
+        with open(self.song, 'wb') as f:
+            f.write(b'\x00\x01' * 100000)
+        self.transcoder = transcoding.Transcoder.from_config({
+            'workers': 1,
+            'default_profile': 'mp3',
+            'profiles': {
+                'mp3': {
+                    'command': '"{}" "{}" $source ${{bitrate}}k $offset'
+                    .format(sys.executable, self.encoder),
+                    'mimetype': 'audio/mpeg',
+                    'bitrate': 192,
+                },
+                'opus': {
+                    'command': 'opusenc $source',
+                    'mimetype': 'audio/ogg',
+                    'suffix': 'ogg',
+                },
+            },
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_select(self):
+        mp3 = self.transcoder.profiles['mp3']
+        opus = self.transcoder.profiles['opus']
+        select = self.transcoder.select
+        # Nothing asked
+        self.assertIsNone(select('FLAC', 1000000))
+        self.assertIsNone(select('FLAC', 1000000, 'raw', 128))
+        # Lower bitrate, with the default profile
+        self.assertEqual((mp3, 128), select('FLAC', 1000000, max_bitrate=128))
+        self.assertIsNone(select('MP3', 128000, max_bitrate=128))
+        self.assertEqual((mp3, 192), select('MP3', 320000, max_bitrate=256))
+        # Other format, by name or by suffix
+        self.assertEqual((opus, 128), select('FLAC', 1000000, 'opus'))
+        self.assertEqual((opus, 96), select('MP3', 320000, 'ogg', 96))
+        self.assertIsNone(select('MP3', 128000, 'mp3'))
+        self.assertEqual((mp3, 192), select('FLAC', 1000000, 'unknown',
+                                            offset=10))
+        # Seeking
+        self.assertEqual((mp3, 192), select('MP3', 128000, offset=30))
+
+    def test_transcode(self):
+        profile = self.transcoder.profiles['mp3']
+        stream = self.transcoder.transcode(self.song, profile, 128, 12)
+        try:
+            data = b''.join(stream)
+        finally:
+            stream.close()
+        with open(self.song, 'rb') as f:
+            self.assertEqual(b'128k 12\n' + f.read(), data)
+        self.assertEqual(0, stream.process.returncode)
+
+    def test_workers(self):
+        profile = self.transcoder.profiles['mp3']
+        stream = self.transcoder.transcode(self.song, profile, 128)
+        with self.assertRaises(transcoding.TranscoderBusyError):
+            self.transcoder.transcode(self.song, profile, 128)
+        # Closing the stream before the end stops the encoder
+        stream.close()
+        self.assertIsNotNone(stream.process.returncode)
+        self.transcoder.transcode(self.song, profile, 128).close()
+
+    def test_missing_encoder(self):
+        profile = transcoding.TranscodingProfile(
+            'mp3', os.path.join(self.dir, 'missing'), 'audio/mpeg')
+        with self.assertRaises(OSError):
+            self.transcoder.transcode(self.song, profile, 128)
+        # The worker is free again
+        self.transcoder.transcode(
+            self.song, self.transcoder.profiles['mp3'], 128).close()
+
+    def _transcode_cached(self, cache, item_id, close_early=False):
+        profile = self.transcoder.profiles['mp3']
+        path = cache.path(item_id, 1490000000.5, profile, 128)
+        stream = cache.wrap(
+            self.transcoder.transcode(self.song, profile, 128), path)
+        try:
+            for _ in stream:
+                if close_early:
+                    break
+        finally:
+            stream.close()
+        return path
+
+    def test_cache(self):
+        cache = transcoding.TranscodeCache(os.path.join(self.dir, 'cache'),
+                                           1 << 20)
+        path = self._transcode_cached(cache, 1)
+        self.assertEqual(os.path.join(cache.directory,
+                                      '1-1490000000-mp3-128.mp3'), path)
+        self.assertEqual(path, cache.get(path))
+        with open(self.song, 'rb') as f:
+            song = f.read()
+        with open(path, 'rb') as f:
+            self.assertEqual(b'128k 0\n' + song, f.read())
+
+        # Incomplete transcodings are not cached
+        path = self._transcode_cached(cache, 2, close_early=True)
+        self.assertIsNone(cache.get(path))
+        self.assertEqual(['1-1490000000-mp3-128.mp3'],
+                         os.listdir(cache.directory))
+
+    def test_cache_eviction(self):
+        size = os.path.getsize(self.song)
+        cache = transcoding.TranscodeCache(os.path.join(self.dir, 'cache'),
+                                           size * 2 + 100)
+        first = self._transcode_cached(cache, 1)
+        second = self._transcode_cached(cache, 2)
+        os.utime(first, (1, 1))
+        os.utime(second, (2, 2))
+        # Using the first one makes the second the least recently used
+        cache.get(first)
+        # The size of the cache is known without listing the directory
+        with patch('os.listdir') as listdir:
+            third = self._transcode_cached(cache, 3)
+        self.assertFalse(listdir.called)
+        self.assertEqual(1, cache.evicted)
+        self.assertEqual(first, cache.get(first))
+        self.assertIsNone(cache.get(second))
+        self.assertEqual(third, cache.get(third))
+
+    def test_cache_shared(self):
+        size = os.path.getsize(self.song)
+        directory = os.path.join(self.dir, 'cache')
+        cache = transcoding.TranscodeCache(directory, size * 2 + 100)
+        # Another process, listing the directory on every add
+        other = transcoding.TranscodeCache(directory, size * 2 + 100,
+                                           rescan_interval=0)
+        first = self._transcode_cached(cache, 1)
+        second = self._transcode_cached(cache, 2)
+        os.utime(first, (1, 1))
+        os.utime(second, (2, 2))
+        third = self._transcode_cached(other, 3)
+        # The files of both processes count toward the size of the cache
+        self.assertEqual(1, other.evicted)
+        self.assertEqual(sorted(os.path.basename(path)
+                                for path in [second, third]),
+                         sorted(os.listdir(directory)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,20 +13,28 @@ from __future__ import (
 import binascii
 import hashlib
 import json
+import os
 import random
 import shutil
+import sqlite3
 import string
+import sys
 import tempfile
 import time
 from datetime import datetime, timedelta
 
 import unittest2 as unittest
 from enum import Enum
-from mock import MagicMock
+from mock import MagicMock, patch
 
 from beetsplug.beetsonic import bindings
 from beetsplug.beetsonic import errors
+from beetsplug.beetsonic import search
+from beetsplug.beetsonic import transcoding
+from beetsplug.beetsonic import utils
 from beetsplug.beetsonic import web
+from beetsplug.beetsonic.models import LibraryState, SongFile
+from test.test_transcoding import ENCODER_SCRIPT
 
 
 class ResponseType(Enum):
@@ -64,12 +72,22 @@ class BeetsonicWebTestCase(unittest.TestCase):
             'ignoredArticles': 'The La Les',
         }
         self.model = MagicMock()
-        server = web.SubsonicServer(self.model, self.configs, __name__)
-        self.app = server.test_client()
+        self.model.get_library_state.return_value = LibraryState(
+            '1-1', 1490000000.0)
+        self.server = web.SubsonicServer(self.model, self.configs, __name__)
+        self.app = self.server.test_client()
 
     def tearDown(self):
+        self.server.close()
         shutil.rmtree(self.configs['playlist_dir'])
 
+    def _create_server(self):
+        """Replace the server of the test, e.g. after changing its configs."""
+        self.server.close()
+        self.server = web.SubsonicServer(self.model, self.configs, __name__)
+        self.app = self.server.test_client()
+        return self.server
+
     def _get_content(self, response, response_type=ResponseType.xml,
                      callback='callback'):
         """Return the Response a Python object that has similar-ish structure
@@ -303,7 +321,7 @@ class BeetsonicWebTestCase(unittest.TestCase):
                 now.timetuple()
             )
             client_last_modified = time.mktime(
-                (now + timedelta(0, -10)).timetuple()
+                (now + timedelta(0, 10)).timetuple()
             )
             response = self._get_response(
                 '/rest/getIndexes.view',
@@ -313,6 +331,93 @@ class BeetsonicWebTestCase(unittest.TestCase):
             self.assertFalse(self.contains(response, 'indexes'))
             self.model.get_last_modified.assert_called_once()
 
+    def test_get_indexes_same_modified(self):
+        @self.response_types
+        def actual_tests(response_type):
+            self.model.get_last_modified.return_value = 1490000000.75
+            # The lastModified of the indexes, sent back by the client
+            response = self._get_response(
+                '/rest/getIndexes.view',
+                {'ifModifiedSince': 1490000000},
+                response_type
+            )
+            self.assertFalse(self.contains(response, 'indexes'))
+
+    def test_get_indexes_modified(self):
+        @self.response_types
+        def actual_tests(response_type):
+            now = datetime.now()
+            self.model.get_last_modified.return_value = time.mktime(
+                now.timetuple()
+            )
+            self.model.get_album_artists.return_value = []
+            self.model.get_singletons.return_value = []
+            client_last_modified = time.mktime(
+                (now + timedelta(0, -10)).timetuple()
+            )
+            response = self._get_response(
+                '/rest/getIndexes.view',
+                {'ifModifiedSince': client_last_modified},
+                response_type
+            )
+            self.assertTrue(self.contains(response, 'indexes'))
+
+    def test_conditional_request(self):
+        params = {
+            'v': web.SUBSONIC_API_VERSION,
+            'c': 'TestApp',
+            'u': self.configs['username'],
+            'p': self.configs['password'],
+            'id': 'album:1',
+        }
+        self.model.get_album.return_value = bindings.AlbumWithSongsID3(
+            id='album:1', name='name', songCount=0, duration=0,
+            created=datetime(2017, 1, 1))
+        response = self.app.get('/rest/getAlbum.view', query_string=params)
+        self.assertEqual(200, response.status_code)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        # The password does not change the response
+        params['p'] = 'enc:' + binascii.hexlify(
+            self.configs['password'].encode()).decode()
+        response = self.app.get('/rest/getAlbum.view', query_string=params,
+                                headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.data)
+        response = self.app.get('/rest/getAlbum.view', query_string=params,
+                                headers={'If-Modified-Since': last_modified})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(1, self.model.get_album.call_count)
+
+        # Other arguments do
+        params['f'] = 'json'
+        response = self.app.get('/rest/getAlbum.view', query_string=params,
+                                headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+
+        # And so does a new generation of the library
+        self.model.get_library_state.return_value = LibraryState(
+            '1-2', 1490000000.0)
+        params['f'] = 'xml'
+        response = self.app.get('/rest/getAlbum.view', query_string=params,
+                                headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers['ETag'])
+
+    def test_random_album_list_not_conditional(self):
+        self.model.get_album_list2.return_value = utils.create_album_list2(
+            [])
+        response = self.app.get('/rest/getAlbumList2.view', query_string={
+            'v': web.SUBSONIC_API_VERSION,
+            'c': 'TestApp',
+            'u': self.configs['username'],
+            'p': self.configs['password'],
+            'type': 'random',
+        })
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('ETag', response.headers)
+
     def test_get_indexes_empty_indexes(self):
         @self.response_types
         def actual_tests(response_type):
@@ -331,6 +436,30 @@ class BeetsonicWebTestCase(unittest.TestCase):
             self.assertEqual(0, len(response.indexes.index))
             self.assertEqual(0, len(response.indexes.child))
 
+    def test_get_artists_cached(self):
+        @self.response_types
+        def actual_tests(response_type):
+            self.model.get_library_state.return_value = LibraryState(
+                '1-1', 1490000000.0)
+            self.model.get_album_artists_id3.return_value = [
+                bindings.ArtistID3(id='artist:abba', name='abba',
+                                   albumCount=1),
+            ]
+            for _ in range(2):
+                response = self._get_response('/rest/getArtists.view',
+                                              response_type=response_type)
+                self.assertEqual('abba',
+                                 response.artists.index[0].artist[0].name)
+            self.model.get_album_artists_id3.assert_called_once()
+
+            self.model.get_library_state.return_value = LibraryState(
+                '1-2', 1490000000.0)
+            self.model.get_album_artists_id3.return_value = []
+            response = self._get_response('/rest/getArtists.view',
+                                          response_type=response_type)
+            self.assertEqual(2, self.model.get_album_artists_id3.call_count)
+            self.assertEqual(0, len(response.artists.index))
+
     def test_get_album_without_id(self):
         @self.response_types
         def actual_tests(response_type):
@@ -402,6 +531,312 @@ class BeetsonicWebTestCase(unittest.TestCase):
             self.assertEqual(mock_album.songCount, returned_album.songCount)
             self.assertEqual(mock_album.duration, returned_album.duration)
 
+    def _get_stream(self, headers):
+        params = {
+            'v': web.SUBSONIC_API_VERSION,
+            'c': 'TestApp',
+            'u': self.configs['username'],
+            'p': self.configs['password'],
+            'id': 'item:1',
+        }
+        return self.app.get('/rest/stream.view', query_string=params,
+                            headers=headers)
+
+    def _set_up_song(self, content):
+        path = os.path.join(self.configs['playlist_dir'], 'song.mp3')
+        with open(path, 'wb') as f:
+            f.write(content)
+        self.model.get_song_location.return_value = path
+        self.model.get_song_file.return_value = SongFile(1, path, 'MP3',
+                                                         128000, 0, 2)
+
+    def test_stream_ranges(self):
+        content = bytes(bytearray(range(256))) * 1024
+        self._set_up_song(content)
+
+        response = self._get_stream({})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(content, response.data)
+
+        for header, start, stop in [('bytes=0-', 0, len(content)),
+                                    ('bytes=10-99', 10, 100),
+                                    ('bytes=-500', len(content) - 500,
+                                     len(content)),
+                                    ('bytes=100000-999999', 100000,
+                                     len(content))]:
+            response = self._get_stream({'Range': header})
+            self.assertEqual(206, response.status_code)
+            self.assertEqual(content[start:stop], response.data)
+            self.assertEqual(
+                'bytes {}-{}/{}'.format(start, stop - 1, len(content)),
+                response.headers['Content-Range'])
+            self.assertEqual(str(stop - start),
+                             response.headers['Content-Length'])
+
+    def test_stream_multiple_ranges(self):
+        content = bytes(bytearray(range(256))) * 4
+        self._set_up_song(content)
+        response = self._get_stream({'Range': 'bytes=0-9,-10'})
+        self.assertEqual(206, response.status_code)
+        content_type = response.headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges'))
+        boundary = content_type.split('boundary=')[1].encode('ascii')
+        parts = response.data.split(b'--' + boundary)
+        self.assertEqual(4, len(parts))
+        self.assertIn(b'Content-Range: bytes 0-9/1024', parts[1])
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + content[:10] +
+                                          b'\r\n'))
+        self.assertIn(b'Content-Range: bytes 1014-1023/1024', parts[2])
+        self.assertTrue(parts[2].endswith(content[-10:] + b'\r\n'))
+        self.assertEqual(str(len(response.data)),
+                         response.headers['Content-Length'])
+
+    def test_stream_unsatisfiable_range(self):
+        self._set_up_song(b'0123456789')
+        response = self._get_stream({'Range': 'bytes=10-'})
+        self.assertEqual(416, response.status_code)
+        self.assertEqual('bytes */10', response.headers['Content-Range'])
+
+    def test_stream_transcoded(self):
+        content = b'0123456789' * 1000
+        self._set_up_song(content)
+        encoder = os.path.join(self.configs['playlist_dir'], 'encoder.py')
+        with open(encoder, 'w') as f:
+            f.write(ENCODER_SCRIPT)
+        self.configs['transcoding'] = {
+            'workers': 1,
+            'default_profile': 'mp3',
+            'profiles': {
+                'mp3': {
+                    'command': '"{}" "{}" $source ${{bitrate}}k $offset'
+                    .format(sys.executable, encoder),
+                    'mimetype': 'audio/mpeg',
+                },
+            },
+        }
+        server = self._create_server()
+
+        response = self._get_stream({})
+        self.assertEqual(content, response.data)
+
+        response = self.app.get('/rest/stream.view', query_string={
+            'v': web.SUBSONIC_API_VERSION,
+            'c': 'TestApp',
+            'u': self.configs['username'],
+            'p': self.configs['password'],
+            'id': 'item:1',
+            'maxBitRate': 64,
+            'timeOffset': 30,
+        })
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('audio/mpeg', response.mimetype)
+        self.assertEqual(b'64k 30\n' + content, response.data)
+
+        # The song is sent as it is, with ranges, when the workers are busy
+        with patch.object(server.blueprints['api'].transcoder, 'transcode',
+                          side_effect=transcoding.TranscoderBusyError):
+            response = self._get_stream({'Range': 'bytes=10-19'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(content[10:20], response.data)
+
+    def test_stream_transcode_cache(self):
+        content = b'0123456789' * 1000
+        self._set_up_song(content)
+        encoder = os.path.join(self.configs['playlist_dir'], 'encoder.py')
+        with open(encoder, 'w') as f:
+            f.write(ENCODER_SCRIPT)
+        self.configs['transcoding'] = {
+            'profiles': {
+                'mp3': {
+                    'command': '"{}" "{}" $source ${{bitrate}}k $offset'
+                    .format(sys.executable, encoder),
+                    'mimetype': 'audio/mpeg',
+                },
+            },
+            'cache_dir': os.path.join(self.configs['playlist_dir'], 'cache'),
+            'cache_size': 10,
+        }
+        self._create_server()
+        params = {
+            'v': web.SUBSONIC_API_VERSION,
+            'c': 'TestApp',
+            'u': self.configs['username'],
+            'p': self.configs['password'],
+            'id': 'item:1',
+            'format': 'mp3',
+            'maxBitRate': 64,
+        }
+        response = self.app.get('/rest/stream.view', query_string=params)
+        self.assertEqual(b'64k 0\n' + content, response.data)
+        response.close()
+
+        # Served from the cache, with support for ranges
+        os.remove(encoder)
+        response = self.app.get('/rest/stream.view', query_string=params,
+                                headers={'Range': 'bytes=0-5'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('audio/mpeg', response.mimetype)
+        self.assertEqual(b'64k 0\n', response.data)
+
+    def test_cover_art_caching(self):
+        path = os.path.join(self.configs['playlist_dir'], 'cover.jpg')
+        with open(path, 'wb') as f:
+            f.write(b'\xff' * 100)
+        self.model.get_cover_art.return_value = path
+        params = {
+            'v': web.SUBSONIC_API_VERSION,
+            'c': 'TestApp',
+            'u': self.configs['username'],
+            'p': self.configs['password'],
+            'id': 'album:1',
+            'size': 160,
+        }
+        response = self.app.get('/rest/getCoverArt.view', query_string=params)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'\xff' * 100, response.data)
+        self.assertIn('public', response.headers['Cache-Control'])
+        self.assertIn('max-age', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+
+        response = self.app.get('/rest/getCoverArt.view', query_string=params,
+                                headers={'If-None-Match': etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response.headers['ETag'])
+
+    def _set_up_play_stats(self, **configs):
+        self._set_up_song(b'0123456789')
+        self.configs['stats_db'] = ':memory:'
+        self.configs.update(configs)
+        plays = self._create_server().blueprints['api'].plays
+        plays.flush_interval = 0.01
+        self.model.get_album_list2_from_ids.return_value = \
+            utils.create_album_list2([])
+        self.model.get_song_album_id.side_effect = lambda id: {
+            'item:1': 2, 'item:4': 5}[id]
+        return plays
+
+    def _get_view(self, endpoint, **params):
+        params.update({
+            'v': web.SUBSONIC_API_VERSION,
+            'c': 'TestApp',
+            'u': self.configs['username'],
+            'p': self.configs['password'],
+        })
+        return self.app.get('/rest/' + endpoint, query_string=params)
+
+    def test_play_stats(self):
+        plays = self._set_up_play_stats()
+        get = self._get_view
+
+        # Plays are counted from the scrobbles, not from the streams
+        self._get_stream({}).close()
+        response = get('scrobble.view', id=['item:4', 'item:1', 'item:4'],
+                       time=[1490000000000, 1490000001000, 1490000002000])
+        self.assertEqual(200, response.status_code)
+        # Now playing notifications are not counted
+        get('scrobble.view', id='item:1', submission='false')
+        # Nor are scrobbles with invalid times, rather than shifting them
+        response = get('scrobble.view', id=['item:1', 'item:1', 'item:1'],
+                       time=['yesterday', 1490000003000, 1490000004000],
+                       f='json')
+        error = json.loads(response.get_data(as_text=True))[
+            'subsonic-response']['error']
+        self.assertEqual(errors.GENERIC_ERROR_CODE, error['code'])
+        plays.join()
+        response = get('getAlbumList2.view', type='frequent')
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('ETag', response.headers)
+        self.model.get_album_list2_from_ids.assert_called_with([5, 2])
+        self.assertEqual(0, self.model.get_album_list2.call_count)
+        get('getAlbumList2.view', type='recent')
+        self.model.get_album_list2_from_ids.assert_called_with([5, 2])
+
+        self.assertEqual(200, get('star.view', albumId='album:3').status_code)
+        get('getAlbumList2.view', type='starred')
+        self.model.get_album_list2_from_ids.assert_called_with([3])
+        get('unstar.view', albumId='album:3')
+        get('getAlbumList2.view', type='starred')
+        self.model.get_album_list2_from_ids.assert_called_with([])
+
+    def test_play_stats_from_streams(self):
+        plays = self._set_up_play_stats(count_streams=True)
+        get = self._get_view
+
+        self._get_stream({}).close()
+        # Parts of the same play are not counted again
+        self._get_stream({'Range': 'bytes=5-'}).close()
+        # Nor are the scrobbles of the songs streamed
+        response = get('scrobble.view', id=['item:4', 'item:4'])
+        self.assertEqual(200, response.status_code)
+        plays.join()
+        get('getAlbumList2.view', type='frequent')
+        self.model.get_album_list2_from_ids.assert_called_with([2])
+
+    def _get_search3(self, query):
+        self.model.get_artist_id3s_from_names.return_value = []
+        self.model.get_album_id3s_from_ids.return_value = []
+        self.model.get_songs_from_ids.return_value = [
+            utils.create_song('item:1', 'title')]
+        response = self.app.get('/rest/search3.view', query_string={
+            'v': web.SUBSONIC_API_VERSION,
+            'c': 'TestApp',
+            'u': self.configs['username'],
+            'p': self.configs['password'],
+            'f': 'json',
+            'query': query,
+            'songCount': 5,
+        })
+        self.assertEqual(200, response.status_code)
+        result = json.loads(response.get_data(as_text=True))
+        self.assertEqual(
+            'item:1',
+            result['subsonic-response']['searchResult3']['song'][0]['id'])
+
+    def test_search3(self):
+        self.configs['search_db'] = ':memory:'
+        with patch.object(search, 'keep_updated') as keep_updated:
+            server = self._create_server()
+        # Kept up to date from the start of the server
+        index = server.blueprints['api'].search_index
+        keep_updated.assert_called_once_with(
+            index, self.model.update_search_index)
+
+        # The library is searched without the index until it is built
+        self._get_search3('tit')
+        self.model.search_library.assert_called_with(u'song', u'tit', 5, 0)
+        self.assertFalse(self.model.update_search_index.called)
+
+        with index._connection as connection:
+            connection.execute(
+                'PRAGMA user_version={}'.format(search.INDEX_VERSION))
+        self.model.search_library.reset_mock()
+        self._get_search3('')
+        self.assertFalse(self.model.search_library.called)
+        self.model.get_songs_from_ids.assert_called_with([])
+        # Only updated in the background
+        self.assertFalse(self.model.update_search_index.called)
+
+        # Nor is the index needed while another process writes to it
+        error = sqlite3.OperationalError('database is locked')
+        with patch.object(index, 'search', side_effect=error):
+            self.model.search_library.return_value = [1]
+            self._get_search3('tit')
+        self.model.search_library.assert_called_with(u'song', u'tit', 5, 0)
+
+    def test_search3_without_fts5(self):
+        self.configs['search_db'] = ':memory:'
+        error = sqlite3.OperationalError('no such module: fts5')
+        with patch.object(search, 'SearchIndex', side_effect=error) as index:
+            server = self._create_server()
+            self.model.search_library.return_value = [1]
+            for _ in range(2):
+                self._get_search3('tit')
+        # Searched without an index, which is not tried again
+        index.assert_called_once_with(':memory:')
+        self.assertIsNone(server.blueprints['api'].search_index)
+        self.model.search_library.assert_called_with(u'song', u'tit', 5, 0)
+        self.assertFalse(self.model.update_search_index.called)
+
 
 if __name__ == '__main__':
     unittest.main()